@@ -0,0 +1,108 @@
+# benchmark of everything after the LLM call, driven by real recorded responses
+#
+# record a cassette first (LLM_CASSETTE_MODE=record, see core/cassette.py), then every story response in it gets
+# parsed, saved and read back (the /complete tree) against a scratch sqlite database, no network and no tokens.
+# the recorded LLM time is printed next to it for scale
+#
+# run from the backend folder:
+#   python -m benchmarks.bench_cassette [CASSETTE] [--repeat N]
+
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from core.config import settings
+from core.models import StoryBatchLLMResponse
+from core.search import ensure_search_index
+from core.story_generator import StoryGenerator
+from db.database import Base
+from models.story import Story
+from routers.story import build_complete_story_tree
+import models.job, models.story, models.playthrough # registers every table on Base
+
+
+def story_responses(path: str) -> tuple[list[str], list[float]]:
+    # one JSON text per story: single story responses as they are, batch responses split up, expansions skipped
+    stories, durations = [], []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            text = StoryGenerator._strip_code_fences(entry["content"])
+            try:
+                data = json.loads(text)
+            except ValueError:
+                continue # the model's garbage is real too, but there's nothing to benchmark in it
+
+            if "rootNode" in data:
+                stories.append(text)
+            elif "stories" in data:
+                stories += [story.model_dump_json() for story in StoryBatchLLMResponse.model_validate(data).stories]
+            else:
+                continue
+            durations.append(entry["duration"])
+    return stories, durations
+
+
+def timed(fn) -> float:
+    started = time.perf_counter()
+    fn()
+    return time.perf_counter() - started
+
+
+def summary(name: str, seconds: list[float]):
+    ms = sorted(s * 1000 for s in seconds)
+    p95 = ms[min(len(ms) - 1, int(len(ms) * 0.95))]
+    print(f"{name:<10} {statistics.median(ms):>10.3f} {p95:>10.3f} {max(ms):>10.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cassette", nargs="?", default=settings.LLM_CASSETTE_PATH)
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    texts, durations = story_responses(args.cassette)
+    if not texts:
+        print(f"no story responses in {args.cassette}")
+        return
+
+    with tempfile.TemporaryDirectory() as scratch:
+        engine = create_engine(f"sqlite:///{os.path.join(scratch, 'bench.db')}")
+        Base.metadata.create_all(engine)
+        ensure_search_index(engine)
+
+        parse, persist, read = [], [], []
+        with Session(engine) as db:
+            for _ in range(args.repeat):
+                for text in texts:
+                    parsed = []
+                    parse.append(timed(lambda: parsed.append(StoryGenerator._parse_story_response(text))))
+
+                    saved = []
+                    def save():
+                        saved.append(StoryGenerator._save_story(db, "bench", parsed[0]).id)
+                        db.commit()
+                    persist.append(timed(save))
+
+                    db.expunge_all() # nothing cached in the session, like a request that didn't generate the story
+                    read.append(timed(lambda: build_complete_story_tree(db, db.get(Story, saved[0])).model_dump_json()))
+        engine.dispose()
+
+    print(f"{len(texts)} stories from {args.cassette}, {args.repeat}x")
+    print(f"{'':<10} {'median ms':>10} {'p95 ms':>10} {'max ms':>10}")
+    summary("llm", durations)
+    summary("parse", parse)
+    summary("persist", persist)
+    summary("read", read)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# benchmark for parsing the LLM story response
+#
+# compares the old approach (first level validated, every nextNode re-validated from a dict while walking the tree)
+# against the recursive models in core/models.py that validate the whole tree in a single pass
+#
+# run from the backend folder:
+#   python -m benchmarks.bench_story_parse
+
+import json
+import timeit
+from typing import Any, Dict, List, Optional
+
+from pydantic import BaseModel
+
+from core.models import StoryLLMResponse, StoryNodeLLM
+
+
+# the models as they were before they became recursive, only used for comparison
+class LegacyStoryOptionLLM(BaseModel):
+    text: str
+    nextNode: Dict[str, Any]
+
+class LegacyStoryNodeLLM(BaseModel):
+    content: str
+    isEnding: bool
+    isWinningEnding: bool = False
+    options: Optional[List[LegacyStoryOptionLLM]] = None
+
+class LegacyStoryLLMResponse(BaseModel):
+    title: str
+    rootNode: LegacyStoryNodeLLM
+
+
+def build_story_json(node_count: int, branching: int = 3) -> str:
+    # breadth first so the tree stays as shallow as possible for the requested amount of nodes
+    root = {"content": "node 0 " + "lorem ipsum " * 20, "isEnding": False, "isWinningEnding": False, "options": []}
+    queue = [root]
+    created = 1
+    
+    while queue and created < node_count:
+        parent = queue.pop(0)
+        for _ in range(branching):
+            if created >= node_count:
+                break
+            child = {"content": f"node {created} " + "lorem ipsum " * 20, "isEnding": False, "isWinningEnding": False, "options": []}
+            parent["options"].append({"text": f"option {created}", "nextNode": child})
+            queue.append(child)
+            created += 1
+    
+    # whatever didn't get children is an ending
+    for leaf in queue:
+        leaf["isEnding"] = True
+        leaf["isWinningEnding"] = True
+        leaf["options"] = None
+    
+    return json.dumps({"title": "benchmark story", "rootNode": root})
+
+
+def parse_legacy(payload: str) -> int:
+    story = LegacyStoryLLMResponse.model_validate(json.loads(payload))
+    
+    count = 0
+    stack = [story.rootNode]
+    while stack:
+        node = stack.pop()
+        count += 1
+        for option in node.options or []:
+            stack.append(LegacyStoryNodeLLM.model_validate(option.nextNode))
+    return count
+
+
+def parse_single_pass(payload: str) -> int:
+    story = StoryLLMResponse.model_validate(json.loads(payload))
+    
+    count = 0
+    stack: List[StoryNodeLLM] = [story.rootNode]
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(option.nextNode for option in node.options or [])
+    return count
+
+
+def parse_from_json(payload: str) -> int:
+    # same as above but pydantic validates straight from the JSON text, skipping the intermediate dicts
+    story = StoryLLMResponse.model_validate_json(payload)
+    
+    count = 0
+    stack: List[StoryNodeLLM] = [story.rootNode]
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(option.nextNode for option in node.options or [])
+    return count
+
+
+def main():
+    print(f"{'nodes':>6} {'legacy ms':>10} {'single pass ms':>15} {'from json ms':>13} {'speedup':>8}")
+    
+    for node_count in (10, 100, 250, 500, 1000):
+        payload = build_story_json(node_count)
+        assert parse_legacy(payload) == parse_single_pass(payload) == parse_from_json(payload) == node_count
+        
+        number = max(1, 2000 // node_count)
+        legacy = min(timeit.repeat(lambda: parse_legacy(payload), number=number, repeat=5)) / number
+        single = min(timeit.repeat(lambda: parse_single_pass(payload), number=number, repeat=5)) / number
+        from_json = min(timeit.repeat(lambda: parse_from_json(payload), number=number, repeat=5)) / number
+        
+        print(f"{node_count:>6} {legacy * 1000:>10.3f} {single * 1000:>15.3f} {from_json * 1000:>13.3f} {legacy / from_json:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+# command line tools for running the backend outside of the api
+#
+#   python cli.py maintenance [--archive] [--no-vacuum]
+#   python cli.py purge-jobs [--retention-days N] [--failed-retention-days N] [--archive]
+#   python cli.py gc-orphans [--grace-minutes N]
+#   python cli.py vacuum
+#   python cli.py reindex-search
+#   python cli.py export FILE [--batch-size N] [--shard N]      (FILE.gz is gzipped, - is stdout)
+#   python cli.py import FILE [--batch-size N] [--no-index] [--shard N]
+#   python cli.py migrate-content
+#   python cli.py train-content-dict [--samples N]
+#   python cli.py recompress-content
+#   python cli.py content-report [--sample-stories N]
+#   python cli.py backfill-edges
+#   python cli.py serve
+#
+# with DATABASE_SHARD_URLS set the commands run on every shard, export / import work on one shard at a time
+
+import argparse
+import logging
+import sys
+
+from db.database import create_tables, each_shard_session, shard_engines, shard_session
+import models.job, models.story, models.playthrough # registers every table on Base before create_tables()
+
+
+def _shard_prefix(db) -> str:
+    # per shard output only says which shard when there's more than one
+    return f"shard {db.info['shard']} " if len(shard_engines) > 1 else ""
+
+
+def cmd_maintenance(args):
+    from core.maintenance import run_maintenance
+    
+    summary = run_maintenance(archive=args.archive or None, compact=not args.no_vacuum)
+    for key, value in summary.items():
+        print(f"{key}: {value}")
+
+
+def cmd_purge_jobs(args):
+    from core.maintenance import purge_jobs
+    
+    purged = sum(
+        purge_jobs(
+            db,
+            retention_days=args.retention_days,
+            failed_retention_days=args.failed_retention_days,
+            archive=args.archive or None,
+        )
+        for db in each_shard_session()
+    )
+    print(f"purged_jobs: {purged}")
+
+
+def cmd_gc_orphans(args):
+    from core.maintenance import collect_orphans
+    
+    deleted_stories, deleted_nodes = 0, 0
+    for db in each_shard_session():
+        stories, nodes = collect_orphans(db, grace_minutes=args.grace_minutes)
+        deleted_stories += stories
+        deleted_nodes += nodes
+    print(f"deleted_stories: {deleted_stories}")
+    print(f"deleted_nodes: {deleted_nodes}")
+
+
+def cmd_vacuum(args):
+    from core.maintenance import compact_database
+    
+    compact_database()
+    print("done")
+
+
+def cmd_reindex_search(args):
+    from core.search import rebuild_search_index
+    
+    indexed = sum(rebuild_search_index(db) for db in each_shard_session())
+    print(f"indexed_stories: {indexed}")
+
+
+def cmd_export(args):
+    from core.transfer import export_stories, open_ndjson
+    
+    db = shard_session(args.shard)
+    try:
+        with open_ndjson(args.file, "w") as out:
+            counts = export_stories(db, out, batch_size=args.batch_size)
+    finally:
+        db.close()
+    
+    # stdout might be the export itself
+    for key, value in counts.items():
+        print(f"exported_{key}: {value}", file=sys.stderr if args.file == "-" else sys.stdout)
+
+
+def cmd_import(args):
+    from core.transfer import import_stories, open_ndjson
+    
+    db = shard_session(args.shard)
+    try:
+        with open_ndjson(args.file, "r") as lines:
+            counts = import_stories(db, lines, batch_size=args.batch_size, index=not args.no_index)
+    finally:
+        db.close()
+    
+    for key, value in counts.items():
+        print(f"{key if key.startswith('skipped_') else 'imported_' + key}: {value}")
+
+
+def cmd_migrate_content(args):
+    from core.content_store import migrate_contents
+    
+    migrated = sum(migrate_contents(db) for db in each_shard_session())
+    print(f"migrated_nodes: {migrated}")
+
+
+def cmd_train_content_dict(args):
+    from core.content_store import train_dictionary
+    
+    # every shard has its own content store, and its own dictionaries
+    for db in each_shard_session():
+        dictionary_id = train_dictionary(db, samples=args.samples)
+        prefix = _shard_prefix(db)
+        print(f"{prefix}dictionary_id: {dictionary_id}" if dictionary_id else f"{prefix}not enough node texts to train on")
+
+
+def cmd_recompress_content(args):
+    from core.content_store import recompress_contents
+    
+    recompressed = sum(recompress_contents(db) for db in each_shard_session())
+    print(f"recompressed_contents: {recompressed}")
+
+
+def cmd_content_report(args):
+    from core.content_store import storage_report
+    
+    for db in each_shard_session():
+        report = storage_report(db, sample_stories=args.sample_stories)
+        for key, value in report.items():
+            print(f"{_shard_prefix(db)}{key}: {value}")
+
+
+def cmd_backfill_edges(args):
+    from core.story_graph import backfill_edges
+    
+    backfilled = sum(backfill_edges(db) for db in each_shard_session())
+    print(f"backfilled_stories: {backfilled}")
+
+
+def cmd_serve(args):
+    from core.server import serve
+    
+    serve()
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Choose your own adventure backend tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    
+    maintenance = subparsers.add_parser("maintenance", help="purge old jobs, collect orphans and vacuum")
+    maintenance.add_argument("--archive", action="store_true", help="copy purged jobs to story_jobs_archive")
+    maintenance.add_argument("--no-vacuum", action="store_true", help="skip VACUUM/ANALYZE")
+    maintenance.set_defaults(func=cmd_maintenance)
+    
+    purge = subparsers.add_parser("purge-jobs", help="delete finished jobs past the retention window")
+    purge.add_argument("--retention-days", type=int, default=None)
+    purge.add_argument("--failed-retention-days", type=int, default=None)
+    purge.add_argument("--archive", action="store_true", help="copy purged jobs to story_jobs_archive")
+    purge.set_defaults(func=cmd_purge_jobs)
+    
+    orphans = subparsers.add_parser("gc-orphans", help="delete unfinished, unread stories and nodes without a story")
+    orphans.add_argument("--grace-minutes", type=int, default=None)
+    orphans.set_defaults(func=cmd_gc_orphans)
+    
+    vacuum = subparsers.add_parser("vacuum", help="run VACUUM/ANALYZE on the database(s)")
+    vacuum.set_defaults(func=cmd_vacuum)
+    
+    reindex = subparsers.add_parser("reindex-search", help="rebuild the full-text search index from the stories")
+    reindex.set_defaults(func=cmd_reindex_search)
+    
+    export = subparsers.add_parser("export", help="stream stories, nodes and jobs to an NDJSON file")
+    export.add_argument("file", help="output file, .gz to compress, - for stdout")
+    export.add_argument("--batch-size", type=int, default=1000, help="rows fetched per round trip")
+    export.add_argument("--shard", type=int, default=0, choices=range(len(shard_engines)), help="which shard to export (DATABASE_SHARD_URLS)")
+    export.set_defaults(func=cmd_export)
+    
+    import_ = subparsers.add_parser("import", help="load an NDJSON export, stories get new ids")
+    import_.add_argument("file", help="input file, .gz if compressed, - for stdin")
+    import_.add_argument("--batch-size", type=int, default=200, help="stories inserted per transaction")
+    import_.add_argument("--no-index", action="store_true", help="skip the search index (run reindex-search later)")
+    import_.add_argument("--shard", type=int, default=0, choices=range(len(shard_engines)), help="shard to import into, jobs keep their ids so use the one they were exported from")
+    import_.set_defaults(func=cmd_import)
+    
+    migrate_content = subparsers.add_parser("migrate-content", help="move node text into the compressed content store")
+    migrate_content.set_defaults(func=cmd_migrate_content)
+    
+    train = subparsers.add_parser("train-content-dict", help="train a compression dictionary on the stored node texts")
+    train.add_argument("--samples", type=int, default=5000)
+    train.set_defaults(func=cmd_train_content_dict)
+    
+    recompress = subparsers.add_parser("recompress-content", help="rewrite stored node texts with the newest dictionary")
+    recompress.set_defaults(func=cmd_recompress_content)
+    
+    content_report = subparsers.add_parser("content-report", help="bytes saved by the content store and its read cost")
+    content_report.add_argument("--sample-stories", type=int, default=200)
+    content_report.set_defaults(func=cmd_content_report)
+    
+    backfill = subparsers.add_parser("backfill-edges", help="fill story_edges for stories that don't have them yet")
+    backfill.set_defaults(func=cmd_backfill_edges)
+    
+    serve = subparsers.add_parser("serve", help="run the api with multiple workers (production)")
+    serve.set_defaults(func=cmd_serve)
+    
+    return parser
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    
+    args = build_parser().parse_args()
+    create_tables()
+    args.func(args)
@@ -0,0 +1,138 @@
+# record / replay of LLM calls (LLM_CASSETTE_MODE)
+#
+# record: every call StoryGenerator makes goes to gemini as usual, and the prompt, the raw response (text and token
+#         usage) and how long it took get appended to LLM_CASSETTE_PATH
+# replay: nothing goes over the network, calls are answered from the cassette, after sleeping as long as the
+#         original call took (LLM_CASSETTE_REPLAY_TIMING=false answers right away)
+#
+# so real production responses, with their real sizes and quirks, can drive benchmarks of the parsing, persistence
+# and read path offline and without spending tokens (see benchmarks/bench_cassette.py)
+#
+# the cassette is NDJSON, one call per line. in replay a call gets the recorded responses for the same prompt in the
+# order they were recorded (starting over when they run out), LLM_CASSETTE_MATCH=order ignores the prompt and
+# hands out every response of the file in turn
+
+import hashlib
+import itertools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from langchain_core.messages import AIMessage
+
+from core.config import settings
+
+
+class CassetteMiss(LookupError):
+    pass
+
+
+def prompt_messages(prompt_value) -> list[list[str]]:
+    return [[message.type, message.content] for message in prompt_value.to_messages()]
+
+
+def prompt_key(messages: list[list[str]]) -> str:
+    return hashlib.sha256(json.dumps(messages).encode()).hexdigest()
+
+
+class CassetteRecorder:
+    # wraps the real LLM, same invoke() as langchain's chat models
+
+    def __init__(self, llm, path: str):
+        self.llm = llm
+        self.path = path
+        self.model = getattr(llm, "model", None)
+
+    def invoke(self, prompt_value):
+        messages = prompt_messages(prompt_value)
+
+        started = time.monotonic()
+        response = self.llm.invoke(prompt_value)
+        duration = time.monotonic() - started
+
+        entry = {
+            "key": prompt_key(messages),
+            "messages": messages,
+            "content": response.content,
+            "model": (getattr(response, "response_metadata", None) or {}).get("model_name") or self.model,
+            "usage_metadata": dict(getattr(response, "usage_metadata", None) or {}),
+            "duration": round(duration, 4),
+            "recorded_at": datetime.now(timezone.utc).isoformat(),
+        }
+        line = (json.dumps(entry) + "\n").encode()
+
+        # one write per line on an O_APPEND file, so calls recorded by several workers at once don't interleave
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+        return response
+
+
+class Cassette:
+
+    def __init__(self, path: str):
+        self.entries: list[dict] = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    self.entries.append(json.loads(line))
+
+        by_key: dict[str, list[dict]] = defaultdict(list)
+        for entry in self.entries:
+            by_key[entry["key"]].append(entry)
+        self._by_key = {key: itertools.cycle(entries) for key, entries in by_key.items()}
+        self._in_order = itertools.cycle(self.entries)
+        self._lock = threading.Lock()
+
+    def next_entry(self, messages: list[list[str]], match: str = "prompt") -> dict:
+        with self._lock:
+            if not self.entries:
+                raise CassetteMiss("the cassette is empty")
+            if match == "order":
+                return next(self._in_order)
+
+            responses = self._by_key.get(prompt_key(messages))
+            if responses is None:
+                raise CassetteMiss("no recorded response for this prompt (LLM_CASSETTE_MATCH=order ignores the prompt)")
+            return next(responses)
+
+
+class CassettePlayer:
+
+    def __init__(self, cassette: Cassette, match: str = "prompt", timing: bool = True):
+        self.cassette = cassette
+        self.match = match
+        self.timing = timing
+
+    def invoke(self, prompt_value):
+        entry = self.cassette.next_entry(prompt_messages(prompt_value), self.match)
+        if self.timing:
+            time.sleep(entry["duration"])
+        return AIMessage(
+            content=entry["content"],
+            usage_metadata=entry["usage_metadata"] or None,
+            response_metadata={"model_name": entry.get("model")},
+        )
+
+
+_cassette: Cassette | None = None
+_cassette_lock = threading.Lock()
+
+
+def replay_llm() -> CassettePlayer:
+    # the file is read once per process, every call after that shares it
+    global _cassette
+    with _cassette_lock:
+        if _cassette is None:
+            _cassette = Cassette(settings.LLM_CASSETTE_PATH)
+    return CassettePlayer(_cassette, settings.LLM_CASSETTE_MATCH, settings.LLM_CASSETTE_REPLAY_TIMING)
+
+
+def record_llm(llm) -> CassetteRecorder:
+    return CassetteRecorder(llm, settings.LLM_CASSETTE_PATH)
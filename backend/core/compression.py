@@ -0,0 +1,127 @@
+# gzip / brotli response compression
+#
+# - CompressionMiddleware compresses any response over COMPRESSION_MINIMUM_SIZE for clients that accept it
+# - complete story payloads don't change once generated, so get_complete_story compresses them once
+#   (see core/story_payloads.py) and the middleware leaves responses that are already encoded alone
+#
+# brotli is optional, without the package installed everything falls back to gzip
+
+import gzip
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from core.config import settings
+
+try:
+    import brotli
+except ImportError: # uv add brotli to turn it on
+    brotli = None
+
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/x-ndjson")
+
+
+def available_encodings() -> list[str]:
+    # in order of preference
+    return ["br", "gzip"] if brotli else ["gzip"]
+
+
+def negotiate_encoding(accept_encoding: str | None) -> str | None:
+    # picks the best encoding we support out of an Accept-Encoding header, None means send it uncompressed
+    if not accept_encoding:
+        return None
+
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                continue
+        accepted[name.strip().lower()] = quality
+
+    best = None
+    for encoding in available_encodings():
+        quality = accepted.get(encoding, accepted.get("*", 0))
+        if quality > 0 and (best is None or quality > best[1]):
+            best = (encoding, quality)
+
+    return best[0] if best else None
+
+
+def compress(body: bytes, encoding: str, precompressed: bool = False) -> bytes:
+    # payloads that get compressed once and stored can afford the slowest, smallest settings
+    if encoding == "br":
+        quality = 11 if precompressed else settings.COMPRESSION_BROTLI_QUALITY
+        return brotli.compress(body, quality=quality)
+    if encoding == "gzip":
+        level = 9 if precompressed else settings.COMPRESSION_GZIP_LEVEL
+        return gzip.compress(body, compresslevel=level, mtime=0)
+    raise ValueError(f"unsupported encoding {encoding}")
+
+
+def decompress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.decompress(body)
+    if encoding == "gzip":
+        return gzip.decompress(body)
+    raise ValueError(f"unsupported encoding {encoding}")
+
+
+class CompressionMiddleware:
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message: Message | None = None
+        chunks: list[bytes] = []
+        passthrough = False
+
+        async def send_wrapper(message: Message):
+            nonlocal start_message, passthrough
+
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                content_type = headers.get("content-type", "")
+                # already encoded (precompressed story payloads) or not worth compressing
+                if "content-encoding" in headers or not content_type.startswith(COMPRESSIBLE_TYPES):
+                    passthrough = True
+                    await send(message)
+                else:
+                    start_message = message
+                return
+
+            if passthrough or message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+
+            body = b"".join(chunks)
+            headers = MutableHeaders(raw=start_message["headers"])
+            headers.add_vary_header("Accept-Encoding")
+
+            if len(body) >= self.minimum_size:
+                body = compress(body, encoding)
+                headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(body))
+
+            await send(start_message)
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_wrapper)
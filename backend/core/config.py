@@ -6,16 +6,144 @@ from pydantic import field_validator
 class Settings(BaseSettings):
     API_PREFIX: str = "/api"
     DEBUG: bool = False
+    
+    # production server (python cli.py serve, see core/server.py), 0 workers means one per cpu
+    HOST: str = "0.0.0.0"
+    PORT: int = 8000
+    WEB_CONCURRENCY: int = 0
+    KEEP_ALIVE_SECONDS: int = 5
+    GRACEFUL_TIMEOUT_SECONDS: int = 30
+    PRELOAD_APP: bool = True
     DATABASE_URL: str
+    # read replicas for the GET endpoints, comma separated like ALLOWED_ORIGINS, empty means reads use DATABASE_URL
+    DATABASE_READ_URL: str = ""
+    # optional extra databases, comma separated. DATABASE_URL is shard 0, these are shards 1, 2, ...
+    # stories and jobs go to a shard by session (see db/sharding.py). only ever add to the end of the list
+    DATABASE_SHARD_URLS: str = ""
+    # after a create, the client reads from the primary for this long so it sees its own jobs (replication lag)
+    READ_YOUR_WRITES_SECONDS: int = 10
     ALLOWED_ORIGINS: str = ""
     GOOGLE_API_KEY: str
     
+    # maintenance (see core/maintenance.py), an interval of 0 means it only runs from the cli
+    JOB_RETENTION_DAYS: int = 30
+    FAILED_JOB_RETENTION_DAYS: int = 7
+    ARCHIVE_JOBS: bool = False
+    ORPHAN_GRACE_MINUTES: int = 60
+    MAINTENANCE_BATCH_SIZE: int = 500
+    MAINTENANCE_INTERVAL_MINUTES: int = 0
+    
+    # admission control on /stories/create (see core/rate_limit.py), rates are stories per minute
+    SESSION_RATE_LIMIT_PER_MINUTE: float = 5
+    SESSION_RATE_LIMIT_BURST: int = 10
+    GLOBAL_RATE_LIMIT_PER_MINUTE: float = 120
+    GLOBAL_RATE_LIMIT_BURST: int = 200
+    MAX_JOB_BACKLOG: int = 500
+    # a batch costs one token per theme, so keep this <= SESSION_RATE_LIMIT_BURST or full batches never get in
+    MAX_STORY_BATCH_SIZE: int = 10
+    BACKLOG_STATS_TTL_SECONDS: float = 5
+    RETRY_AFTER_MAX_SECONDS: int = 300
+    # empty keeps the limiter state in memory (per process), redis://... shares it between nodes
+    RATE_LIMIT_BACKEND_URL: str = ""
+    
+    # generation scheduler (see core/scheduler.py)
+    GENERATION_WORKERS: int = 4
+    MAX_JOBS_PER_SESSION: int = 2
+    # up to this many queued themes go out in one LLM call, 1 turns batching off
+    GENERATION_BATCH_SIZE: int = 3
+    GENERATION_BATCH_WINDOW_SECONDS: float = 0.25
+    
+    # LLM calls (see core/llm_guard.py), the concurrency limit is per process and shared by stories and expansions
+    LLM_TIMEOUT_SECONDS: float = 120
+    LLM_MAX_CONCURRENCY: int = 4
+    LLM_QUEUE_TIMEOUT_SECONDS: float = 60
+    LLM_BREAKER_WINDOW_SECONDS: float = 60
+    LLM_BREAKER_MIN_CALLS: int = 5 # fewer calls than this in the window never open the breaker
+    LLM_BREAKER_FAILURE_RATE: float = 0.5
+    LLM_BREAKER_SLOW_CALL_SECONDS: float = 90 # a call that took longer counts as failed even if it answered
+    LLM_BREAKER_COOLDOWN_SECONDS: float = 30
+    
+    # record / replay of LLM calls for offline benchmarks (see core/cassette.py), empty, record or replay
+    LLM_CASSETTE_MODE: str = ""
+    LLM_CASSETTE_PATH: str = "llm_cassette.jsonl"
+    LLM_CASSETTE_MATCH: str = "prompt" # or order
+    LLM_CASSETTE_REPLAY_TIMING: bool = True # sleep as long as the recorded call took
+    
+    # sql instrumentation (see core/sql_stats.py), DEBUG adds a Server-Timing header with the request's db time
+    SQL_SLOW_QUERY_MS: float = 200
+    SQL_REPEATED_STATEMENT_THRESHOLD: int = 25 # same statement this often in one request / job gets logged as N+1
+    
+    # per job cost accounting (see core/job_accounting.py), tracing memory slows every allocation down
+    JOB_ACCOUNTING_TRACE_MEMORY: bool = False
+    JOB_USAGE_RETENTION_DAYS: int = 90
+    JOB_USAGE_STATS_MAX_ROWS: int = 50_000
+    # the operator endpoints (GET /jobs/usage/stats, /jobs/scheduler/stats) show themes players typed and other
+    # sessions' queues, they need this in an X-Admin-Token header. empty turns them off
+    ADMIN_TOKEN: str = ""
+    
+    # job leases (see core/leases.py), a running job's lease gets renewed every heartbeat,
+    # keep the lease a few heartbeats long so one slow beat doesn't hand the job to someone else
+    JOB_LEASE_SECONDS: int = 120
+    JOB_HEARTBEAT_SECONDS: int = 30
+    JOB_MAX_ATTEMPTS: int = 3
+    JOB_REAPER_INTERVAL_SECONDS: int = 60
+    
+    # job status cache in front of GET /jobs/{job_id} (see core/job_cache.py), empty keeps it in memory (per process),
+    # redis://... shares it between nodes, local:// is an in-process stand-in for redis
+    JOB_STATUS_CACHE_URL: str = ""
+    JOB_STATUS_CACHE_TTL_SECONDS: int = 3600
+    JOB_STATUS_CACHE_MAX_ENTRIES: int = 50_000
+    # in memory, pending/processing entries expire this fast since other workers finish the job (see core/job_cache.py)
+    JOB_STATUS_CACHE_MEMORY_UNFINISHED_TTL_SECONDS: int = 5
+    
+    # endless mode (see core/expansion.py)
+    ENDLESS_EXPANSION_WORKERS: int = 2
+    ENDLESS_PREFETCH: bool = True
+    ENDLESS_MAX_NODES: int = 500 # per story, so one story can't grow forever
+    ENDLESS_CONTEXT_STEPS: int = 12 # how much of the path so far goes into the prompt
+    ENDLESS_EXPANSION_TIMEOUT_SECONDS: int = 300 # a queued/running expansion older than this counts as lost
+    # expansions of one story, whoever asks (on top of the per client limit, see core/rate_limit.py)
+    ENDLESS_STORY_EXPANSIONS_PER_MINUTE: float = 10
+    ENDLESS_STORY_EXPANSION_BURST: int = 20
+    
+    # a repeated Idempotency-Key on /stories/create returns the original job for this long
+    IDEMPOTENCY_KEY_TTL_HOURS: int = 24
+    IDEMPOTENCY_KEY_MAX_LENGTH: int = 255
+    
+    # playthrough progress write-behind buffer (see core/playthrough.py)
+    PLAYTHROUGH_FLUSH_SIZE: int = 500
+    PLAYTHROUGH_FLUSH_INTERVAL_SECONDS: float = 2
+    
+    # response compression (see core/compression.py and core/story_payloads.py)
+    COMPRESSION_MINIMUM_SIZE: int = 1024
+    COMPRESSION_GZIP_LEVEL: int = 6
+    COMPRESSION_BROTLI_QUALITY: int = 5
+    STORY_PAYLOAD_CACHE_BYTES: int = 32 * 1024 * 1024
+    
+    # node text storage (see core/content_store.py), the level is zstd's, deflate always uses 9
+    CONTENT_COMPRESSION_LEVEL: int = 10
+    CONTENT_DICTIONARY_SIZE: int = 32 * 1024
+    CONTENT_CACHE_ENTRIES: int = 20_000
+    
     
     # .env files don't support python lists (only csv), so we convert that here
     @field_validator("ALLOWED_ORIGINS")
     def parse_allowed_origins(cls, v: str) -> List[str]:
         return v.split(",") if v else []
     
+    @field_validator(
+        "SESSION_RATE_LIMIT_PER_MINUTE", "SESSION_RATE_LIMIT_BURST", "GLOBAL_RATE_LIMIT_PER_MINUTE", "GLOBAL_RATE_LIMIT_BURST"
+    )
+    def check_rate_limit(cls, v: float) -> float:
+        # a rate of 0 would never refill (and divides by zero in the limiter)
+        if v <= 0:
+            raise ValueError("rate limits have to be greater than 0")
+        return v
+    
+    @field_validator("DATABASE_READ_URL", "DATABASE_SHARD_URLS")
+    def parse_database_urls(cls, v: str) -> List[str]:
+        return [url.strip() for url in v.split(",") if url.strip()]
+    
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
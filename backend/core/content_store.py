@@ -0,0 +1,439 @@
+# compressed, content addressed storage of node text
+#
+# storynodes.content used to hold the prose as is. now every distinct text goes into node_contents once, keyed by
+# its sha256 and compressed, and nodes point at it with content_hash. the same text showing up in many stories
+# (pooled or cached stories, stock endings) is stored a single time.
+#
+# - codec: zstd when the zstandard package is installed, raw deflate (zlib) otherwise. node texts are a few hundred
+#   bytes, too short to compress well on their own, so both can use a dictionary trained on our own texts
+#   (python cli.py train-content-dict)
+# - every row records its codec and dictionary ("deflate", "zstd:3" = zstd with dictionary 3, "raw" when
+#   compressing didn't help), so old rows stay readable when the codec or the dictionary changes
+# - reads go through load_node_contents(), one query per batch of nodes, decompressed texts are kept in an LRU
+#
+# nodes from before this still have their text in storynodes.content, python cli.py migrate-content moves them over
+
+import hashlib
+import re
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from typing import Iterable
+
+from sqlalchemy import bindparam, func, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+
+from core.config import settings
+from db.database import shard_of
+from models.story import ContentDictionary, NodeContent, StoryNode
+
+try:
+    import zstandard
+except ImportError: # uv add zstandard for better ratios and faster reads
+    zstandard = None
+
+CHUNK_SIZE = 500 # ids per IN (...) list
+DEFLATE_DICT_SIZE = 32 * 1024 # deflate only ever looks 32KB back, a bigger dictionary is wasted
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _chunks(items: list, size: int = CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class _Codecs:
+    # one per shard, every shard keeps its own dictionaries (and their ids overlap). dictionaries never change once
+    # stored, they're loaded on first use and again whenever a row names one this process hasn't seen yet
+    # (trained since, maybe by another process)
+
+    def __init__(self):
+        self._dictionaries: dict[int, bytes] = {}
+        self._zstd_dictionaries: dict[int, "zstandard.ZstdCompressionDict"] = {}
+        self._current: tuple[int, bytes] | None = None # dictionary new content gets written with
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._local = threading.local() # zstd (de)compressor objects can't be shared between threads
+
+    @property
+    def active(self) -> str:
+        return "zstd" if zstandard else "deflate"
+
+    def load(self, db: Session, dictionary_id: int | None = None):
+        # dictionary_id: reload unless that dictionary is known by now
+        if self._loaded and (dictionary_id is None or dictionary_id in self._dictionaries):
+            return
+
+        with self._lock:
+            # someone else might have loaded it while we waited
+            if self._loaded and (dictionary_id is None or dictionary_id in self._dictionaries):
+                return
+
+            rows = db.execute(select(ContentDictionary.id, ContentDictionary.codec, ContentDictionary.data)).all()
+            self._dictionaries = {row.id: row.data for row in rows}
+            if zstandard:
+                self._zstd_dictionaries = {
+                    row.id: zstandard.ZstdCompressionDict(row.data) for row in rows if row.codec == "zstd"
+                }
+            usable = [row for row in rows if row.codec == self.active]
+            self._current = (usable[-1].id, usable[-1].data) if usable else None
+            self._local = threading.local()
+            self._loaded = True
+
+    def reset(self):
+        with self._lock:
+            self._loaded = False
+
+    def compress(self, data: bytes) -> tuple[str, bytes]:
+        codec = self.active
+        dictionary_id, dictionary = self._current or (None, None)
+
+        if codec == "zstd":
+            body = self._zstd("compressors", dictionary_id).compress(data)
+        else:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -15, **({"zdict": dictionary} if dictionary else {}))
+            body = compressor.compress(data) + compressor.flush()
+
+        if len(body) >= len(data):
+            return "raw", data
+        return (f"{codec}:{dictionary_id}" if dictionary else codec), body
+
+    def decompress(self, codec: str, body: bytes, db: Session | None = None) -> bytes:
+        # db: where to look for a dictionary that isn't loaded yet
+        name, _, dictionary_id = codec.partition(":")
+        dictionary_id = int(dictionary_id) if dictionary_id else None
+
+        if name == "raw":
+            return body
+        if dictionary_id is not None and dictionary_id not in self._dictionaries:
+            if db is not None:
+                self.load(db, dictionary_id)
+            if dictionary_id not in self._dictionaries:
+                # decompressing without it would only give garbage (deflate) or fail, and a cached decompressor
+                # without its dictionary would keep failing after the dictionary shows up
+                raise LookupError(f"content dictionary {dictionary_id} not found")
+
+        if name == "deflate":
+            dictionary = self._dictionaries.get(dictionary_id)
+            decompressor = zlib.decompressobj(-15, **({"zdict": dictionary} if dictionary else {}))
+            return decompressor.decompress(body) + decompressor.flush()
+        if name == "zstd":
+            if zstandard is None:
+                raise RuntimeError("node content was stored with zstd, install it with: uv add zstandard")
+            return self._zstd("decompressors", dictionary_id).decompress(body)
+        raise ValueError(f"unknown content codec {codec}")
+
+    def _zstd(self, kind: str, dictionary_id: int | None):
+        cache = self._local.__dict__.setdefault(kind, {})
+        if dictionary_id not in cache:
+            dict_data = self._zstd_dictionaries.get(dictionary_id)
+            if kind == "compressors":
+                cache[dictionary_id] = zstandard.ZstdCompressor(level=settings.CONTENT_COMPRESSION_LEVEL, dict_data=dict_data)
+            else:
+                cache[dictionary_id] = zstandard.ZstdDecompressor(dict_data=dict_data)
+        return cache[dictionary_id]
+
+
+_codecs: dict[int, _Codecs] = {} # shard -> its codecs
+_codecs_lock = threading.Lock()
+
+
+def codecs_for(db: Session) -> _Codecs:
+    shard = shard_of(db)
+    codecs = _codecs.get(shard)
+    if codecs is None:
+        with _codecs_lock:
+            codecs = _codecs.setdefault(shard, _Codecs())
+    codecs.load(db)
+    return codecs
+
+
+class _TextCache:
+
+    def __init__(self, max_entries: int):
+        self._entries: OrderedDict[str, str] = OrderedDict()
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+
+    def get_many(self, hashes: Iterable[str]) -> dict[str, str]:
+        with self._lock:
+            found = {}
+            for h in hashes:
+                if h in self._entries:
+                    self._entries.move_to_end(h)
+                    found[h] = self._entries[h]
+            return found
+
+    def put_many(self, texts: dict[str, str]):
+        with self._lock:
+            self._entries.update(texts)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+
+text_cache = _TextCache(settings.CONTENT_CACHE_ENTRIES)
+
+
+def _insert_ignore_statement(db: Session):
+    # both databases speak INSERT ... ON CONFLICT DO NOTHING, only the import differs.
+    # two writers storing the same new text at once is fine, the second one just finds it there
+    dialect = postgresql if db.get_bind().dialect.name == "postgresql" else sqlite
+    return dialect.insert(NodeContent).on_conflict_do_nothing(index_elements=[NodeContent.hash])
+
+
+def store_contents(db: Session, texts: Iterable[str]) -> dict[str, str]:
+    # text -> hash, runs in the caller's transaction so the contents commit together with the nodes pointing at them
+    codecs = codecs_for(db)
+    by_hash = {content_hash(text): text for text in texts}
+
+    existing = set()
+    for chunk in _chunks(list(by_hash)):
+        existing.update(db.scalars(select(NodeContent.hash).where(NodeContent.hash.in_(chunk))))
+
+    # texts that are already stored only get touched, that keeps collect_unused_contents away from them
+    # while the nodes pointing at them aren't committed yet
+    for chunk in _chunks(list(existing)):
+        db.execute(update(NodeContent).where(NodeContent.hash.in_(chunk)).values(last_used_at=func.now()))
+
+    rows = []
+    for h, text in by_hash.items():
+        if h in existing:
+            continue
+        data = text.encode()
+        codec, body = codecs.compress(data)
+        rows.append({"hash": h, "codec": codec, "body": body, "size": len(data)})
+
+    if rows:
+        db.execute(_insert_ignore_statement(db), rows)
+
+    text_cache.put_many(by_hash) # whoever stores a story usually reads it right after
+    return {text: h for h, text in by_hash.items()}
+
+
+def load_contents(db: Session, hashes: Iterable[str]) -> dict[str, str]:
+    hashes = set(hashes)
+    texts = text_cache.get_many(hashes)
+    missing = [h for h in hashes if h not in texts]
+    if not missing:
+        return texts
+
+    loaded = _fetch(db, missing)
+    text_cache.put_many(loaded)
+    texts.update(loaded)
+    return texts
+
+
+def _fetch(db: Session, hashes: list[str]) -> dict[str, str]:
+    codecs = codecs_for(db)
+    return {row.hash: codecs.decompress(row.codec, row.body, db).decode() for row in _stored_rows(db, hashes)}
+
+
+def _stored_rows(db: Session, hashes: list[str]):
+    for chunk in _chunks(hashes):
+        yield from db.execute(select(NodeContent.hash, NodeContent.codec, NodeContent.body).where(NodeContent.hash.in_(chunk)))
+
+
+def load_node_contents(db: Session, nodes: list[StoryNode]):
+    # fills node.content in for nodes whose text is in the store, without marking them as changed
+    texts = load_contents(db, [node.content_hash for node in nodes if node.content is None and node.content_hash])
+    for node in nodes:
+        if node.content is None and node.content_hash:
+            set_committed_value(node, "content", texts[node.content_hash])
+
+
+def collect_unused_contents(db: Session, cutoff, batch_size: int) -> int:
+    # contents no node points at anymore and nobody stored or reused since the cutoff
+    deleted = 0
+    while True:
+        unused = db.scalars(
+            select(NodeContent.hash)
+            .where(
+                NodeContent.last_used_at < cutoff,
+                ~select(StoryNode.id).where(StoryNode.content_hash == NodeContent.hash).exists(),
+            )
+            .limit(batch_size)
+        ).all()
+
+        if not unused:
+            break
+
+        db.execute(NodeContent.__table__.delete().where(NodeContent.hash.in_(unused)))
+        db.commit()
+
+        deleted += len(unused)
+        if len(unused) < batch_size:
+            break
+
+    return deleted
+
+
+def migrate_contents(db: Session, batch_size: int = 500) -> int:
+    # moves text still in storynodes.content into the store (python cli.py migrate-content)
+    migrated = 0
+    while True:
+        nodes = db.execute(
+            select(StoryNode.id, StoryNode.content).where(StoryNode.content.is_not(None)).limit(batch_size)
+        ).all()
+        if not nodes:
+            break
+
+        hashes = store_contents(db, [node.content for node in nodes])
+        db.execute(
+            update(StoryNode.__table__)
+            .where(StoryNode.__table__.c.id == bindparam("b_id"))
+            .values(content_hash=bindparam("b_hash"), content=None),
+            [{"b_id": node.id, "b_hash": hashes[node.content]} for node in nodes],
+        )
+        db.commit()
+        migrated += len(nodes)
+
+    return migrated
+
+
+def recompress_contents(db: Session, batch_size: int = 500) -> int:
+    # rewrites stored contents with the current codec and dictionary (after train-content-dict),
+    # the hash is of the text so nothing pointing at a row changes
+    codecs = codecs_for(db)
+    recompressed = 0
+    last_hash = ""
+    while True:
+        rows = db.execute(
+            select(NodeContent.hash, NodeContent.codec, NodeContent.body)
+            .where(NodeContent.hash > last_hash)
+            .order_by(NodeContent.hash)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+
+        updates = []
+        for row in rows:
+            codec, body = codecs.compress(codecs.decompress(row.codec, row.body, db))
+            if codec != row.codec and len(body) < len(row.body):
+                updates.append({"b_hash": row.hash, "b_codec": codec, "b_body": body})
+
+        if updates:
+            db.execute(
+                update(NodeContent.__table__)
+                .where(NodeContent.__table__.c.hash == bindparam("b_hash"))
+                .values(codec=bindparam("b_codec"), body=bindparam("b_body")),
+                updates,
+            )
+        db.commit()
+        recompressed += len(updates)
+        last_hash = rows[-1].hash
+
+    return recompressed
+
+
+def train_dictionary(db: Session, samples: int = 5000) -> int | None:
+    # trains a dictionary for the active codec on a random sample of node texts, returns its id.
+    # content stored from now on uses it, recompress_contents() moves what's already stored over
+    hashes = db.scalars(select(NodeContent.hash).order_by(func.random()).limit(samples)).all()
+    texts = [text.encode() for text in load_contents(db, hashes).values()]
+    texts += [
+        text.encode()
+        for text in db.scalars(select(StoryNode.content).where(StoryNode.content.is_not(None)).limit(max(0, samples - len(texts))))
+    ]
+    if len(texts) < 10:
+        return None
+
+    codecs = codecs_for(db)
+    if codecs.active == "zstd":
+        data = zstandard.train_dictionary(settings.CONTENT_DICTIONARY_SIZE, texts).as_bytes()
+    else:
+        data = _deflate_dictionary(texts)
+
+    dictionary = ContentDictionary(codec=codecs.active, data=data)
+    db.add(dictionary)
+    db.commit()
+    codecs.reset()
+    return dictionary.id
+
+
+def _deflate_dictionary(texts: list[bytes]) -> bytes:
+    # deflate has no trainer, its dictionary is just text it can point back into. the phrases that save the most
+    # (count * length) go in, the best ones last since deflate reaches recent bytes with shorter distances
+    phrases = Counter()
+    for text in texts:
+        words = re.findall(rb"\S+\s*", text)
+        for n in (2, 3, 4):
+            for i in range(len(words) - n + 1):
+                phrases[b"".join(words[i:i + n])] += 1
+
+    picked, size = [], 0
+    for phrase, count in sorted(phrases.items(), key=lambda item: item[1] * len(item[0]), reverse=True):
+        if count < 2 or size + len(phrase) > DEFLATE_DICT_SIZE:
+            continue
+        picked.append(phrase)
+        size += len(phrase)
+
+    return b"".join(reversed(picked))
+
+
+def storage_report(db: Session, sample_stories: int = 200) -> dict:
+    # bytes saved by dedup and compression, and what reading a story's text through the store costs
+    # (one query plus decompressing, cache bypassed) compared to reading the same bytes without decompressing
+    logical = db.execute(
+        select(func.count(StoryNode.id), func.coalesce(func.sum(NodeContent.size), 0))
+        .join(NodeContent, NodeContent.hash == StoryNode.content_hash)
+    ).one()
+    stored = db.execute(
+        select(
+            func.count(NodeContent.hash),
+            func.coalesce(func.sum(NodeContent.size), 0),
+            func.coalesce(func.sum(func.length(NodeContent.body)), 0),
+        )
+    ).one()
+    legacy_bytes = db.scalar(select(func.coalesce(func.sum(func.length(StoryNode.content)), 0)))
+
+    story_ids = db.scalars(
+        select(StoryNode.story_id).where(StoryNode.content_hash.is_not(None)).distinct().order_by(func.random()).limit(sample_stories)
+    ).all()
+    hashes_by_story = {
+        story_id: db.scalars(select(StoryNode.content_hash).where(StoryNode.story_id == story_id)).all()
+        for story_id in story_ids
+    }
+    codecs = codecs_for(db)
+
+    # the baseline is the same query without decompressing, as if the text was still a plain column. one untimed
+    # pass warms the cache for both, then they take turns story by story (and who goes first) so neither is favoured
+    for hashes in hashes_by_story.values():
+        for _ in _stored_rows(db, hashes):
+            pass
+
+    store_seconds = plain_seconds = 0.0
+    nodes_read = 0
+    for i, hashes in enumerate(hashes_by_story.values()):
+        for decompressed in ((True, False) if i % 2 else (False, True)):
+            started = time.perf_counter()
+            if decompressed:
+                nodes_read += len(_fetch(db, hashes))
+                store_seconds += time.perf_counter() - started
+            else:
+                for _ in _stored_rows(db, hashes):
+                    pass
+                plain_seconds += time.perf_counter() - started
+
+    return {
+        "codec": codecs.active,
+        "nodes_in_store": logical[0],
+        "distinct_texts": stored[0],
+        "text_bytes": logical[1], # what storynodes.content would hold
+        "distinct_text_bytes": stored[1], # after dedup
+        "stored_bytes": stored[2], # after dedup and compression
+        "saved_by_dedup": logical[1] - stored[1],
+        "saved_by_compression": stored[1] - stored[2],
+        "ratio": round(logical[1] / stored[2], 2) if stored[2] else None,
+        "legacy_uncompressed_bytes": legacy_bytes,
+        "sampled_stories": len(hashes_by_story),
+        "read_ms_per_story": round(store_seconds / len(hashes_by_story) * 1000, 3) if hashes_by_story else None,
+        "baseline_read_ms_per_story": round(plain_seconds / len(hashes_by_story) * 1000, 3) if hashes_by_story else None,
+        "decompress_overhead_us_per_node": round((store_seconds - plain_seconds) / nodes_read * 1e6, 2) if nodes_read else None,
+    }
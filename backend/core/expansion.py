@@ -0,0 +1,172 @@
+# endless mode: stories that grow while they're played
+#
+# an endless story is generated only 2 levels deep. when a player reaches a leaf that isn't an ending, the generator
+# writes that leaf's options (StoryGenerator.expand_node) with the path so far as context. new nodes hang off the
+# same story_id through the same options structure as everything else.
+#
+# - expansions run on their own FairScheduler, so they don't wait behind whole story generations
+# - the leaf the player is on goes in with PRIORITY_HIGH. once it's expanded (or if it already was), its children
+#   get expanded speculatively with PRIORITY_LOW, so the next step is usually there before it's clicked
+# - node_expansions has a row per leaf, whoever moves it queued -> running runs it, so each leaf is expanded once
+#   no matter how many requests (clicks, polls, prefetches) ask for it
+
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import and_, or_, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from core.config import settings
+from core.llm_guard import LLMUnavailable
+from core.scheduler import FairScheduler, GenerationRequest, PRIORITY_HIGH, PRIORITY_LOW
+from core.story_generator import StoryGenerator
+from core.sql_stats import track
+from db.database import shard_session
+from db.sharding import shard_of_id
+from models.story import NodeExpansion, StoryNode
+
+logger = logging.getLogger(__name__)
+
+# one expansion per pick, they're independent LLM calls
+expansion_scheduler = FairScheduler(batch_size=1)
+
+
+def is_expandable(node: StoryNode) -> bool:
+    return not node.is_ending and not node.options
+
+
+def _stale_before(now: datetime) -> datetime:
+    return now - timedelta(seconds=settings.ENDLESS_EXPANSION_TIMEOUT_SECONDS)
+
+
+def expansion_in_progress(db: Session, node_id: int) -> bool:
+    # whether asking for this leaf again just waits on an expansion that's already queued or running
+    return db.query(NodeExpansion.node_id).filter(
+        NodeExpansion.node_id == node_id,
+        NodeExpansion.status.in_(("queued", "running")),
+        NodeExpansion.updated_at >= _stale_before(datetime.now(timezone.utc)),
+    ).first() is not None
+
+
+def request_expansion(db: Session, node: StoryNode, session_id: str, priority: int = PRIORITY_HIGH) -> NodeExpansion:
+    # queues the expansion of a leaf unless it's already queued or running, commits
+    now = datetime.now(timezone.utc)
+    dialect = postgresql if db.get_bind().dialect.name == "postgresql" else sqlite
+
+    inserted = db.execute(
+        dialect.insert(NodeExpansion)
+        .values(node_id=node.id, story_id=node.story_id, status="queued", priority=priority, updated_at=now)
+        .on_conflict_do_nothing(index_elements=[NodeExpansion.node_id])
+    ).rowcount
+
+    # failed ones get another try, and so do ones whose process died before finishing them
+    stale = _stale_before(now)
+    retried = db.execute(
+        update(NodeExpansion)
+        .where(
+            NodeExpansion.node_id == node.id,
+            or_(
+                NodeExpansion.status == "failed",
+                and_(NodeExpansion.status.in_(("queued", "running")), NodeExpansion.updated_at < stale),
+            ),
+        )
+        .values(status="queued", priority=priority, error=None, updated_at=now)
+    ).rowcount
+
+    # a prefetch the player caught up with jumps the queue
+    promoted = db.execute(
+        update(NodeExpansion)
+        .where(NodeExpansion.node_id == node.id, NodeExpansion.status == "queued", NodeExpansion.priority > priority)
+        .values(priority=priority)
+    ).rowcount
+
+    db.commit()
+
+    if inserted or retried or promoted:
+        expansion_scheduler.submit(GenerationRequest(
+            job_id=f"expand-{node.id}",
+            theme="",
+            session_id=session_id,
+            priority=priority,
+            node_id=node.id,
+        ))
+
+    return db.get(NodeExpansion, node.id, populate_existing=True)
+
+
+def prefetch_children(db: Session, node: StoryNode, session_id: str):
+    # the nodes the player can go to next get expanded ahead of time
+    if not settings.ENDLESS_PREFETCH or not node.options:
+        return
+
+    child_ids = [option.get("node_id") for option in node.options]
+    children = db.query(StoryNode).filter(StoryNode.id.in_(child_ids)).all()
+    for child in children:
+        if is_expandable(child):
+            request_expansion(db, child, session_id, PRIORITY_LOW)
+
+
+def run_expansions(requests: list[GenerationRequest]):
+    # what the expansion scheduler's workers run (started in main.py)
+    for request in requests:
+        with track(f"expansion of node {request.node_id}"):
+            expand_queued_node(request.node_id, request.session_id, request.priority)
+
+
+def _submit_later(node_id: int, session_id: str, priority: int, delay: float):
+    # like defer_requests in routers/story.py. if the process stops first, the row is still queued and the next
+    # request for the leaf queues it again once it's stale
+    timer = threading.Timer(delay, lambda: expansion_scheduler.submit(GenerationRequest(
+        job_id=f"expand-{node_id}", theme="", session_id=session_id, priority=priority, node_id=node_id,
+    )))
+    timer.daemon = True
+    timer.start()
+
+
+def expand_queued_node(node_id: int, session_id: str, priority: int = PRIORITY_LOW):
+    db = shard_session(shard_of_id(node_id)) # the new nodes go in with the story, on its shard
+
+    try:
+        claimed = db.execute(
+            update(NodeExpansion)
+            .where(NodeExpansion.node_id == node_id, NodeExpansion.status == "queued")
+            .values(status="running", updated_at=datetime.now(timezone.utc))
+        ).rowcount
+        db.commit()
+        if not claimed:
+            return
+
+        try:
+            StoryGenerator.expand_node(db, node_id)
+            status, error = "done", None
+        except LLMUnavailable as e:
+            # the LLM was never called, the leaf goes back in the queue for when it might be back
+            db.rollback()
+            db.execute(
+                update(NodeExpansion)
+                .where(NodeExpansion.node_id == node_id, NodeExpansion.status == "running")
+                .values(status="queued", updated_at=datetime.now(timezone.utc))
+            )
+            db.commit()
+            _submit_later(node_id, session_id, priority, e.retry_after)
+            return
+        except Exception as e:
+            db.rollback()
+            logger.exception("expanding node %s failed", node_id)
+            status, error = "failed", str(e)
+
+        db.execute(
+            update(NodeExpansion)
+            .where(NodeExpansion.node_id == node_id)
+            .values(status=status, error=error, updated_at=datetime.now(timezone.utc))
+        )
+        db.commit()
+
+        # the player is on this node, the prefetch of what comes after it can start now
+        if priority == PRIORITY_HIGH and status == "done":
+            prefetch_children(db, db.get(StoryNode, node_id, populate_existing=True), session_id)
+
+    finally:
+        db.close()
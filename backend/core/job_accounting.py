@@ -0,0 +1,244 @@
+# what each story generation costs: tokens, LLM / parse / db time, nodes, memory
+#
+# a generation task runs inside account(), which puts a GenerationUsage in a contextvar. StoryGenerator adds to it as it
+# goes (record_llm_call, parse_timer, record_story), db time and statements come from the task's sql stats unit
+# (core/sql_stats.py). when the task is done save_job_usage writes a job_usage row per job, GET /jobs/usage/stats
+# turns them into percentiles per theme and model.
+#
+# a batched call generates several stories at once, its tokens and times are split evenly over its jobs.
+# peak memory needs tracemalloc, which slows every allocation down, so it's off unless JOB_ACCOUNTING_TRACE_MEMORY
+
+import contextlib
+import logging
+import threading
+import time
+import tracemalloc
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Iterable
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.orm import Session
+
+from core.config import settings
+from core.sql_stats import current_stats
+from models.job import JobUsage, StoryJob
+
+METRICS = (
+    "prompt_tokens", "output_tokens", "llm_seconds", "parse_seconds", "db_seconds", "db_statements",
+    "node_count", "peak_memory_bytes",
+)
+PERCENTILES = (50, 90, 99)
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class GenerationUsage:
+    model: str | None = None
+    llm_calls: int = 0
+    prompt_tokens: int | None = None
+    output_tokens: int | None = None
+    llm_seconds: float = 0.0
+    parse_seconds: float = 0.0
+    db_seconds: float = 0.0
+    db_statements: int = 0
+    peak_memory_bytes: int | None = None
+    nodes: dict[int, int] = field(default_factory=dict) # story id -> node count
+
+
+_current: ContextVar[GenerationUsage | None] = ContextVar("generation_usage", default=None)
+
+
+def record_llm_call(llm, response, elapsed: float):
+    usage = _current.get()
+    if usage is None:
+        return
+
+    usage.llm_calls += 1
+    usage.llm_seconds += elapsed
+    usage.model = (
+        (getattr(response, "response_metadata", None) or {}).get("model_name")
+        or getattr(llm, "model", None)
+        or usage.model
+    )
+
+    metadata = getattr(response, "usage_metadata", None) or {}
+    if "input_tokens" in metadata:
+        usage.prompt_tokens = (usage.prompt_tokens or 0) + metadata["input_tokens"]
+    if "output_tokens" in metadata:
+        usage.output_tokens = (usage.output_tokens or 0) + metadata["output_tokens"]
+
+
+@contextlib.contextmanager
+def parse_timer():
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        usage = _current.get()
+        if usage is not None:
+            usage.parse_seconds += time.perf_counter() - started
+
+
+def record_story(story_id: int, node_count: int):
+    usage = _current.get()
+    if usage is not None:
+        usage.nodes[story_id] = node_count
+
+
+# tracemalloc's peak is process wide. it's only reset when no other job is running, so a job's peak covers
+# everything that ran alongside it: exact with one generation worker, an upper bound with several
+_memory_lock = threading.Lock()
+_memory_jobs = 0
+
+
+def _start_memory():
+    global _memory_jobs
+    with _memory_lock:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if _memory_jobs == 0:
+            tracemalloc.reset_peak()
+        _memory_jobs += 1
+
+
+def _stop_memory() -> int:
+    global _memory_jobs
+    with _memory_lock:
+        _memory_jobs -= 1
+        return tracemalloc.get_traced_memory()[1]
+
+
+@contextlib.contextmanager
+def account():
+    # the task's sql stats unit has to be open already (run_generation_batch does that)
+    usage = GenerationUsage()
+    token = _current.set(usage)
+    stats = current_stats()
+    db_seconds, db_statements = (stats.db_time, stats.statements) if stats else (0.0, 0)
+
+    trace_memory = settings.JOB_ACCOUNTING_TRACE_MEMORY
+    if trace_memory:
+        _start_memory()
+
+    try:
+        yield usage
+    finally:
+        _current.reset(token)
+        if trace_memory:
+            usage.peak_memory_bytes = _stop_memory()
+        if stats:
+            usage.db_seconds = stats.db_time - db_seconds
+            usage.db_statements = stats.statements - db_statements
+
+
+def save_job_usage(db: Session, usage: GenerationUsage, jobs: list[tuple[str, str, int | None, str]]):
+    # jobs: (job id, theme, story id or None, completed / failed / lost), commits.
+    # the jobs are already finished, accounting going wrong is logged and doesn't touch them
+    if not jobs:
+        return
+
+    try:
+        _insert_usage(db, usage, jobs)
+        db.commit()
+    except Exception:
+        db.rollback()
+        logger.exception("saving job usage failed")
+
+
+def _insert_usage(db: Session, usage: GenerationUsage, jobs: list[tuple[str, str, int | None, str]]):
+    share = len(jobs)
+    per_job = lambda value: value // share if value is not None else None # tokens stay whole
+    attempts = dict(db.execute(
+        select(StoryJob.job_id, StoryJob.attempts).where(StoryJob.job_id.in_([job[0] for job in jobs]))
+    ).all())
+
+    db.execute(insert(JobUsage), [
+        {
+            "job_id": job_id,
+            "theme": theme,
+            "model": usage.model,
+            "status": status,
+            "attempt": attempts.get(job_id),
+            "stories_in_call": share,
+            "prompt_tokens": per_job(usage.prompt_tokens),
+            "output_tokens": per_job(usage.output_tokens),
+            "llm_seconds": usage.llm_seconds / share,
+            "parse_seconds": usage.parse_seconds / share,
+            "db_seconds": usage.db_seconds / share,
+            "db_statements": usage.db_statements // share,
+            "node_count": usage.nodes.get(story_id) if story_id is not None else None,
+            "peak_memory_bytes": usage.peak_memory_bytes,
+        }
+        for job_id, theme, story_id, status in jobs
+    ])
+
+
+def _percentile(values: list, percent: int):
+    # nearest rank, values sorted
+    index = max(0, min(len(values) - 1, -(-len(values) * percent // 100) - 1))
+    return values[index]
+
+
+def usage_stats(dbs: Iterable[Session], since_hours: int, max_groups: int) -> dict:
+    # one session per shard. newest rows first, capped so a big window can't load the whole table
+    since = datetime.now(timezone.utc) - timedelta(hours=since_hours)
+    rows = []
+    for db in dbs:
+        rows += db.execute(
+            select(JobUsage.created_at, JobUsage.theme, JobUsage.model, JobUsage.status, *[getattr(JobUsage, name) for name in METRICS])
+            .where(JobUsage.created_at >= since)
+            .order_by(JobUsage.created_at.desc())
+            .limit(settings.JOB_USAGE_STATS_MAX_ROWS)
+        ).all()
+    rows = sorted(rows, key=lambda row: row.created_at, reverse=True)[:settings.JOB_USAGE_STATS_MAX_ROWS]
+
+    # themes are whatever players typed, "Space Pirates " and "space pirates" are the same theme
+    groups: dict[tuple[str, str | None], list] = {}
+    for row in rows:
+        groups.setdefault(((row.theme or "").strip().lower(), row.model), []).append(row)
+
+    result = []
+    for (theme, model), group in sorted(groups.items(), key=lambda item: -len(item[1]))[:max_groups]:
+        metrics = {}
+        for name in METRICS:
+            values = sorted(getattr(row, name) for row in group if getattr(row, name) is not None)
+            if not values:
+                continue
+            metrics[name] = {
+                **{f"p{percent}": _percentile(values, percent) for percent in PERCENTILES},
+                "mean": sum(values) / len(values),
+                "max": values[-1],
+            }
+        result.append({
+            "theme": theme,
+            "model": model,
+            "runs": len(group),
+            "failed": sum(1 for row in group if row.status == "failed"),
+            "lost": sum(1 for row in group if row.status == "lost"),
+            "metrics": metrics,
+        })
+
+    return {
+        "since": since,
+        "runs": len(rows),
+        "truncated": len(rows) == settings.JOB_USAGE_STATS_MAX_ROWS,
+        "groups": result,
+    }
+
+
+def purge_job_usage(db: Session, retention_days: int, batch_size: int) -> int:
+    cutoff = datetime.now(timezone.utc) - timedelta(days=retention_days)
+    purged = 0
+    while True:
+        ids = db.scalars(select(JobUsage.id).where(JobUsage.created_at < cutoff).limit(batch_size)).all()
+        if not ids:
+            break
+        db.execute(delete(JobUsage).where(JobUsage.id.in_(ids)))
+        db.commit()
+        purged += len(ids)
+        if len(ids) < batch_size:
+            break
+    return purged
@@ -0,0 +1,110 @@
+# job status cache in front of GET /jobs/{job_id}
+#
+# clients poll that endpoint until their story is done, and only the generation task (plus the create endpoints and
+# the lease reaper) ever changes a job. so every status change writes the job through to this cache right after its
+# commit, and polls get answered from here without touching the database.
+#
+# in memory by default (per process), JOB_STATUS_CACHE_URL=redis://... shares it between nodes,
+# local:// is the in-process stand-in from core/shared_store.py
+#
+# the memory one only sees writes from its own process, and a job's later status changes usually happen in another
+# worker (whichever one claimed it). so in memory, unfinished statuses only live for a few seconds, otherwise a
+# poll could keep answering "pending" from a stale entry long after the job finished somewhere else
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from core.config import settings
+from core.shared_store import get_redis_client
+from models.job import StoryJob
+from schemas.job import StoryJobResponse
+
+logger = logging.getLogger(__name__)
+
+# what StoryJobResponse needs, for RETURNING clauses so a status update doesn't need another select
+CACHED_COLUMNS = (
+    StoryJob.job_id,
+    StoryJob.status,
+    StoryJob.created_at,
+    StoryJob.story_id,
+    StoryJob.completed_at,
+    StoryJob.error,
+    StoryJob.group_id,
+)
+
+FINISHED_STATUSES = ("completed", "failed")
+
+
+class MemoryJobStatusBackend:
+
+    def __init__(self, max_entries: int):
+        self._entries: OrderedDict[str, tuple[str, float]] = OrderedDict() # key -> (value, expires at)
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key: str, value: str, ex: int):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.monotonic() + ex)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+
+class JobStatusCache:
+
+    def __init__(self, backend, prefix: str = "job:", unfinished_ttl: int | None = None):
+        self.backend = backend
+        self._prefix = prefix
+        self._unfinished_ttl = unfinished_ttl
+
+    def get(self, job_id: str) -> StoryJobResponse | None:
+        try:
+            value = self.backend.get(self._prefix + job_id)
+        except Exception:
+            # the cache being down shouldn't take the endpoint with it, the database still has everything
+            logger.exception("job status cache read failed")
+            return None
+
+        return StoryJobResponse.model_validate_json(value) if value else None
+
+    def put(self, job) -> None:
+        # job is a StoryJob, or a row with the CACHED_COLUMNS
+        response = StoryJobResponse.model_validate(job._mapping if hasattr(job, "_mapping") else job)
+
+        ttl = settings.JOB_STATUS_CACHE_TTL_SECONDS
+        if self._unfinished_ttl is not None and response.status not in FINISHED_STATUSES:
+            ttl = min(ttl, self._unfinished_ttl)
+
+        try:
+            self.backend.set(self._prefix + response.job_id, response.model_dump_json(), ex=ttl)
+        except Exception:
+            logger.exception("job status cache write failed")
+
+    def put_many(self, jobs) -> None:
+        for job in jobs:
+            self.put(job)
+
+
+def _build_cache() -> JobStatusCache:
+    if settings.JOB_STATUS_CACHE_URL:
+        return JobStatusCache(get_redis_client(settings.JOB_STATUS_CACHE_URL))
+    return JobStatusCache(
+        MemoryJobStatusBackend(settings.JOB_STATUS_CACHE_MAX_ENTRIES),
+        unfinished_ttl=settings.JOB_STATUS_CACHE_MEMORY_UNFINISHED_TTL_SECONDS,
+    )
+
+
+job_status_cache = _build_cache()
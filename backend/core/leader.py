@@ -0,0 +1,73 @@
+# which worker runs the once-per-server background work (requeueing pending jobs, the lease reaper, maintenance)
+#
+# python cli.py serve starts several worker processes that each run main.py's lifespan. before starting them
+# core/server.py puts a lock file path in the environment, and the worker holding an flock on it is the leader.
+# a worker that exits or crashes drops the lock, and the next is_leader() call of another worker takes over
+# (and runs the on_elected callbacks, e.g. requeueing the pending jobs the dead worker had queued in memory).
+# without that variable (dev server, tests, uvicorn main:app) every process is its own leader.
+#
+# it only keeps the work from running N times on one host, the work itself is safe to run concurrently
+# (claims and conditional updates), which is what happens with several hosts on one database
+
+import logging
+import os
+import threading
+from typing import Callable
+
+try:
+    import fcntl
+except ImportError: # windows, every process leads
+    fcntl = None
+
+LOCK_FILE_ENV = "STORY_LEADER_LOCK_FILE"
+
+logger = logging.getLogger(__name__)
+
+
+class Leader:
+
+    def __init__(self):
+        self._file = None
+        self._callbacks: list[Callable[[], object]] = []
+        self._lock = threading.Lock()
+
+    def on_elected(self, callback: Callable[[], object]):
+        if callback not in self._callbacks: # the lifespan can run more than once (tests)
+            self._callbacks.append(callback)
+
+    def is_leader(self) -> bool:
+        # blocking callbacks run in the caller's thread, call it through asyncio.to_thread from the event loop
+        with self._lock:
+            if self._file is not None:
+                return True
+
+            path = os.environ.get(LOCK_FILE_ENV)
+            if path and fcntl is not None:
+                file = open(path, "a")
+                try:
+                    fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    file.close()
+                    return False
+                self._file = file
+            else:
+                self._file = True
+
+            logger.info("process %s runs the background jobs", os.getpid())
+
+        for callback in self._callbacks:
+            try:
+                callback()
+            except Exception:
+                logger.exception("leader startup work failed")
+        return True
+
+    def resign(self):
+        # on shutdown, so another worker can take over right away
+        with self._lock:
+            if self._file not in (None, True):
+                self._file.close() # closing drops the flock
+            self._file = None
+
+
+leader = Leader()
@@ -0,0 +1,277 @@
+# job leases, so a job whose process died doesn't stay "processing" forever
+#
+# - claiming a job (pending -> processing) also writes who owns it and until when (JOB_LEASE_SECONDS)
+# - while the generation runs, a heartbeat thread keeps pushing the expiry forward
+# - finishing a job only counts if we still own the lease, and a job's story is only saved (in the same
+#   transaction) while we do, so a job that went to another worker doesn't leave a second story behind
+# - the reaper puts jobs with an expired lease back to pending, or fails them after JOB_MAX_ATTEMPTS claims
+#
+# claim / finish take the session of the job's shard, the rest find it from the job id (db/sharding.py)
+
+import asyncio
+import logging
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from typing import Callable
+
+from sqlalchemy import func, or_, select, update
+from sqlalchemy.orm import Session
+
+from core.config import settings
+from core.leader import leader
+from core.job_cache import job_status_cache, CACHED_COLUMNS
+from core.scheduler import scheduler, GenerationRequest
+from db.database import each_shard_session, shard_session
+from db.sharding import shard_of_key
+from models.job import StoryJob
+from models.story import Story
+
+logger = logging.getLogger(__name__)
+
+_worker_id: tuple[int, str] | None = None
+
+
+def worker_id() -> str:
+    # per process, a preloaded app gets forked so this can't be decided at import time
+    global _worker_id
+    if _worker_id is None or _worker_id[0] != os.getpid():
+        _worker_id = (os.getpid(), f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}")
+    return _worker_id[1]
+
+
+def _lease_expiry() -> datetime:
+    return datetime.now(timezone.utc) + timedelta(seconds=settings.JOB_LEASE_SECONDS)
+
+
+def _by_shard(job_ids: list[str]) -> dict[int, list[str]]:
+    shards: dict[int, list[str]] = {}
+    for job_id in job_ids:
+        shards.setdefault(shard_of_key(job_id), []).append(job_id)
+    return shards
+
+
+def claim_jobs(db: Session, job_ids: list[str]) -> set[str]:
+    # atomic pending -> processing with a lease, returns the job ids this call actually got
+    claimed = db.execute(
+        update(StoryJob)
+        .where(StoryJob.job_id.in_(job_ids), StoryJob.status == "pending")
+        .values(
+            status="processing",
+            lease_owner=worker_id(),
+            lease_expires_at=_lease_expiry(),
+            attempts=func.coalesce(StoryJob.attempts, 0) + 1,
+        )
+        .returning(*CACHED_COLUMNS)
+    ).all()
+    db.commit()
+
+    job_status_cache.put_many(claimed)
+    return {row.job_id for row in claimed}
+
+
+def finish_job(db: Session, job_id: str, story_id: int | None = None, error: str | None = None) -> bool:
+    # False means the lease expired and the job went to someone else (or back to pending), our result is dropped
+    finished = db.execute(
+        update(StoryJob)
+        .where(StoryJob.job_id == job_id, StoryJob.status == "processing", StoryJob.lease_owner == worker_id())
+        .values(
+            status="failed" if error is not None else "completed",
+            story_id=story_id,
+            error=error,
+            completed_at=datetime.now(),
+            lease_owner=None,
+            lease_expires_at=None,
+        )
+        .returning(*CACHED_COLUMNS)
+    ).first()
+    if finished is not None and story_id is not None:
+        # the story was delivered, purging the job later doesn't make it an orphan
+        db.execute(update(Story).where(Story.id == story_id).values(completed_at=datetime.now(timezone.utc)))
+    db.commit()
+
+    if finished is None:
+        logger.warning("lost the lease on job %s before it finished", job_id)
+        return False
+
+    job_status_cache.put(finished)
+    return True
+
+
+def complete_job(db: Session, job_id: str, save: Callable[[], Story]) -> Story | None:
+    # marks the job completed and saves its story (save()) in the caller's transaction, the caller commits and
+    # then calls cache_jobs(). the update holds the job's row (the write lock on sqlite) until the commit, so the
+    # reaper can't hand the job out in between. None: the lease is gone and nothing got saved
+    owned = db.execute(
+        update(StoryJob)
+        .where(StoryJob.job_id == job_id, StoryJob.status == "processing", StoryJob.lease_owner == worker_id())
+        .values(
+            status="completed",
+            error=None,
+            completed_at=datetime.now(),
+            lease_owner=None,
+            lease_expires_at=None,
+        )
+    ).rowcount
+    if not owned:
+        logger.warning("lost the lease on job %s before it finished, its story is dropped", job_id)
+        return None
+
+    story = save()
+    story.completed_at = datetime.now(timezone.utc)
+    db.execute(update(StoryJob).where(StoryJob.job_id == job_id).values(story_id=story.id))
+    return story
+
+
+def cache_jobs(db: Session, job_ids: list[str]):
+    # after complete_job's commit
+    if job_ids:
+        job_status_cache.put_many(db.execute(select(*CACHED_COLUMNS).where(StoryJob.job_id.in_(job_ids))).all())
+
+
+def release_jobs(job_ids: list[str]):
+    # jobs this process claimed but isn't working on (deferred while the LLM is unavailable) go back to pending.
+    # not for jobs that are still running, another process would generate them a second time.
+    # it isn't the job's fault, so the attempt doesn't count
+    for shard, shard_job_ids in _by_shard(job_ids).items():
+        db = shard_session(shard)
+        try:
+            released = db.execute(
+                update(StoryJob)
+                .where(
+                    StoryJob.job_id.in_(shard_job_ids),
+                    StoryJob.status == "processing",
+                    StoryJob.lease_owner == worker_id(),
+                )
+                .values(
+                    status="pending",
+                    lease_owner=None,
+                    lease_expires_at=None,
+                    attempts=func.coalesce(StoryJob.attempts, 1) - 1,
+                )
+                .returning(*CACHED_COLUMNS)
+            ).all()
+            db.commit()
+            job_status_cache.put_many(released)
+        finally:
+            db.close()
+
+
+class Heartbeat:
+    # keeps the lease on the given jobs alive for as long as the with block runs
+
+    _active: set["Heartbeat"] = set()
+    _active_lock = threading.Lock()
+
+    def __init__(self, job_ids: list[str]):
+        self.job_ids = job_ids
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="job-heartbeat", daemon=True)
+
+    def __enter__(self):
+        with Heartbeat._active_lock:
+            Heartbeat._active.add(self)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        with Heartbeat._active_lock:
+            Heartbeat._active.discard(self)
+        self._stop.set()
+        self._thread.join()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(settings.JOB_HEARTBEAT_SECONDS):
+            for shard, job_ids in _by_shard(self.job_ids).items():
+                db = shard_session(shard)
+                try:
+                    db.execute(
+                        update(StoryJob)
+                        .where(
+                            StoryJob.job_id.in_(job_ids),
+                            StoryJob.status == "processing",
+                            StoryJob.lease_owner == worker_id(),
+                        )
+                        .values(lease_expires_at=_lease_expiry())
+                    )
+                    db.commit()
+                except Exception:
+                    # a missed beat isn't fatal, the lease is several beats long
+                    logger.exception("heartbeat for jobs %s failed", job_ids)
+                finally:
+                    db.close()
+
+
+def stop_heartbeats():
+    # for a drain that timed out: the jobs still running here keep their lease until it runs out, then the reaper
+    # (in whichever process) hands them out again. if they finish before that, their result still counts
+    with Heartbeat._active_lock:
+        heartbeats = list(Heartbeat._active)
+    for heartbeat in heartbeats:
+        heartbeat.stop()
+
+
+def reap_expired_leases(db: Session) -> tuple[int, int]:
+    # returns (requeued, failed). processing jobs without any lease are from before leases existed
+    now = datetime.now(timezone.utc)
+    expired = (
+        StoryJob.status == "processing",
+        or_(StoryJob.lease_expires_at < now, StoryJob.lease_expires_at.is_(None)),
+    )
+    attempts = func.coalesce(StoryJob.attempts, 0)
+
+    failed = db.execute(
+        update(StoryJob)
+        .where(*expired, attempts >= settings.JOB_MAX_ATTEMPTS)
+        .values(
+            status="failed",
+            error=f"Story generation was interrupted {settings.JOB_MAX_ATTEMPTS} times, giving up.",
+            completed_at=datetime.now(),
+            lease_owner=None,
+            lease_expires_at=None,
+        )
+        .returning(*CACHED_COLUMNS)
+    ).all()
+
+    requeued = db.execute(
+        update(StoryJob)
+        .where(*expired, attempts < settings.JOB_MAX_ATTEMPTS)
+        .values(status="pending", lease_owner=None, lease_expires_at=None)
+        .returning(*CACHED_COLUMNS, StoryJob.theme, StoryJob.session_id, StoryJob.endless)
+    ).all()
+    db.commit()
+
+    job_status_cache.put_many(failed)
+    job_status_cache.put_many(requeued)
+    for row in requeued:
+        scheduler.submit(GenerationRequest(
+            job_id=row.job_id, theme=row.theme, session_id=row.session_id, endless=bool(row.endless)
+        ))
+
+    if requeued or failed:
+        logger.info("reaped expired job leases: %s requeued, %s failed", len(requeued), len(failed))
+    return len(requeued), len(failed)
+
+
+def _reap():
+    # every shard has its own jobs to look after
+    for db in each_shard_session():
+        reap_expired_leases(db)
+
+
+async def reaper_loop(interval_seconds: float):
+    # started from main.py in every worker, only the leader reaps (core/leader.py)
+    while True:
+        await asyncio.sleep(interval_seconds)
+
+        try:
+            if await asyncio.to_thread(leader.is_leader):
+                await asyncio.to_thread(_reap)
+        except Exception:
+            logger.exception("reaping expired job leases failed")
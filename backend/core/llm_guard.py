@@ -0,0 +1,202 @@
+# concurrency limit and circuit breaker around every LLM call (StoryGenerator._invoke_llm)
+#
+# when gemini slows down or starts failing, every queued job would still fire its call and sit out the whole timeout,
+# which only piles more load on it. so:
+# - at most LLM_MAX_CONCURRENCY calls are in flight per process, the rest wait for a slot (the waiting count is the
+#   queue depth gauge in GET /jobs/scheduler/stats). waiting longer than LLM_QUEUE_TIMEOUT_SECONDS gives up
+# - the breaker keeps the outcomes of the last LLM_BREAKER_WINDOW_SECONDS. errors, timeouts and calls slower than
+#   LLM_BREAKER_SLOW_CALL_SECONDS are failures, once enough calls failed it opens and calls fail right away
+# - after LLM_BREAKER_COOLDOWN_SECONDS it goes half open and lets one probe call through, the probe succeeding
+#   closes it again, failing reopens it
+#
+# whoever gets LLMUnavailable hasn't used the LLM at all, the generation jobs get deferred (routers/story.py)
+# and the create endpoints turn new jobs away with a 503 while the breaker is open
+
+import contextlib
+import threading
+import time
+from collections import deque
+
+from core.config import settings
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+HALF_OPEN_RETRY_SECONDS = 2 # how long the others wait while a probe is out
+
+
+class LLMUnavailable(Exception):
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(f"{reason}, retry in {retry_after:.0f}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class ConcurrencyLimiter:
+
+    def __init__(self, max_concurrency: int, queue_timeout: float):
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._waiting = 0
+        self._max_waiting = 0
+
+    def acquire(self):
+        deadline = time.monotonic() + self.queue_timeout
+        with self._cond:
+            self._waiting += 1
+            self._max_waiting = max(self._max_waiting, self._waiting)
+            try:
+                while self._in_flight >= self.max_concurrency:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise LLMUnavailable("too many LLM calls waiting", self.queue_timeout)
+                    self._cond.wait(remaining)
+                self._in_flight += 1
+            finally:
+                self._waiting -= 1
+
+    def release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "max_concurrency": self.max_concurrency,
+                "in_flight": self._in_flight,
+                "waiting": self._waiting,
+                "max_waiting": self._max_waiting,
+            }
+
+
+class CircuitBreaker:
+
+    def __init__(self, window_seconds: float, min_calls: int, failure_rate: float, cooldown_seconds: float):
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.cooldown_seconds = cooldown_seconds
+        self._outcomes: deque[tuple[float, bool]] = deque() # (time, failed)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self) -> bool:
+        # raises LLMUnavailable if the call can't go out, returns whether it's the half open probe
+        with self._lock:
+            retry_after = self._retry_after()
+            if retry_after:
+                raise LLMUnavailable(f"LLM circuit breaker {self._state}", retry_after)
+            if self._state == HALF_OPEN:
+                self._probing = True
+                return True
+            return False
+
+    def record(self, failed: bool, probe: bool):
+        with self._lock:
+            now = time.monotonic()
+            if probe:
+                self._probing = False
+                if failed:
+                    self._open(now)
+                else:
+                    self._state = CLOSED
+                    self._outcomes.clear()
+                return
+
+            if self._state != CLOSED:
+                return # went out before the breaker opened, it already counted what it needed to
+
+            self._outcomes.append((now, failed))
+            self._trim(now)
+            if len(self._outcomes) >= self.min_calls:
+                failures = sum(1 for _, outcome in self._outcomes if outcome)
+                if failures / len(self._outcomes) >= self.failure_rate:
+                    self._open(now)
+
+    def retry_after(self) -> float:
+        with self._lock:
+            return self._retry_after()
+
+    def _retry_after(self) -> float:
+        if self._state == OPEN:
+            remaining = self._opened_at + self.cooldown_seconds - time.monotonic()
+            if remaining > 0:
+                return remaining
+            self._state = HALF_OPEN
+        if self._state == HALF_OPEN and self._probing:
+            return HALF_OPEN_RETRY_SECONDS
+        return 0
+
+    def _open(self, now: float):
+        self._state = OPEN
+        self._opened_at = now
+        self._outcomes.clear()
+
+    def _trim(self, now: float):
+        cutoff = now - self.window_seconds
+        while self._outcomes and self._outcomes[0][0] < cutoff:
+            self._outcomes.popleft()
+
+    def stats(self) -> dict:
+        with self._lock:
+            retry_after = self._retry_after()
+            self._trim(time.monotonic())
+            failures = sum(1 for _, outcome in self._outcomes if outcome)
+            return {
+                "state": self._state,
+                "retry_after_seconds": round(retry_after, 1),
+                "window_calls": len(self._outcomes),
+                "window_failures": failures,
+            }
+
+
+class LLMGuard:
+
+    def __init__(self, limiter: ConcurrencyLimiter, breaker: CircuitBreaker, slow_call_seconds: float):
+        self.limiter = limiter
+        self.breaker = breaker
+        self.slow_call_seconds = slow_call_seconds
+
+    @contextlib.contextmanager
+    def slot(self):
+        # wrap exactly the LLM call, parsing the response afterwards isn't the LLM's fault.
+        # the breaker is checked once the slot is there, so calls that queued up before it opened don't go out either
+        self.limiter.acquire()
+        try:
+            probe = self.breaker.before_call()
+            started = time.monotonic()
+            try:
+                yield
+            except Exception:
+                self.breaker.record(True, probe)
+                raise
+            else:
+                self.breaker.record(time.monotonic() - started > self.slow_call_seconds, probe)
+        finally:
+            self.limiter.release()
+
+    def retry_after(self) -> float:
+        # 0 when calls can go out, otherwise how long until they might
+        return self.breaker.retry_after()
+
+    def stats(self) -> dict:
+        return {**self.limiter.stats(), "breaker": self.breaker.stats()}
+
+
+llm_guard = LLMGuard(
+    ConcurrencyLimiter(settings.LLM_MAX_CONCURRENCY, settings.LLM_QUEUE_TIMEOUT_SECONDS),
+    CircuitBreaker(
+        settings.LLM_BREAKER_WINDOW_SECONDS,
+        settings.LLM_BREAKER_MIN_CALLS,
+        settings.LLM_BREAKER_FAILURE_RATE,
+        settings.LLM_BREAKER_COOLDOWN_SECONDS,
+    ),
+    settings.LLM_BREAKER_SLOW_CALL_SECONDS,
+)
@@ -0,0 +1,207 @@
+# housekeeping for the tables that grow forever: story_jobs, stories and storynodes
+#
+# - finished jobs older than the retention window get deleted (or moved to story_jobs_archive first)
+# - stories whose generation never finished and that nobody reads, and nodes whose story is gone, get garbage
+#   collected, then node texts in the content store that no node points at anymore
+# - the database gets compacted and its planner statistics refreshed
+#
+# everything works in bounded batches of ids with one commit per batch, so a big cleanup
+# never holds a lock for long or builds a huge transaction. with shards (db/sharding.py) each one gets cleaned
+# on its own, a story and its job are always on the same shard
+
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import delete, exists, insert, or_, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from core.config import settings
+from core.leader import leader
+from core.search import remove_stories
+from core.content_store import collect_unused_contents
+from core.job_accounting import purge_job_usage
+from db.database import shard_engines, shard_session
+from models.job import StoryJob, StoryJobArchive
+from models.playthrough import PlaythroughProgress
+from models.story import NodeExpansion, Story, StoryEdge, StoryNode, StoryPayload
+
+logger = logging.getLogger(__name__)
+
+
+def _cutoff(days: int = 0, minutes: int = 0) -> datetime:
+    return datetime.now(timezone.utc) - timedelta(days=days, minutes=minutes)
+
+
+def purge_jobs(
+    db: Session,
+    retention_days: int | None = None,
+    failed_retention_days: int | None = None,
+    archive: bool | None = None,
+    batch_size: int | None = None,
+) -> int:
+    retention_days = settings.JOB_RETENTION_DAYS if retention_days is None else retention_days
+    failed_retention_days = settings.FAILED_JOB_RETENTION_DAYS if failed_retention_days is None else failed_retention_days
+    archive = settings.ARCHIVE_JOBS if archive is None else archive
+    batch_size = batch_size or settings.MAINTENANCE_BATCH_SIZE
+    
+    # the archive gets its own ids, sqlite can hand out a deleted job id again
+    archived_columns = [column.name for column in StoryJob.__table__.columns if column.name != "id"]
+    
+    purged = 0
+    # only finished jobs, pending/processing ones are still being worked on
+    for status, days in (("completed", retention_days), ("failed", failed_retention_days)):
+        cutoff = _cutoff(days=days)
+        
+        while True:
+            # (status, created_at) index
+            job_ids = db.scalars(
+                select(StoryJob.id)
+                .where(StoryJob.status == status, StoryJob.created_at < cutoff)
+                .limit(batch_size)
+            ).all()
+            
+            if not job_ids:
+                break
+            
+            if archive:
+                db.execute(
+                    insert(StoryJobArchive).from_select(
+                        archived_columns,
+                        select(*[StoryJob.__table__.c[name] for name in archived_columns]).where(StoryJob.id.in_(job_ids)),
+                    )
+                )
+            db.execute(delete(StoryJob).where(StoryJob.id.in_(job_ids)))
+            db.commit()
+            
+            purged += len(job_ids)
+            if len(job_ids) < batch_size:
+                break
+    
+    return purged
+
+
+def _delete_stories(db: Session, story_ids: list[int]):
+    # everything that hangs off a story has to go before the story itself
+    remove_stories(db, story_ids)
+    db.execute(delete(PlaythroughProgress).where(PlaythroughProgress.story_id.in_(story_ids)))
+    db.execute(delete(StoryPayload).where(StoryPayload.story_id.in_(story_ids)))
+    db.execute(delete(NodeExpansion).where(NodeExpansion.story_id.in_(story_ids)))
+    db.execute(delete(StoryEdge).where(StoryEdge.story_id.in_(story_ids)))
+    db.execute(delete(StoryNode).where(StoryNode.story_id.in_(story_ids)))
+    db.execute(delete(Story).where(Story.id.in_(story_ids)))
+
+
+def collect_orphans(db: Session, grace_minutes: int | None = None, batch_size: int | None = None) -> tuple[int, int]:
+    grace_minutes = settings.ORPHAN_GRACE_MINUTES if grace_minutes is None else grace_minutes
+    batch_size = batch_size or settings.MAINTENANCE_BATCH_SIZE
+    
+    # the grace period keeps us away from stories that are still being generated,
+    # the story row gets flushed before its job is pointed at it
+    cutoff = _cutoff(minutes=grace_minutes)
+    
+    # stories from a generation that never finished (failed, or the worker died or lost its lease after saving):
+    # no completed_at, no job or archived job pointing at them, and nobody has played or read them.
+    # a finished story is never collected, whatever happens to its job
+    orphaned = (
+        Story.created_at < cutoff,
+        Story.completed_at.is_(None),
+        ~exists().where(StoryJob.story_id == Story.id, StoryJob.status != "failed"),
+        ~exists().where(StoryJobArchive.story_id == Story.id),
+        ~exists().where(PlaythroughProgress.story_id == Story.id),
+        ~exists().where(StoryPayload.story_id == Story.id), # a payload gets built on the first read
+    )
+    
+    deleted_stories = 0
+    while True:
+        story_ids = db.scalars(select(Story.id).where(*orphaned).limit(batch_size)).all()
+        
+        if not story_ids:
+            break
+        
+        _delete_stories(db, story_ids)
+        db.commit()
+        
+        deleted_stories += len(story_ids)
+        if len(story_ids) < batch_size:
+            break
+    
+    # nodes whose story doesn't exist anymore
+    deleted_nodes = 0
+    while True:
+        node_ids = db.scalars(
+            select(StoryNode.id)
+            .where(~exists().where(Story.id == StoryNode.story_id))
+            .limit(batch_size)
+        ).all()
+        
+        if not node_ids:
+            break
+        
+        db.execute(delete(NodeExpansion).where(NodeExpansion.node_id.in_(node_ids)))
+        db.execute(delete(StoryEdge).where(or_(StoryEdge.from_node_id.in_(node_ids), StoryEdge.to_node_id.in_(node_ids))))
+        db.execute(delete(StoryNode).where(StoryNode.id.in_(node_ids)))
+        db.commit()
+        
+        deleted_nodes += len(node_ids)
+        if len(node_ids) < batch_size:
+            break
+    
+    return deleted_stories, deleted_nodes
+
+
+def compact_database(engine: Engine | None = None):
+    # every shard unless one is given. VACUUM can't run inside a transaction on either database
+    for db_engine in [engine] if engine is not None else shard_engines:
+        with db_engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            if db_engine.dialect.name == "sqlite":
+                conn.execute(text("VACUUM"))
+                conn.execute(text("ANALYZE"))
+            elif db_engine.dialect.name == "postgresql":
+                for table in (StoryJob.__table__, Story.__table__, StoryNode.__table__):
+                    conn.execute(text(f"VACUUM (ANALYZE) {table.name}"))
+            else:
+                conn.execute(text("ANALYZE"))
+
+
+def run_maintenance(archive: bool | None = None, compact: bool = True) -> dict:
+    summary = dict.fromkeys(
+        ("purged_jobs", "deleted_stories", "deleted_nodes", "deleted_contents", "purged_job_usage"), 0
+    )
+    
+    for shard in range(len(shard_engines)):
+        db = shard_session(shard)
+        try:
+            purged_jobs = purge_jobs(db, archive=archive)
+            deleted_stories, deleted_nodes = collect_orphans(db)
+            deleted_contents = collect_unused_contents(
+                db, _cutoff(minutes=settings.ORPHAN_GRACE_MINUTES), settings.MAINTENANCE_BATCH_SIZE
+            )
+            purged_usage = purge_job_usage(db, settings.JOB_USAGE_RETENTION_DAYS, settings.MAINTENANCE_BATCH_SIZE)
+        finally:
+            db.close()
+        
+        summary["purged_jobs"] += purged_jobs
+        summary["deleted_stories"] += deleted_stories
+        summary["deleted_nodes"] += deleted_nodes
+        summary["deleted_contents"] += deleted_contents
+        summary["purged_job_usage"] += purged_usage
+    
+    if compact:
+        compact_database()
+    
+    logger.info("maintenance finished: %s", summary)
+    return summary
+
+
+async def maintenance_loop(interval_minutes: int):
+    # started from main.py when MAINTENANCE_INTERVAL_MINUTES > 0, in every worker but only the leader runs it
+    while True:
+        await asyncio.sleep(interval_minutes * 60)
+        
+        try:
+            if await asyncio.to_thread(leader.is_leader):
+                await asyncio.to_thread(run_maintenance)
+        except Exception:
+            logger.exception("scheduled maintenance failed")
@@ -1,10 +1,12 @@
-from typing import List, Dict, Any, Optional
+from typing import List, Optional
 from pydantic import BaseModel, Field
 
 
 class StoryOptionLLM(BaseModel):
     text: str = Field(description="the text of the option shown to the user")
-    nextNode: Dict[str, Any] = Field(description="the next node content and its options")
+    # recursive reference so the whole tree gets validated in one go when the response is parsed,
+    # instead of only the first level (the rest used to come back as plain dicts)
+    nextNode: "StoryNodeLLM" = Field(description="the next node content and its options")
     
 class StoryNodeLLM(BaseModel):
     content: str = Field(description="the main content of the story node")
@@ -14,4 +16,18 @@ class StoryNodeLLM(BaseModel):
     
 class StoryLLMResponse(BaseModel):
     title: str = Field(description="the title of the story")
-    rootNode: StoryNodeLLM = Field(description="the root node of the story")
\ No newline at end of file
+    rootNode: StoryNodeLLM = Field(description="the root node of the story")
+
+
+# StoryOptionLLM points forward to StoryNodeLLM, so it has to be rebuilt once both classes exist
+StoryOptionLLM.model_rebuild()
+
+
+# endless mode: the options that continue the story from the node the player reached
+class StoryExpansionLLM(BaseModel):
+    options: List[StoryOptionLLM] = Field(description="the options for the current node, each with the node it leads to")
+
+
+# several stories in one LLM call, in the same order as the themes that were asked for
+class StoryBatchLLMResponse(BaseModel):
+    stories: List[StoryLLMResponse] = Field(description="one story per requested theme, in the same order")
@@ -0,0 +1,197 @@
+# write-behind buffer for playthrough progress
+#
+# every choice a player makes would be a write, so instead choices land in memory and a background thread
+# upserts them into playthrough_progress in one statement, either every PLAYTHROUGH_FLUSH_INTERVAL_SECONDS
+# or as soon as PLAYTHROUGH_FLUSH_SIZE players have something pending.
+# several clicks by the same player between two flushes collapse into a single row update
+#
+# reads check the buffer first, so a player always sees their own latest choice. that includes a batch that's
+# being written (in flight) until its commit, so reads never fall in the gap between the buffer and the table.
+# progress lives on the story's shard, a flush writes one statement per shard. when that fails the rows get
+# written one by one, a row that can never go in (its story was deleted) is dropped instead of blocking the rest
+
+import logging
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import DataError, IntegrityError
+
+from core.config import settings
+from db.database import shard_session
+from db.sharding import shard_of_id
+from models.playthrough import PlaythroughProgress
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PendingProgress:
+    current_node_id: int
+    choices_made: int # choices since the last flush, added on top of what's stored
+    updated_at: datetime
+
+
+class PlaythroughBuffer:
+
+    def __init__(self):
+        self._pending: dict[tuple[str, int], PendingProgress] = {}
+        self._in_flight: dict[tuple[str, int], PendingProgress] = {} # taken by flush(), not committed yet
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="playthrough-flusher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping = True
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.flush() # whatever came in while stopping
+
+    def record(self, session_id: str, story_id: int, node_id: int) -> PendingProgress:
+        with self._lock:
+            key = (session_id, story_id)
+            pending = self._pending.get(key)
+            
+            if pending:
+                pending.current_node_id = node_id
+                pending.choices_made += 1
+                pending.updated_at = datetime.now(timezone.utc)
+            else:
+                pending = self._pending[key] = PendingProgress(node_id, 1, datetime.now(timezone.utc))
+            
+            if len(self._pending) >= settings.PLAYTHROUGH_FLUSH_SIZE:
+                self._wake.set()
+            
+            return PendingProgress(pending.current_node_id, pending.choices_made, pending.updated_at)
+
+    def get(self, session_id: str, story_id: int) -> PendingProgress | None:
+        with self._lock:
+            pending = self._pending.get((session_id, story_id))
+            in_flight = self._in_flight.get((session_id, story_id))
+            
+            if not pending and not in_flight:
+                return None
+            latest = pending or in_flight
+            return PendingProgress(
+                latest.current_node_id,
+                (pending.choices_made if pending else 0) + (in_flight.choices_made if in_flight else 0),
+                latest.updated_at
+            )
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(settings.PLAYTHROUGH_FLUSH_INTERVAL_SECONDS)
+            self._wake.clear()
+            
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("flushing playthrough progress failed, will retry")
+
+    def flush(self) -> int:
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            self._in_flight.update(batch)
+        
+        if not batch:
+            return 0
+        
+        by_shard: dict[int, dict[tuple[str, int], PendingProgress]] = {}
+        for key, pending in batch.items():
+            by_shard.setdefault(shard_of_id(key[1]), {})[key] = pending
+        
+        flushed, error = 0, None
+        for shard, shard_batch in by_shard.items():
+            db = shard_session(shard)
+            try:
+                db.execute(_upsert_statement(db), _rows(shard_batch)) # one executemany for the whole batch
+                db.commit()
+                flushed += len(shard_batch)
+                self._done(shard_batch)
+            except Exception:
+                db.rollback()
+                # find the rows that broke it, the other shards still get their rows either way
+                written, row_error = self._flush_rows(db, shard_batch)
+                flushed += written
+                error = error or row_error
+            finally:
+                db.close()
+        
+        if error:
+            raise error
+        return flushed
+
+    def _flush_rows(self, db, batch: dict[tuple[str, int], PendingProgress]) -> tuple[int, Exception | None]:
+        written, error = 0, None
+        for key, pending in batch.items():
+            try:
+                db.execute(_upsert_statement(db), _rows({key: pending}))
+                db.commit()
+                written += 1
+                self._done({key: pending})
+            except (IntegrityError, DataError) as e:
+                # retrying won't help (the story is gone), dropped so it doesn't block every later flush
+                db.rollback()
+                logger.warning("dropping playthrough progress of story %s: %s", key[1], e.orig)
+                self._done({key: pending})
+            except Exception as e:
+                db.rollback()
+                self._requeue({key: pending})
+                error = e
+        return written, error
+
+    def _done(self, batch: dict[tuple[str, int], PendingProgress]):
+        with self._lock:
+            for key in batch:
+                self._in_flight.pop(key, None)
+
+    def _requeue(self, batch: dict[tuple[str, int], PendingProgress]):
+        # put a failed batch back without losing choices that came in since
+        with self._lock:
+            for key, failed in batch.items():
+                self._in_flight.pop(key, None)
+                newer = self._pending.get(key)
+                if newer:
+                    newer.choices_made += failed.choices_made
+                else:
+                    self._pending[key] = failed
+
+
+def _rows(batch: dict[tuple[str, int], PendingProgress]) -> list[dict]:
+    return [
+        {
+            "session_id": session_id,
+            "story_id": story_id,
+            "current_node_id": pending.current_node_id,
+            "choices_made": pending.choices_made,
+            "updated_at": pending.updated_at,
+        }
+        for (session_id, story_id), pending in batch.items()
+    ]
+
+
+def _upsert_statement(db):
+    # both databases speak INSERT ... ON CONFLICT DO UPDATE, only the import differs
+    dialect = postgresql if db.get_bind().dialect.name == "postgresql" else sqlite
+    
+    stmt = dialect.insert(PlaythroughProgress)
+    return stmt.on_conflict_do_update(
+        index_elements=[PlaythroughProgress.session_id, PlaythroughProgress.story_id],
+        set_={
+            "current_node_id": stmt.excluded.current_node_id,
+            "choices_made": PlaythroughProgress.choices_made + stmt.excluded.choices_made,
+            "updated_at": stmt.excluded.updated_at,
+        },
+    )
+
+
+playthrough_buffer = PlaythroughBuffer()
@@ -45,4 +45,74 @@ json_structure = """
                 ]
             }
         }
-        """
\ No newline at end of file
+        """
+
+# same story rules as STORY_PROMPT, but for several themes in one request so the instructions
+# and the format are only sent once (see StoryGenerator.generate_stories)
+STORY_BATCH_PROMPT = """
+                You are a creative story writer that creates engaging choose-your-own-adventure stories.
+                You will get a numbered list of themes. Generate one complete branching story for each theme,
+                with multiple paths and endings, in the JSON format I'll specify.
+
+                Every story should have:
+                1. A compelling title
+                2. A starting situation (root node) with 2-3 options
+                3. Each option should lead to another node with its own options
+                4. Some paths should lead to endings (both winning and losing)
+                5. At least one path should lead to a winning ending
+
+                Story structure requirements:
+                - Each node should have 2-3 options except for ending nodes
+                - Each story should be 3-4 levels deep (including root node)
+                - Add variety in the path lengths (some end earlier, some later)
+                - Make sure there's at least one winning path in every story
+
+                The "stories" list must contain exactly one story per theme, in the same order as the themes.
+                Stories are independent from each other, don't mix characters or settings between them.
+
+                Output your stories in this exact JSON structure:
+                {format_instructions}
+
+                Don't simplify or omit any part of the story structure. 
+                Don't add any text outside of the JSON structure.
+                """
+
+
+# endless mode (see core/expansion.py): the story starts shallow and every leaf gets continued once a player gets near it
+ENDLESS_STORY_PROMPT = """
+                You are a creative story writer that creates engaging choose-your-own-adventure stories.
+                Generate the beginning of an endless branching story in the JSON format I'll specify.
+                The story will be continued later from wherever the player goes, so only write the first steps.
+
+                The story should have:
+                1. A compelling title
+                2. A starting situation (root node) with 2-3 options
+                3. Each option leads to another node
+
+                Story structure requirements:
+                - The story should be exactly 2 levels deep: the root node and the nodes its options lead to
+                - Nodes on the second level that aren't endings have an empty options list, they get continued later
+                - At most one node on the second level can be an ending
+
+                Output your story in this exact JSON structure:
+                {format_instructions}
+
+                Don't add any text outside of the JSON structure.
+                """
+
+EXPAND_NODE_PROMPT = """
+                You are a creative story writer continuing an ongoing choose-your-own-adventure story.
+                You will get the story's title and the path the player took so far, ending with the scene they are in now.
+                Write the options the player has in the current scene and what each one leads to.
+
+                Requirements:
+                - 2-3 options for the current scene, each leading to a new node
+                - Keep the characters, the setting and the tone consistent with the path so far
+                - New nodes that aren't endings have an empty options list, they get continued later
+                - Endings (winning or losing) are allowed, the longer the path the more an ending fits
+
+                Output the options in this exact JSON structure:
+                {format_instructions}
+
+                Don't add any text outside of the JSON structure.
+                """
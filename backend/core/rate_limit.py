@@ -0,0 +1,231 @@
+# admission control for story generation
+#
+# every story costs a full LLM generation, so before a job gets queued we check:
+# 1. the backlog (pending + processing jobs) isn't over MAX_JOB_BACKLOG, otherwise we shed load
+# 2. the client still has tokens in its bucket (its session, or its address when it sends no session cookie)
+# 3. the whole service still has tokens in the global bucket
+#
+# endless expansions (an LLM call each) go through the same checks, plus a bucket per story: any session can play
+# and expand any endless story, so without it many sessions together could grow one story as fast as the LLM goes
+#
+# the buckets live in memory by default, RATE_LIMIT_BACKEND_URL=redis://... moves them to redis
+# so every node shares the same limits
+
+import math
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select
+
+from core.config import settings
+from core.shared_store import get_redis_client
+from db.database import each_shard_session
+from models.job import StoryJob
+
+
+@dataclass
+class AdmissionDecision:
+    allowed: bool
+    retry_after: int = 0
+    reason: str = ""
+
+
+class MemoryRateLimitBackend:
+
+    def __init__(self, max_keys: int = 100_000):
+        self._buckets: dict[str, tuple[float, float]] = {} # key -> (tokens, last refill time)
+        self._lock = threading.Lock()
+        self._max_keys = max_keys
+
+    def acquire(self, key: str, rate: float, capacity: float, cost: float = 1) -> tuple[bool, float]:
+        # returns (allowed, seconds until enough tokens are available)
+        now = time.monotonic()
+
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * rate)
+
+            if tokens >= cost:
+                self._buckets[key] = (tokens - cost, now)
+                allowed, retry_after = True, 0.0
+            else:
+                self._buckets[key] = (tokens, now)
+                allowed, retry_after = False, (cost - tokens) / rate
+
+            if len(self._buckets) > self._max_keys:
+                self._prune(now)
+
+        return allowed, retry_after
+
+    def refund(self, key: str, capacity: float, cost: float):
+        # gives back tokens taken by an acquire() whose request didn't go through after all
+        with self._lock:
+            if key in self._buckets:
+                tokens, updated_at = self._buckets[key]
+                self._buckets[key] = (min(capacity, tokens + cost), updated_at)
+
+    def _prune(self, now: float):
+        # a bucket that has been idle long enough to refill completely is the same as no bucket at all,
+        # the slowest configured rate decides how long that takes
+        idle_after = max(
+            settings.SESSION_RATE_LIMIT_BURST / _per_second(settings.SESSION_RATE_LIMIT_PER_MINUTE),
+            settings.GLOBAL_RATE_LIMIT_BURST / _per_second(settings.GLOBAL_RATE_LIMIT_PER_MINUTE),
+        )
+        self._buckets = {
+            key: state for key, state in self._buckets.items() if now - state[1] < idle_after
+        }
+
+
+class RedisRateLimitBackend:
+
+    # refill + take has to be atomic across nodes, so it runs inside redis,
+    # TIME comes from the redis server so clock skew between nodes doesn't matter
+    SCRIPT = """
+        local rate = tonumber(ARGV[1])
+        local capacity = tonumber(ARGV[2])
+        local cost = tonumber(ARGV[3])
+        local clock = redis.call('TIME')
+        local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+        local tokens = tonumber(state[1]) or capacity
+        local ts = tonumber(state[2]) or now
+        tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+        local allowed = 0
+        local retry_after = 0
+        if tokens >= cost then
+            tokens = tokens - cost
+            allowed = 1
+        else
+            retry_after = (cost - tokens) / rate
+        end
+
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+        return {allowed, tostring(retry_after)}
+    """
+
+    REFUND_SCRIPT = """
+        local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+        if tokens then
+            redis.call('HSET', KEYS[1], 'tokens', tostring(math.min(tonumber(ARGV[1]), tokens + tonumber(ARGV[2]))))
+        end
+        return 0
+    """
+
+    def __init__(self, client, prefix: str = "ratelimit:"):
+        self._client = client
+        self._prefix = prefix
+        self._script = client.register_script(self.SCRIPT)
+        self._refund_script = client.register_script(self.REFUND_SCRIPT)
+
+    def acquire(self, key: str, rate: float, capacity: float, cost: float = 1) -> tuple[bool, float]:
+        allowed, retry_after = self._script(keys=[self._prefix + key], args=[rate, capacity, cost])
+        return bool(int(allowed)), float(retry_after)
+
+    def refund(self, key: str, capacity: float, cost: float):
+        self._refund_script(keys=[self._prefix + key], args=[capacity, cost])
+
+
+def _per_second(per_minute: float) -> float:
+    return per_minute / 60
+
+
+class AdmissionController:
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._backlog_cache: tuple[float, int, float] | None = None # (checked at, backlog, jobs finished per second)
+        self._lock = threading.Lock()
+
+    def admit(self, client_key: str, cost: int = 1) -> AdmissionDecision:
+        # client_key: "session:<id>" or "client:<address>", see client_rate_key in routers/story.py
+        backlog, throughput = self._backlog_stats()
+
+        if backlog + cost > settings.MAX_JOB_BACKLOG:
+            # how long until the queue drains back under the threshold at the rate we've been finishing jobs
+            excess = backlog + cost - settings.MAX_JOB_BACKLOG
+            retry_after = excess / throughput if throughput > 0 else settings.RETRY_AFTER_MAX_SECONDS
+            return AdmissionDecision(False, self._clamp(retry_after), "Too many stories are being generated right now.")
+
+        # client first, so one noisy client burns its own tokens and not the global ones
+        allowed, retry_after = self.backend.acquire(
+            client_key,
+            _per_second(settings.SESSION_RATE_LIMIT_PER_MINUTE),
+            settings.SESSION_RATE_LIMIT_BURST,
+            cost,
+        )
+        if not allowed:
+            return AdmissionDecision(False, self._clamp(retry_after), "You are creating stories too quickly.")
+
+        allowed, retry_after = self.backend.acquire(
+            "global",
+            _per_second(settings.GLOBAL_RATE_LIMIT_PER_MINUTE),
+            settings.GLOBAL_RATE_LIMIT_BURST,
+            cost,
+        )
+        if not allowed:
+            # the request doesn't go through, so it shouldn't cost the client anything either
+            self.backend.refund(client_key, settings.SESSION_RATE_LIMIT_BURST, cost)
+            return AdmissionDecision(False, self._clamp(retry_after), "Too many stories are being created right now.")
+
+        return AdmissionDecision(True)
+
+    def admit_expansion(self, client_key: str, story_id: int) -> AdmissionDecision:
+        decision = self.admit(client_key)
+        if not decision.allowed:
+            return decision
+
+        allowed, retry_after = self.backend.acquire(
+            f"story:{story_id}",
+            _per_second(settings.ENDLESS_STORY_EXPANSIONS_PER_MINUTE),
+            settings.ENDLESS_STORY_EXPANSION_BURST,
+        )
+        if not allowed:
+            self.backend.refund(client_key, settings.SESSION_RATE_LIMIT_BURST, 1)
+            self.backend.refund("global", settings.GLOBAL_RATE_LIMIT_BURST, 1)
+            return AdmissionDecision(False, self._clamp(retry_after), "This story is growing too quickly.")
+
+        return decision
+
+    def _backlog_stats(self) -> tuple[int, float]:
+        # two count queries per create would add up under load, so they're cached for a few seconds
+        now = time.monotonic()
+        with self._lock:
+            if self._backlog_cache and now - self._backlog_cache[0] < settings.BACKLOG_STATS_TTL_SECONDS:
+                return self._backlog_cache[1], self._backlog_cache[2]
+
+        # every shard's jobs go to the same LLM, so the backlog is the sum over all of them.
+        # completed_at is written with datetime.now() by the generation task, so compare against the same clock
+        window = timedelta(minutes=5)
+        backlog, finished = 0, 0
+        for db in each_shard_session():
+            backlog += db.scalar(
+                select(func.count()).select_from(StoryJob).where(StoryJob.status.in_(("pending", "processing")))
+            )
+            finished += db.scalar(
+                select(func.count()).select_from(StoryJob).where(
+                    StoryJob.status.in_(("completed", "failed")),
+                    StoryJob.completed_at >= datetime.now() - window,
+                )
+            )
+        throughput = finished / window.total_seconds()
+
+        with self._lock:
+            self._backlog_cache = (now, backlog, throughput)
+        return backlog, throughput
+
+    def _clamp(self, retry_after: float) -> int:
+        return max(1, min(settings.RETRY_AFTER_MAX_SECONDS, math.ceil(retry_after)))
+
+
+def _build_backend():
+    if settings.RATE_LIMIT_BACKEND_URL:
+        return RedisRateLimitBackend(get_redis_client(settings.RATE_LIMIT_BACKEND_URL))
+    return MemoryRateLimitBackend()
+
+
+admission = AdmissionController(_build_backend())
@@ -0,0 +1,249 @@
+# scheduler that sits in front of generate_story_task
+#
+# jobs used to run in arrival order, so one session queuing lots of stories made everyone else wait
+# behind it. now every session gets its own queue and the workers pick between sessions with
+# weighted fair queuing (start-time fair queuing):
+#
+# - every queued job gets a virtual finish tag = max(virtual clock, session's last finish tag) + 1 / weight
+# - workers always run the job with the smallest finish tag, so sessions take turns
+#   no matter how many jobs each one queued
+# - priority classes are strict, a lower class only runs when no higher class has runnable work
+# - a session never has more than MAX_JOBS_PER_SESSION jobs running at once
+#
+# a worker can also take up to GENERATION_BATCH_SIZE jobs at once (in the same fair order) and hand them to the
+# handler together, so they go out as a single LLM call. if fewer are queued it waits up to
+# GENERATION_BATCH_WINDOW_SECONDS for more to show up
+
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Callable
+
+from core.config import settings
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+@dataclass
+class GenerationRequest:
+    job_id: str
+    theme: str
+    session_id: str
+    priority: int = PRIORITY_NORMAL
+    weight: float = 1.0
+    enqueued_at: float = field(default_factory=time.monotonic)
+    finish_tag: float = 0.0
+    endless: bool = False
+    node_id: int | None = None # set for endless mode expansions (see core/expansion.py)
+
+
+@dataclass
+class SessionWaitStats:
+    jobs: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+
+class FairScheduler:
+
+    def __init__(self, batch_size: int | None = None):
+        self.batch_size = batch_size # defaults to GENERATION_BATCH_SIZE
+        self._cond = threading.Condition()
+        # priority -> session_id -> queued requests (in arrival order)
+        self._queues: dict[int, dict[str, deque[GenerationRequest]]] = {}
+        self._virtual_time: dict[int, float] = {}
+        self._last_finish: dict[tuple[int, str], float] = {}
+        self._running: dict[str, int] = {}
+        self._in_flight: dict[str, GenerationRequest] = {} # job_id -> request, handed to the handler and not done yet
+        self._wait_stats: OrderedDict[str, SessionWaitStats] = OrderedDict()
+        self._workers: list[threading.Thread] = []
+        self._handler: Callable[[list[GenerationRequest]], None] | None = None
+        self._stopping = False
+
+    def start(self, handler: Callable[[list[GenerationRequest]], None], workers: int | None = None):
+        self._handler = handler
+        self._stopping = False
+
+        for i in range(workers or settings.GENERATION_WORKERS):
+            worker = threading.Thread(target=self._work, name=f"story-generator-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self, timeout: float | None = None) -> list[str]:
+        # graceful drain: nothing new gets picked up, running jobs get until the timeout to finish.
+        # returns the job ids that were still running, what's left in the queues stays pending in the database
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for worker in self._workers:
+            worker.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        self._workers = []
+
+        with self._cond:
+            return list(self._in_flight)
+
+    def submit(self, request: GenerationRequest):
+        with self._cond:
+            key = (request.priority, request.session_id)
+            start_tag = max(self._virtual_time.get(request.priority, 0.0), self._last_finish.get(key, 0.0))
+            request.finish_tag = start_tag + 1 / request.weight
+            self._last_finish[key] = request.finish_tag
+
+            if len(self._last_finish) > 10_000:
+                # tags the virtual clock already passed make no difference anymore (max() above ignores them)
+                self._last_finish = {
+                    k: tag for k, tag in self._last_finish.items() if tag > self._virtual_time.get(k[0], 0.0)
+                }
+
+            sessions = self._queues.setdefault(request.priority, {})
+            sessions.setdefault(request.session_id, deque()).append(request)
+            self._cond.notify()
+
+    def _pick(self) -> GenerationRequest | None:
+        # called with the lock held
+        for priority in sorted(self._queues):
+            sessions = self._queues[priority]
+
+            best_session = None
+            for session_id, queue in sessions.items():
+                if self._running.get(session_id, 0) >= settings.MAX_JOBS_PER_SESSION:
+                    continue
+                if best_session is None or queue[0].finish_tag < sessions[best_session][0].finish_tag:
+                    best_session = session_id
+
+            if best_session is None:
+                continue
+
+            queue = sessions[best_session]
+            request = queue.popleft()
+            if not queue:
+                del sessions[best_session]
+
+            self._virtual_time[priority] = request.finish_tag - 1 / request.weight
+            self._running[best_session] = self._running.get(best_session, 0) + 1
+            return request
+
+        return None
+
+    def _pick_batch(self) -> list[GenerationRequest]:
+        # called with the lock held
+        batch = []
+        deadline = time.monotonic() + settings.GENERATION_BATCH_WINDOW_SECONDS
+
+        while len(batch) < (self.batch_size or settings.GENERATION_BATCH_SIZE):
+            request = self._pick()
+            if request is not None:
+                batch.append(request)
+                continue
+
+            remaining = deadline - time.monotonic()
+            if not batch or remaining <= 0 or self._stopping:
+                break
+            self._cond.wait(remaining)
+
+        return batch
+
+    def _work(self):
+        while True:
+            with self._cond:
+                batch = []
+                while not batch and not self._stopping:
+                    batch = self._pick_batch()
+                    if not batch:
+                        self._cond.wait()
+
+                if self._stopping:
+                    # picked while a stop came in, put it back untouched
+                    self._requeue(batch)
+                    return
+
+                now = time.monotonic()
+                for request in batch:
+                    self._record_wait(request.session_id, now - request.enqueued_at)
+                    self._in_flight[request.job_id] = request
+
+            try:
+                self._handler(batch)
+            except Exception:
+                logger.exception("story generation for jobs %s crashed", [request.job_id for request in batch])
+            finally:
+                with self._cond:
+                    for request in batch:
+                        self._in_flight.pop(request.job_id, None)
+                        self._running[request.session_id] -= 1
+                        if not self._running[request.session_id]:
+                            del self._running[request.session_id]
+                    # slots for these sessions opened up, someone might be waiting on them
+                    self._cond.notify_all()
+
+    def _requeue(self, batch: list[GenerationRequest]):
+        # called with the lock held, undoes _pick for requests that never reached the handler
+        for request in reversed(batch):
+            self._queues.setdefault(request.priority, {}).setdefault(request.session_id, deque()).appendleft(request)
+            self._running[request.session_id] -= 1
+            if not self._running[request.session_id]:
+                del self._running[request.session_id]
+
+    def _record_wait(self, session_id: str, wait: float):
+        stats = self._wait_stats.pop(session_id, None) or SessionWaitStats()
+        stats.jobs += 1
+        stats.total_wait += wait
+        stats.max_wait = max(stats.max_wait, wait)
+
+        # most recently active sessions last, the oldest get dropped so this can't grow forever
+        self._wait_stats[session_id] = stats
+        while len(self._wait_stats) > 10_000:
+            self._wait_stats.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._cond:
+            queued = {
+                session_id: len(queue)
+                for sessions in self._queues.values()
+                for session_id, queue in sessions.items()
+            }
+            average_waits = [s.total_wait / s.jobs for s in self._wait_stats.values()]
+
+            sessions = [
+                {
+                    # session ids are what the cookie holds, so only a hash of them goes out
+                    "session": hashlib.sha256(session_id.encode()).hexdigest()[:12],
+                    "jobs": stats.jobs,
+                    "avg_wait_seconds": round(stats.total_wait / stats.jobs, 3),
+                    "max_wait_seconds": round(stats.max_wait, 3),
+                    "queued": queued.get(session_id, 0),
+                    "running": self._running.get(session_id, 0),
+                }
+                for session_id, stats in self._wait_stats.items()
+            ]
+
+            return {
+                "workers": len(self._workers),
+                "queued": sum(queued.values()),
+                "running": sum(self._running.values()),
+                # jain's fairness index over the average wait per session, 1.0 means everyone waited the same
+                "wait_fairness": _jain_index(average_waits),
+                "sessions": sessions,
+            }
+
+
+def _jain_index(values: list[float]) -> float | None:
+    if not values:
+        return None
+
+    squares = sum(v * v for v in values)
+    if squares == 0:
+        return 1.0
+    return round(sum(values) ** 2 / (len(values) * squares), 4)
+
+
+scheduler = FairScheduler()
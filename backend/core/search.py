@@ -0,0 +1,203 @@
+# full-text search over story titles and node content
+#
+# - sqlite: an FTS5 virtual table (story_search), one row per story keyed by rowid = story id, holding the title and
+#   the content of all its nodes. FTS5 only has an index on the rowid, so that's what every delete and update goes by
+# - postgres: a story_search table with a tsvector per title/node and a GIN index on it
+#
+# rows get added in the same transaction the generator saves the story in, so search never scans storynodes
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from core.content_store import load_contents, load_node_contents
+from models.story import Story, StoryNode
+
+SEARCH_CONFIG = "english" # postgres text search configuration
+
+
+def _is_postgres(bind) -> bool:
+    return bind.dialect.name == "postgresql"
+
+
+def ensure_search_index(engine: Engine) -> bool:
+    # True when the sqlite index was just (re)created and has to be filled (rebuild_search_index)
+    with engine.begin() as conn:
+        if _is_postgres(engine):
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS story_search (
+                    id SERIAL PRIMARY KEY,
+                    story_id INTEGER NOT NULL,
+                    node_id INTEGER,
+                    document TSVECTOR NOT NULL
+                )
+            """))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_story_search_document ON story_search USING GIN (document)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_story_search_story_id ON story_search (story_id)"))
+            return False
+
+        # the layout before one row per story had a row per node, with story_id as an unindexed column
+        existing = conn.execute(text("SELECT sql FROM sqlite_master WHERE name = 'story_search'")).scalar()
+        if existing and "node_id" not in existing:
+            return False
+        if existing:
+            conn.execute(text("DROP TABLE story_search"))
+        conn.execute(text("CREATE VIRTUAL TABLE story_search USING fts5(title, content)"))
+        return True
+
+
+def index_story(db: Session, story: Story, nodes: list[StoryNode]):
+    # postgres: the title row, then one executemany for every node, nodes need their ids (flushed) at this point
+    if _is_postgres(db.get_bind()):
+        db.execute(text(f"""
+            INSERT INTO story_search (story_id, node_id, document)
+            VALUES (:story_id, NULL, setweight(to_tsvector('{SEARCH_CONFIG}', :text), 'A'))
+        """), {"story_id": story.id, "text": story.title})
+        index_nodes(db, story.id, nodes)
+        return
+    
+    db.execute(
+        text("INSERT INTO story_search (rowid, title, content) VALUES (:story_id, :title, :content)"),
+        {"story_id": story.id, "title": story.title, "content": _joined(nodes)},
+    )
+
+
+def _joined(nodes: list[StoryNode]) -> str:
+    return "\n".join(node.content for node in nodes if node.content)
+
+
+def index_nodes(db: Session, story_id: int, nodes: list[StoryNode]):
+    # nodes added to a story that's already indexed (endless mode)
+    if not nodes:
+        return
+    
+    if _is_postgres(db.get_bind()):
+        db.execute(text(f"""
+            INSERT INTO story_search (story_id, node_id, document)
+            VALUES (:story_id, :node_id, setweight(to_tsvector('{SEARCH_CONFIG}', :text), 'D'))
+        """), [{"story_id": story_id, "node_id": node.id, "text": node.content} for node in nodes])
+    else:
+        # the story's row gets the new text appended, a story that was never indexed (imported with --no-index)
+        # has no row and stays out until reindex-search
+        db.execute(
+            text("UPDATE story_search SET content = content || :content WHERE rowid = :story_id"),
+            {"story_id": story_id, "content": "\n" + _joined(nodes)},
+        )
+
+
+def _key_column(db: Session) -> str:
+    return "story_id" if _is_postgres(db.get_bind()) else "rowid"
+
+
+def remove_stories(db: Session, story_ids: list[int]):
+    if not story_ids:
+        return
+
+    db.execute(
+        text(f"DELETE FROM story_search WHERE {_key_column(db)} IN :story_ids").bindparams(
+            bindparam("story_ids", expanding=True)
+        ),
+        {"story_ids": list(story_ids)},
+    )
+
+
+def _remove_story_range(db: Session, after_id: int, up_to_id: int | None):
+    # every row of the stories with after_id < id <= up_to_id, a range on the key instead of a scan
+    key = _key_column(db)
+    if up_to_id is None:
+        db.execute(text(f"DELETE FROM story_search WHERE {key} > :after_id"), {"after_id": after_id})
+    else:
+        db.execute(
+            text(f"DELETE FROM story_search WHERE {key} > :after_id AND {key} <= :up_to_id"),
+            {"after_id": after_id, "up_to_id": up_to_id},
+        )
+
+
+def search_stories(db: Session, query: str, limit: int = 20) -> list[dict]:
+    # best match per story: {"story_id", "title", "snippet", "rank"}, higher rank is better
+    if _is_postgres(db.get_bind()):
+        rows = db.execute(text(f"""
+            WITH matches AS (
+                SELECT story_id, node_id, ts_rank(document, q) AS rank,
+                       ROW_NUMBER() OVER (PARTITION BY story_id ORDER BY ts_rank(document, q) DESC) AS position
+                FROM story_search, websearch_to_tsquery('{SEARCH_CONFIG}', :query) AS q
+                WHERE document @@ q
+            )
+            SELECT m.story_id, s.title, m.rank, n.content, n.content_hash
+            FROM matches m
+            JOIN stories s ON s.id = m.story_id
+            LEFT JOIN storynodes n ON n.id = m.node_id
+            WHERE m.position = 1
+            ORDER BY m.rank DESC
+            LIMIT :limit
+        """), {"query": query, "limit": limit}).mappings().all()
+        
+        # node text is compressed in the content store, so the snippets get built from the texts after loading them
+        stored = load_contents(db, [row["content_hash"] for row in rows if row["content"] is None and row["content_hash"]])
+        texts = [row["content"] or stored.get(row["content_hash"]) or row["title"] for row in rows]
+        snippets = db.execute(text(f"""
+            SELECT ts_headline('{SEARCH_CONFIG}', t, websearch_to_tsquery('{SEARCH_CONFIG}', :query),
+                               'StartSel=[, StopSel=], MaxFragments=1, MaxWords=20')
+            FROM unnest(CAST(:texts AS text[])) WITH ORDINALITY AS u(t, i)
+            ORDER BY i
+        """), {"query": query, "texts": texts}).scalars().all() if rows else []
+        
+        return [
+            {"story_id": row["story_id"], "title": row["title"], "rank": row["rank"], "snippet": snippet}
+            for row, snippet in zip(rows, snippets)
+        ]
+    
+    match = _fts5_query(query)
+    if not match:
+        return []
+
+    # a row per story, so the best rows are the best stories.
+    # bm25 is "lower is better", it gets flipped so both databases rank the same way
+    rows = db.execute(text("""
+        SELECT story_search.rowid AS story_id, stories.title AS title, -bm25(story_search) AS rank,
+               snippet(story_search, -1, '[', ']', '...', 20) AS snippet
+        FROM story_search
+        JOIN stories ON stories.id = story_search.rowid
+        WHERE story_search MATCH :match
+        ORDER BY bm25(story_search)
+        LIMIT :limit
+    """), {"match": match, "limit": limit}).mappings().all()
+
+    return [dict(row) for row in rows]
+
+
+def _fts5_query(query: str) -> str:
+    # every word becomes a quoted phrase (implicit AND), so user input can't break the FTS5 query syntax
+    return " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+
+def rebuild_search_index(db: Session, batch_size: int = 200) -> int:
+    # backfill for stories generated before the index existed (python cli.py reindex-search).
+    # each batch of stories gets its rows swapped in one transaction, so search keeps working during a rebuild
+    indexed = 0
+    last_id = 0
+    while True:
+        stories = db.query(Story).filter(Story.id > last_id).order_by(Story.id).limit(batch_size).all()
+        if not stories:
+            break
+
+        nodes_by_story: dict[int, list[StoryNode]] = {story.id: [] for story in stories}
+        nodes = db.query(StoryNode).filter(StoryNode.story_id.in_(list(nodes_by_story))).all()
+        load_node_contents(db, nodes)
+        for node in nodes:
+            nodes_by_story[node.story_id].append(node)
+
+        # the stories in this id range that are gone lose their rows too
+        _remove_story_range(db, last_id, stories[-1].id)
+        for story in stories:
+            index_story(db, story, nodes_by_story[story.id])
+        indexed += len(stories)
+        last_id = stories[-1].id
+
+        db.commit()
+        db.expunge_all() # keep memory flat across batches
+
+    _remove_story_range(db, last_id, None)
+    db.commit()
+
+    return indexed
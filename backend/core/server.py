@@ -0,0 +1,105 @@
+# production entry point (python cli.py serve), main.py's __main__ is only the reload dev server
+#
+# - with gunicorn installed: gunicorn master + uvicorn workers, the app gets imported once in the master
+#   (PRELOAD_APP) and forked, so workers start fast and share the imported code
+# - without it: uvicorn's own multi-process supervisor, which imports the app in every worker
+#
+# both use uvloop + httptools, and on SIGTERM stop accepting connections, let in-flight requests finish
+# and then run the lifespan shutdown, which drains the generation scheduler (see main.py)
+#
+# the migrations (create_tables) already ran once in this process, python cli.py does that before any command,
+# the workers don't run them. every worker starts main.py's lifespan, the once-per-server loops only run in
+# the one holding the lock file set up here (core/leader.py)
+
+import logging
+import multiprocessing
+import os
+import tempfile
+
+import uvicorn
+
+from core.config import settings
+from core.leader import LOCK_FILE_ENV
+
+logger = logging.getLogger(__name__)
+
+try:
+    from gunicorn.app.base import BaseApplication
+    from uvicorn.workers import UvicornWorker
+except ImportError: # uv add gunicorn for the preloading master
+    BaseApplication = None
+
+APP = "main:app"
+
+
+def worker_count() -> int:
+    return settings.WEB_CONCURRENCY or multiprocessing.cpu_count()
+
+
+if BaseApplication is not None:
+    
+    class StoryWorker(UvicornWorker):
+        CONFIG_KWARGS = {
+            "loop": "uvloop",
+            "http": "httptools",
+            "timeout_graceful_shutdown": settings.GRACEFUL_TIMEOUT_SECONDS,
+        }
+    
+    class StoryApplication(BaseApplication):
+        
+        def load_config(self):
+            options = {
+                "bind": f"{settings.HOST}:{settings.PORT}",
+                "workers": worker_count(),
+                "worker_class": "core.server.StoryWorker",
+                "preload_app": settings.PRELOAD_APP,
+                "keepalive": settings.KEEP_ALIVE_SECONDS,
+                # requests and then the generation drain each get GRACEFUL_TIMEOUT_SECONDS before the kill
+                "graceful_timeout": settings.GRACEFUL_TIMEOUT_SECONDS * 2 + 5,
+                "post_fork": _post_fork,
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+        
+        def load(self):
+            from main import app
+            return app
+
+
+def _post_fork(server, worker):
+    # connections opened in the master while preloading can't be shared with the forked workers
+    from db.database import read_engines, shard_engines
+    for db_engine in [*shard_engines, *read_engines]:
+        db_engine.dispose(close=False)
+
+
+def serve():
+    # per server, inherited by the workers (forked by gunicorn, spawned by uvicorn)
+    lock_file = os.path.join(tempfile.gettempdir(), f"story-leader-{os.getpid()}.lock")
+    os.environ[LOCK_FILE_ENV] = lock_file
+    
+    try:
+        _run()
+    finally:
+        if os.path.exists(lock_file):
+            os.remove(lock_file)
+
+
+def _run():
+    if BaseApplication is not None:
+        StoryApplication().run()
+        return
+    
+    if settings.PRELOAD_APP:
+        logger.warning("PRELOAD_APP needs gunicorn (uv add gunicorn), uvicorn imports the app in every worker")
+    
+    uvicorn.run(
+        APP,
+        host=settings.HOST,
+        port=settings.PORT,
+        workers=worker_count(),
+        loop="uvloop",
+        http="httptools",
+        timeout_keep_alive=settings.KEEP_ALIVE_SECONDS,
+        timeout_graceful_shutdown=settings.GRACEFUL_TIMEOUT_SECONDS,
+    )
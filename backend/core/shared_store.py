@@ -0,0 +1,62 @@
+# connection to the shared store (redis) used when state has to be seen by every node,
+# redis is an optional dependency so it only gets imported when one of these urls is configured
+#
+# local:// gives a LocalRedis instead, an in-process stand-in with the same interface for the commands we use.
+# it's for running the shared-store code paths on a laptop or in tests without a redis server, nothing is shared
+
+import threading
+import time
+
+
+class LocalRedis:
+
+    def __init__(self):
+        self._data: dict[str, tuple[str, float | None]] = {} # key -> (value, expires at)
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] <= time.monotonic():
+                del self._data[key]
+                return None
+            return entry[0]
+
+    def set(self, key: str, value, ex: int | None = None) -> bool:
+        with self._lock:
+            self._data[key] = (str(value), time.monotonic() + ex if ex else None)
+            # expired keys are only dropped when read, so sweep now and then
+            if len(self._data) % 1000 == 0:
+                self._sweep()
+        return True
+
+    def delete(self, *keys: str) -> int:
+        with self._lock:
+            return sum(self._data.pop(key, None) is not None for key in keys)
+
+    def register_script(self, script: str):
+        raise RuntimeError("local:// can't run lua scripts, use a real redis:// url for this")
+
+    def _sweep(self):
+        now = time.monotonic()
+        self._data = {
+            key: entry for key, entry in self._data.items() if entry[1] is None or entry[1] > now
+        }
+
+
+_local_stores: dict[str, LocalRedis] = {}
+
+
+def get_redis_client(url: str):
+    if url.startswith("local://"):
+        # same url, same store, like two clients of one redis server
+        return _local_stores.setdefault(url, LocalRedis())
+
+    try:
+        import redis
+    except ImportError as e:
+        raise RuntimeError(f"{url} needs the redis package, install it with: uv add redis") from e
+
+    return redis.Redis.from_url(url, decode_responses=True)
@@ -0,0 +1,151 @@
+# sql instrumentation: statement counts and db time per request / background job, slow query log, N+1 detection
+#
+# engine events (instrument_engine, called for every engine in db/database.py) time each statement and add it to the
+# unit of work that's running: a request (SqlStatsMiddleware) or a job (track() in the generation and expansion tasks).
+# the unit lives in a contextvar, sync endpoints run in the threadpool with a copy of the context so they still see it
+#
+# - a statement slower than SQL_SLOW_QUERY_MS is logged with its parameters reduced to their types and lengths,
+#   player text and session ids don't end up in the logs
+# - the same statement shape running SQL_REPEATED_STATEMENT_THRESHOLD times or more in one unit gets logged as a
+#   likely N+1 (a query per row in a loop, or a flush per node like _process_story_node does)
+# - with DEBUG on, responses carry a Server-Timing header with the request's statement count and db time
+
+import contextlib
+import logging
+import re
+import time
+from collections import Counter
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SqlStats:
+    name: str
+    statements: int = 0
+    db_time: float = 0.0 # seconds
+    shapes: Counter = field(default_factory=Counter)
+
+    def add(self, statement: str, elapsed: float, executemany: bool):
+        self.statements += 1
+        self.db_time += elapsed
+        if not executemany: # one executemany is one round of work, not a loop
+            self.shapes[statement_shape(statement)] += 1
+
+    def repeated(self) -> list[tuple[str, int]]:
+        return [
+            (shape, count)
+            for shape, count in self.shapes.most_common()
+            if count >= settings.SQL_REPEATED_STATEMENT_THRESHOLD
+        ]
+
+    def server_timing(self) -> str:
+        return f'db;dur={self.db_time * 1000:.1f};desc="{self.statements} queries"'
+
+
+_current: ContextVar[SqlStats | None] = ContextVar("sql_stats", default=None)
+
+# IN lists expand to one placeholder per value, they're the same statement however many values there are
+_PLACEHOLDER = re.compile(r"%\([^)]*\)s|\$\d+|:\w+|\?")
+_PLACEHOLDER_LIST = re.compile(r"\?(?:\s*,\s*\?)+")
+
+
+def statement_shape(statement: str) -> str:
+    return _PLACEHOLDER_LIST.sub("?", _PLACEHOLDER.sub("?", " ".join(statement.split())))
+
+
+def _redact_value(value):
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, (str, bytes)):
+        return f"<{type(value).__name__} {len(value)}>"
+    return f"<{type(value).__name__}>"
+
+
+def redact_parameters(parameters, executemany: bool = False):
+    if executemany:
+        parameters = list(parameters)
+        return {"parameter_sets": len(parameters), "first": redact_parameters(parameters[0]) if parameters else None}
+    if isinstance(parameters, dict):
+        return {key: _redact_value(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [_redact_value(value) for value in parameters]
+    return _redact_value(parameters)
+
+
+def current_stats() -> SqlStats | None:
+    return _current.get()
+
+
+@contextlib.contextmanager
+def track(name: str):
+    # everything the engines run inside the block is added to the yielded SqlStats
+    stats = SqlStats(name)
+    token = _current.set(stats)
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+        report(stats)
+
+
+def report(stats: SqlStats):
+    for shape, count in stats.repeated():
+        logger.warning("%s ran the same statement %d times (N+1?): %s", stats.name, count, shape[:300])
+    logger.debug("%s: %d statements, %.1f ms in the database", stats.name, stats.statements, stats.db_time * 1000)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._sql_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._sql_started
+
+    stats = _current.get()
+    if stats is not None:
+        stats.add(statement, elapsed, executemany)
+
+    if elapsed * 1000 >= settings.SQL_SLOW_QUERY_MS:
+        logger.warning(
+            "slow query (%.1f ms)%s: %s params=%s",
+            elapsed * 1000,
+            f" in {stats.name}" if stats else "",
+            " ".join(statement.split())[:1000],
+            redact_parameters(parameters, executemany),
+        )
+
+
+def instrument_engine(engine: Engine):
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class SqlStatsMiddleware:
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        with track(f"{scope['method']} {scope['path']}") as stats:
+
+            async def send_wrapper(message: Message):
+                # the endpoint is done by the time the response starts, what streams after that isn't in the header
+                if message["type"] == "http.response.start" and settings.DEBUG:
+                    MutableHeaders(raw=message["headers"]).append("Server-Timing", stats.server_timing())
+                await send(message)
+
+            await self.app(scope, receive, send_wrapper)
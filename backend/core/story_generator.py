@@ -1,25 +1,53 @@
+import re
+import time
+
+from sqlalchemy import String, cast, or_, update
 from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
 
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import PydanticOutputParser
 
-from core.prompts import STORY_PROMPT
+from core.prompts import STORY_PROMPT, STORY_BATCH_PROMPT, ENDLESS_STORY_PROMPT, EXPAND_NODE_PROMPT
 from models.story import Story, StoryNode
-from core.models import StoryLLMResponse, StoryNodeLLM
+from core.models import StoryLLMResponse, StoryNodeLLM, StoryBatchLLMResponse, StoryExpansionLLM
+from core.throughput import generation_throughput
+from core.llm_guard import llm_guard
+from core.cassette import record_llm, replay_llm
+from core.job_accounting import record_llm_call, parse_timer, record_story
+from core.story_stats import compute_story_stats, apply_story_stats
+from core.config import settings
+from core.search import index_story, index_nodes
+from core.story_graph import path_to_root, save_edges
+from core.content_store import store_contents, load_node_contents
+from core.story_payloads import invalidate_story_payload
+from core.leases import complete_job
 
 from dotenv import load_dotenv
 
 load_dotenv()
+
+_FENCED_BLOCK = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL)
+
+
 class StoryGenerator:
     
     # class to organize some of the functions that we have for out story generator
     @classmethod
     def _get_llm(cls): # when the function starts with _ its a private method so it should be called internally from the class; python convention
-        return ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0.7)
+        if settings.LLM_CASSETTE_MODE == "replay":
+            return replay_llm() # recorded responses, no network (see core/cassette.py)
+        
+        llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0.7, timeout=settings.LLM_TIMEOUT_SECONDS)
+        return record_llm(llm) if settings.LLM_CASSETTE_MODE == "record" else llm
     
     @classmethod
-    def generate_story(cls, db: Session, session_id: str, theme: str = "fantasy") -> Story:
+    def generate_story(
+        cls, db: Session, session_id: str, theme: str = "fantasy", endless: bool = False, job_id: str | None = None
+    ) -> Story | None:
+        # with a job_id the story is saved together with completing the job (core/leases.py),
+        # None means the job's lease was lost and the story was dropped
         llm = cls._get_llm()
         
         story_parser = PydanticOutputParser(pydantic_object=StoryLLMResponse)
@@ -27,7 +55,7 @@ class StoryGenerator:
         prompt = ChatPromptTemplate.from_messages([
             (
                 "system",
-                STORY_PROMPT
+                ENDLESS_STORY_PROMPT if endless else STORY_PROMPT
             ),
             (
                 "human",
@@ -36,55 +64,255 @@ class StoryGenerator:
         ]).partial(format_instructions=story_parser.get_format_instructions())
         
         
-        raw_response = llm.invoke(prompt.invoke({}))
+        response_text = cls._invoke_llm(llm, prompt, stories=1)
+
+        with parse_timer():
+            story_structure = cls._parse_story_response(response_text)
+        
+        save = lambda: cls._save_story(db, session_id, story_structure, endless=endless)
+        story_db = complete_job(db, job_id, save) if job_id else save()
+        
+        db.commit()
+        return story_db
+    
+    @classmethod
+    def generate_stories(
+        cls, db: Session, requests: list[tuple[str, str]], job_ids: list[str] | None = None
+    ) -> list[Story | Exception | None]:
+        # several (session_id, theme) pairs in one LLM call, the prompt and format instructions are only paid once.
+        # returns one entry per request in the same order, an Exception for the ones that couldn't be generated
+        # (and None for a job whose lease was lost, like generate_story)
+        llm = cls._get_llm()
+        
+        batch_parser = PydanticOutputParser(pydantic_object=StoryBatchLLMResponse)
+        themes = "\n".join(f"{i + 1}. {theme}" for i, (_, theme) in enumerate(requests))
+        
+        prompt = ChatPromptTemplate.from_messages([
+            (
+                "system",
+                STORY_BATCH_PROMPT
+            ),
+            (
+                "human",
+                f"Create one story for each of these {len(requests)} themes:\n{themes}"
+            ),
+        ]).partial(format_instructions=batch_parser.get_format_instructions())
+        
+        response_text = cls._invoke_llm(llm, prompt, stories=len(requests))
+        with parse_timer():
+            batch = StoryBatchLLMResponse.model_validate_json(cls._strip_code_fences(response_text))
+        
+        results: list[Story | Exception | None] = []
+        for i, (session_id, theme) in enumerate(requests):
+            job_id = job_ids[i] if job_ids else None
+            if i < len(batch.stories):
+                save = lambda: cls._save_story(db, session_id, batch.stories[i])
+                results.append(complete_job(db, job_id, save) if job_id else save())
+                continue
+            
+            # the model came back with fewer stories than themes, the missing ones get their own call.
+            # what's saved so far goes in first, a failing call rolls back only its own story
+            db.commit()
+            try:
+                results.append(cls.generate_story(db, session_id, theme, job_id=job_id))
+            except Exception as e:
+                db.rollback()
+                results.append(e)
+        
+        db.commit()
+        return results
+    
+    @classmethod
+    def _invoke_llm(cls, llm, prompt: ChatPromptTemplate, stories: int) -> str:
+        # waits for a free slot, raises LLMUnavailable right away while the breaker is open
+        with llm_guard.slot():
+            started = time.perf_counter()
+            raw_response = llm.invoke(prompt.invoke({}))
+            record_llm_call(llm, raw_response, time.perf_counter() - started) # per job accounting
         
         response_text = raw_response
         
         if hasattr(raw_response, "content"):
             response_text = raw_response.content
-
-        story_structure = story_parser.parse(response_text)
         
-        story_db = Story(title=story_structure.title, session_id=session_id)
+        usage = getattr(raw_response, "usage_metadata", None) or {}
+        generation_throughput.record(stories, usage.get("total_tokens", 0))
+        
+        return response_text
+    
+    @classmethod
+    def _save_story(cls, db: Session, session_id: str, story_structure: StoryLLMResponse, endless: bool = False) -> Story:
+        story_db = Story(title=story_structure.title, session_id=session_id, endless=endless or None)
         db.add(story_db)
         db.flush() # updates story database object with all the automatic populated fields (like the id of the story)
         
-        root_node_data = story_structure.rootNode
-        # process data to put in correct format
-        if isinstance(root_node_data, dict):
-            root_node_data = StoryNodeLLM.model_validate(root_node_data)
-            
-        # by default the model returns JSON so we have to convert it to "python data"
-        cls._process_story_node(db, story_db.id, root_node_data, is_root=True)
+        # the node texts go into the content store first (compressed, stored once per distinct text),
+        # the nodes only keep the hash
+        content_hashes = store_contents(db, cls._collect_contents(story_structure.rootNode))
         
+        # the parser already validated the whole tree (see core/models.py), so every level is a StoryNodeLLM
+        nodes: list[StoryNode] = []
+        cls._process_story_node(
+            db, story_db.id, story_structure.rootNode, is_root=True, created=nodes, content_hashes=content_hashes
+        )
+        
+        # the nodes are all in memory right now, so the stats cost nothing compared to clients walking the tree
+        apply_story_stats(story_db, compute_story_stats(nodes))
+        record_story(story_db.id, len(nodes))
+        
+        # search index rows go in with the same commit as the story, so do the edges
+        index_story(db, story_db, nodes)
+        save_edges(db, story_db.id, nodes)
         
-        db.commit()
         return story_db
     
     @classmethod
-    def _process_story_node(cls, db: Session, story_id: int, node_data: StoryNodeLLM, is_root: bool = False) -> StoryNode:
+    def expand_node(cls, db: Session, node_id: int) -> list[StoryNode]:
+        # endless mode: writes the options of a leaf with the path that led to it as context, returns the new nodes
+        node = db.get(StoryNode, node_id)
+        story = db.get(Story, node.story_id)
+        if (story.node_count or 0) >= settings.ENDLESS_MAX_NODES:
+            raise ValueError("the story reached ENDLESS_MAX_NODES") # don't spend an LLM call on it
+        
+        # only the last steps of the path go in the prompt, story_edges gets them without loading the story
+        path = path_to_root(db, node.id, max_steps=settings.ENDLESS_CONTEXT_STEPS)
+        path_nodes = {
+            path_node.id: path_node
+            for path_node in db.query(StoryNode).filter(StoryNode.id.in_([path_id for path_id, _ in path]))
+        }
+        load_node_contents(db, list(path_nodes.values()))
+        
+        steps = "\n\n".join(
+            f"Scene: {path_nodes[path_id].content}" + (f"\nThe player chose: {choice}" if choice else "")
+            for path_id, choice in path
+        )
+        
+        expansion_parser = PydanticOutputParser(pydantic_object=StoryExpansionLLM)
+        prompt = ChatPromptTemplate.from_messages([
+            (
+                "system",
+                EXPAND_NODE_PROMPT
+            ),
+            (
+                "human",
+                f"Story: {story.title}\n\nThe path so far:\n\n{steps}\n\nContinue from the last scene."
+            ),
+        ]).partial(format_instructions=expansion_parser.get_format_instructions())
+        
+        response_text = cls._invoke_llm(cls._get_llm(), prompt, stories=0)
+        expansion = StoryExpansionLLM.model_validate_json(cls._strip_code_fences(response_text))
+        
+        # the LLM call took a while, lock the story and look again: the leaf might have been expanded meanwhile,
+        # and the stats need every node that's there now
+        db.query(Story).filter(Story.id == story.id).with_for_update().one()
+        nodes = db.query(StoryNode).filter(StoryNode.story_id == story.id).populate_existing().all()
+        if node.options or node.is_ending:
+            db.rollback()
+            return []
+        
+        content_hashes = store_contents(
+            db, [content for option in expansion.options for content in cls._collect_contents(option.nextNode)]
+        )
+        created: list[StoryNode] = []
+        options = [
+            {
+                "text": option.text,
+                "node_id": cls._process_story_node(db, story.id, option.nextNode, False, created, content_hashes).id,
+            }
+            for option in expansion.options
+        ]
+        
+        # the lock above does nothing on sqlite, and an expansion that ran past the timeout can be running twice.
+        # only one of them gets to write the leaf's options, the other one throws its nodes away
+        written = db.execute(
+            update(StoryNode)
+            .where(
+                StoryNode.id == node.id,
+                or_(StoryNode.options.is_(None), cast(StoryNode.options, String).in_(("[]", "null"))),
+            )
+            .values(options=options)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if not written:
+            db.rollback()
+            return []
+        # other leaves of the story can be expanding at the same time, the cap is checked again now that this one
+        # holds the story (and on sqlite, the write lock)
+        if len(nodes) + len(created) > settings.ENDLESS_MAX_NODES:
+            db.rollback()
+            raise ValueError("the story reached ENDLESS_MAX_NODES")
+        set_committed_value(node, "options", options)
+        
+        apply_story_stats(story, compute_story_stats(nodes + created))
+        index_nodes(db, story.id, created)
+        save_edges(db, story.id, [node] + created)
+        db.commit()
+        
+        invalidate_story_payload(db, story.id) # /complete has to be built again with the new nodes
+        db.commit()
+        return created
+    
+    @classmethod
+    def _collect_contents(cls, root: StoryNodeLLM) -> list[str]:
+        contents, stack = [], [root]
+        while stack:
+            node_data = stack.pop()
+            contents.append(node_data.content)
+            if not node_data.isEnding and node_data.options:
+                stack.extend(option.nextNode for option in node_data.options)
+        return contents
+    
+    @classmethod
+    def _parse_story_response(cls, response_text: str) -> StoryLLMResponse:
+        # validates the whole tree in one pass straight from the JSON text (no intermediate dicts)
+        return StoryLLMResponse.model_validate_json(cls._strip_code_fences(response_text))
+    
+    @classmethod
+    def _strip_code_fences(cls, response_text: str) -> str:
+        # the model sometimes wraps the JSON in ```json fences, and sometimes says something before or after it.
+        # same tolerance as langchain's output parser: a fenced block anywhere, else the outermost {...}
+        text = response_text.strip()
+        if text.startswith("{"):
+            return text
+        
+        fenced = _FENCED_BLOCK.search(text)
+        if fenced:
+            return fenced.group(1).strip()
+        
+        start, end = text.find("{"), text.rfind("}")
+        if start != -1 and end > start:
+            return text[start:end + 1]
+        return text
+    
+    @classmethod
+    def _process_story_node(cls, db: Session, story_id: int, node_data: StoryNodeLLM, is_root: bool = False, created: list[StoryNode] | None = None, content_hashes: dict[str, str] | None = None) -> StoryNode:
+        content_hash = content_hashes[node_data.content] if content_hashes is not None else None
+        
         node = StoryNode(
             story_id=story_id,
-            content=node_data.content if hasattr(node_data, "content") else node_data["content"],
+            content=None if content_hash else node_data.content,
+            content_hash=content_hash,
             is_root=is_root,
-            is_ending=node_data.isEnding if hasattr(node_data, "isEnding") else node_data["isEnding"],
-            is_winning_ending=node_data.isWinningEnding if hasattr(node_data, "isWinningEnding") else node_data["isWinningEnding"],
+            is_ending=node_data.isEnding,
+            is_winning_ending=node_data.isWinningEnding,
             options=[]         
         )
         
         db.add(node)
         db.flush()
         
-        if not node.is_ending and (hasattr(node_data, "options") and node_data.options):
+        if content_hash:
+            # the text is still at hand, whatever reads the node in this session (the search index) gets it
+            set_committed_value(node, "content", node_data.content)
+        
+        if created is not None:
+            created.append(node)
+        
+        if not node.is_ending and node_data.options:
             options_list = []
             
             for option_data in node_data.options:
-                next_node = option_data.nextNode
-                
-                if isinstance(next_node, dict):
-                    next_node = StoryNodeLLM.model_validate(next_node)
-                    
-                child_node = cls._process_story_node(db, story_id, next_node, False)
+                child_node = cls._process_story_node(db, story_id, option_data.nextNode, False, created, content_hashes)
                 
                 options_list.append({
                     "text" : option_data.text,
@@ -0,0 +1,112 @@
+# story graph queries on story_edges
+#
+# the choices of a node live in its options JSON, which the database can't index or follow. story_edges has one
+# row per option (from_node_id -> to_node_id), written next to the options by the generator, so questions like
+# "which node leads here", "everything below this node" or "can you get from here to there" are recursive CTEs
+# (same sql on sqlite and postgres) instead of loading a whole story into python
+
+from typing import Iterable
+
+from sqlalchemy import String, exists, func, literal, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from models.story import Story, StoryEdge, StoryNode
+
+MAX_DEPTH = 1000 # generated stories are trees, this only stops a walk if bad data ever has a cycle
+
+
+def edge_rows(story_id: int, nodes: Iterable[StoryNode]) -> list[dict]:
+    return [
+        {
+            "story_id": story_id,
+            "from_node_id": node.id,
+            "to_node_id": option["node_id"],
+            "ordinal": ordinal,
+            "text": option.get("text"),
+        }
+        for node in nodes
+        for ordinal, option in enumerate(node.options or [])
+        if option.get("node_id") is not None
+    ]
+
+
+def save_edges(db: Session, story_id: int, nodes: Iterable[StoryNode]) -> int:
+    # runs in the caller's transaction, nodes need their final options.
+    # edges that are already there (a backfill racing another one) are left alone
+    rows = edge_rows(story_id, nodes)
+    if not rows:
+        return 0
+
+    dialect = postgresql if db.get_bind().dialect.name == "postgresql" else sqlite
+    db.execute(
+        dialect.insert(StoryEdge).on_conflict_do_nothing(index_elements=[StoryEdge.from_node_id, StoryEdge.ordinal]),
+        rows,
+    )
+    return len(rows)
+
+
+def _descendants(node_id: int, max_depth: int):
+    edges = StoryEdge.__table__
+    tree = select(literal(node_id).label("node_id"), literal(0).label("depth")).cte("subtree", recursive=True)
+    return tree.union_all(
+        select(edges.c.to_node_id, tree.c.depth + 1)
+        .select_from(edges.join(tree, edges.c.from_node_id == tree.c.node_id))
+        .where(tree.c.depth < max_depth)
+    )
+
+
+def subtree_node_ids(db: Session, node_id: int, max_depth: int | None = None) -> list[int]:
+    # node_id and everything below it, closest first
+    tree = _descendants(node_id, min(max_depth or MAX_DEPTH, MAX_DEPTH))
+    return db.scalars(
+        select(tree.c.node_id).group_by(tree.c.node_id).order_by(func.min(tree.c.depth), tree.c.node_id)
+    ).all()
+
+
+def path_to_root(db: Session, node_id: int, max_steps: int | None = None) -> list[tuple[int, str | None]]:
+    # (node id, text of the option taken from it) from the root down to node_id, the choice is None for node_id.
+    # max_steps keeps only the last steps of a long path
+    edges = StoryEdge.__table__
+    up = select(
+        literal(node_id).label("node_id"), literal(None, String).label("choice"), literal(0).label("depth")
+    ).cte("path", recursive=True)
+    up = up.union_all(
+        select(edges.c.from_node_id, edges.c.text, up.c.depth + 1)
+        .select_from(edges.join(up, edges.c.to_node_id == up.c.node_id))
+        .where(up.c.depth < min(max_steps - 1 if max_steps else MAX_DEPTH, MAX_DEPTH))
+    )
+    return [tuple(row) for row in db.execute(select(up.c.node_id, up.c.choice).order_by(up.c.depth.desc()))]
+
+
+def is_reachable(db: Session, from_node_id: int, to_node_id: int) -> bool:
+    tree = _descendants(from_node_id, MAX_DEPTH)
+    return bool(db.scalar(select(exists().where(tree.c.node_id == to_node_id))))
+
+
+def backfill_edges(db: Session, batch_size: int = 200) -> int:
+    # stories from before story_edges existed (create_tables runs this once, python cli.py backfill-edges again)
+    backfilled = 0
+    last_id = 0
+    while True:
+        story_ids = db.scalars(
+            select(Story.id)
+            .where(Story.id > last_id, ~exists().where(StoryEdge.story_id == Story.id))
+            .order_by(Story.id)
+            .limit(batch_size)
+        ).all()
+        if not story_ids:
+            break
+
+        nodes = db.execute(
+            select(StoryNode.id, StoryNode.story_id, StoryNode.options).where(StoryNode.story_id.in_(story_ids))
+        ).all()
+        for story_id in story_ids:
+            # a story with a single node has no edges, it gets looked at again next time but that's cheap
+            if save_edges(db, story_id, [node for node in nodes if node.story_id == story_id]):
+                backfilled += 1
+        db.commit()
+
+        last_id = story_ids[-1]
+
+    return backfilled
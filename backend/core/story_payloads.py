@@ -0,0 +1,147 @@
+# precompressed /stories/{id}/complete payloads
+#
+# a generated story never changes, so its JSON gets built and compressed (once per encoding we support)
+# the first time someone asks for it. the bytes are stored in story_payloads next to the story and kept in a small
+# in-process LRU, so later requests just send bytes, no tree building, serializing or compressing.
+# endless stories do change (core/expansion.py). their stored payloads get deleted when they grow, but another
+# worker's LRU would never hear about it, so they're only kept in story_payloads and never in the LRU.
+# a request can build the payload from the tree as it was before an expansion, so payloads are only stored while
+# the story still has the node_count it had when the request looked at it, and expansions delete the stored ones
+# after their commit
+
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable
+
+from sqlalchemy import LargeBinary, bindparam, delete, exists, insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from core.compression import available_encodings, compress, decompress
+from core.config import settings
+from models.story import Story, StoryPayload
+
+IDENTITY = "identity"
+
+
+@dataclass
+class Payload:
+    body: bytes
+    encoding: str # what the body is actually encoded with, can be identity even if the client accepts more
+    etag: str
+
+
+class PayloadCache:
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[tuple[int, str], Payload] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, story_id: int, encoding: str) -> Payload | None:
+        with self._lock:
+            payload = self._entries.get((story_id, encoding))
+            if payload:
+                self._entries.move_to_end((story_id, encoding))
+            return payload
+
+    def put(self, story_id: int, encoding: str, payload: Payload):
+        with self._lock:
+            old = self._entries.pop((story_id, encoding), None)
+            if old:
+                self._size -= len(old.body)
+
+            self._entries[(story_id, encoding)] = payload
+            self._size += len(payload.body)
+
+            while self._size > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted.body)
+
+    def discard(self, story_id: int):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == story_id]:
+                self._size -= len(self._entries.pop(key).body)
+
+
+payload_cache = PayloadCache(settings.STORY_PAYLOAD_CACHE_BYTES)
+
+
+def get_story_payload(
+    db: Session, story_id: int, encoding: str | None, build: Callable[[], bytes], write_db: Session | None = None
+) -> Payload:
+    # encoding is what the client accepts (from negotiate_encoding), build returns the uncompressed JSON.
+    # write_db is where new payloads get stored when db is a read replica
+    wanted = encoding or IDENTITY
+
+    payload = payload_cache.get(story_id, wanted)
+    if payload:
+        return payload
+
+    # every stored variant of the story in one query, at most one row per encoding, and whether it can change
+    rows = (
+        db.query(Story.endless, Story.node_count, StoryPayload)
+        .outerjoin(StoryPayload, StoryPayload.story_id == Story.id)
+        .filter(Story.id == story_id)
+        .all()
+    )
+    stored = {row.encoding: Payload(row.body, row.encoding, row.etag) for _, _, row in rows if row is not None}
+    # a story that isn't on the replica yet isn't cached either, there's no telling if it's endless
+    cacheable = bool(rows) and not rows[0].endless
+
+    if not stored:
+        stored = _store_payloads(write_db or db, story_id, build(), rows[0].node_count if rows else None)
+
+    if wanted in stored:
+        payload = stored[wanted]
+    elif IDENTITY in stored:
+        # too small to be worth compressing, everyone gets the plain JSON
+        payload = stored[IDENTITY]
+    else:
+        # client takes no encoding we stored, decompressing is still cheaper than building the tree again
+        any_variant = next(iter(stored.values()))
+        payload = Payload(decompress(any_variant.body, any_variant.encoding), IDENTITY, any_variant.etag)
+
+    if cacheable:
+        payload_cache.put(story_id, wanted, payload)
+    return payload
+
+
+def _store_payloads(db: Session, story_id: int, body: bytes, node_count: int | None) -> dict[str, Payload]:
+    # node_count: the story's when the request started, the payloads are only stored if it's still the same.
+    # weak etag: the same document in every encoding
+    etag = f'W/"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+    if len(body) < settings.COMPRESSION_MINIMUM_SIZE:
+        variants = {IDENTITY: body}
+    else:
+        variants = {encoding: compress(body, encoding, precompressed=True) for encoding in available_encodings()}
+
+    unchanged = exists().where(Story.id == story_id, Story.node_count.is_not_distinct_from(node_count))
+    try:
+        for encoding, data in variants.items():
+            db.execute(insert(StoryPayload).from_select(
+                ["story_id", "encoding", "body", "etag"],
+                select(
+                    bindparam("story_id", story_id),
+                    bindparam("encoding", encoding),
+                    bindparam("body", data, type_=LargeBinary),
+                    bindparam("etag", etag),
+                ).where(unchanged),
+            ))
+        db.commit()
+    except IntegrityError:
+        # another request stored them first, ours are just as good
+        db.rollback()
+
+    return {encoding: Payload(data, encoding, etag) for encoding, data in variants.items()}
+
+
+def invalidate_story_payload(db: Session, story_id: int):
+    # for stories that do change after all, once the change is committed (so nobody stores a payload of the old
+    # tree after this), the caller commits
+    db.execute(delete(StoryPayload).where(StoryPayload.story_id == story_id))
+    payload_cache.discard(story_id)
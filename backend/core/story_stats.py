@@ -0,0 +1,79 @@
+# numbers about a story's graph that every client used to work out by walking all_nodes itself.
+# computed once when the story is written and stored on the stories row
+
+from collections import deque
+from dataclasses import dataclass
+from typing import Iterable
+
+from models.story import Story, StoryNode
+
+
+@dataclass
+class StoryStats:
+    max_depth: int # levels, the root counts as 1 like in the prompt
+    node_count: int
+    ending_count: int
+    winning_ending_count: int
+    shortest_winning_path: list[int] | None # node ids from the root to the closest winning ending
+    branching_factor: float # average options per node that has options
+
+
+def compute_story_stats(nodes: Iterable[StoryNode]) -> StoryStats:
+    nodes_by_id = {node.id: node for node in nodes}
+    root = next((node for node in nodes_by_id.values() if node.is_root), None)
+    if root is None:
+        raise ValueError("story has no root node")
+    
+    # one breadth first walk: the first winning ending it reaches is also the closest one
+    parents: dict[int, int | None] = {root.id: None}
+    queue = deque([(root, 1)])
+    max_depth = ending_count = winning_ending_count = option_count = nodes_with_options = 0
+    shortest_winning_end = None
+    
+    while queue:
+        node, depth = queue.popleft()
+        max_depth = max(max_depth, depth)
+        
+        if node.is_ending:
+            ending_count += 1
+        if node.is_winning_ending:
+            winning_ending_count += 1
+            if shortest_winning_end is None:
+                shortest_winning_end = node.id
+        
+        if node.options:
+            nodes_with_options += 1
+            option_count += len(node.options)
+        
+        for option in node.options or []:
+            child = nodes_by_id.get(option.get("node_id"))
+            if child is not None and child.id not in parents:
+                parents[child.id] = node.id
+                queue.append((child, depth + 1))
+    
+    shortest_winning_path = None
+    if shortest_winning_end is not None:
+        shortest_winning_path = []
+        node_id = shortest_winning_end
+        while node_id is not None:
+            shortest_winning_path.append(node_id)
+            node_id = parents[node_id]
+        shortest_winning_path.reverse()
+    
+    return StoryStats(
+        max_depth=max_depth,
+        node_count=len(parents), # only what's reachable from the root
+        ending_count=ending_count,
+        winning_ending_count=winning_ending_count,
+        shortest_winning_path=shortest_winning_path,
+        branching_factor=round(option_count / nodes_with_options, 3) if nodes_with_options else 0.0,
+    )
+
+
+def apply_story_stats(story: Story, stats: StoryStats):
+    story.max_depth = stats.max_depth
+    story.node_count = stats.node_count
+    story.ending_count = stats.ending_count
+    story.winning_ending_count = stats.winning_ending_count
+    story.shortest_winning_path = stats.shortest_winning_path
+    story.branching_factor = stats.branching_factor
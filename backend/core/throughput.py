@@ -0,0 +1,48 @@
+# sliding window of finished generations, to see what batching (GENERATION_BATCH_SIZE) buys us
+# in stories per minute and stories per 1k tokens
+
+import threading
+import time
+from collections import deque
+
+
+class ThroughputTracker:
+
+    def __init__(self, window_seconds: float = 600):
+        self.window_seconds = window_seconds
+        self._events: deque[tuple[float, int, int]] = deque() # (time, stories, tokens) per LLM call
+        self._lock = threading.Lock()
+
+    def record(self, stories: int, tokens: int):
+        with self._lock:
+            self._events.append((time.monotonic(), stories, tokens))
+            self._trim()
+
+    def _trim(self):
+        cutoff = time.monotonic() - self.window_seconds
+        while self._events and self._events[0][0] < cutoff:
+            self._events.popleft()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            self._trim()
+            events = list(self._events)
+
+        stories = sum(event[1] for event in events)
+        tokens = sum(event[2] for event in events)
+        
+        # until the window fills up, only count the time since the first call
+        elapsed = min(self.window_seconds, time.monotonic() - events[0][0]) if events else 0
+
+        return {
+            "window_seconds": self.window_seconds,
+            "llm_calls": len(events),
+            "stories": stories,
+            "tokens": tokens,
+            "stories_per_minute": round(stories / elapsed * 60, 3) if elapsed > 0 else None,
+            "stories_per_1k_tokens": round(stories / tokens * 1000, 3) if tokens else None,
+            "stories_per_llm_call": round(stories / len(events), 3) if events else None,
+        }
+
+
+generation_throughput = ThroughputTracker()
@@ -0,0 +1,323 @@
+# bulk export / import of stories as NDJSON (python cli.py export / import)
+#
+# for backups, moving between sqlite and postgres and seeding staging. the file is a header line, then one line per
+# story with its nodes and jobs merged in, then one line per job that has no story (pending, failed).
+# a file name ending in .gz gets gzipped, - is stdout / stdin
+#
+# both directions stream so memory stays flat however big the database is:
+# - export reads stories, nodes and jobs through three server side cursors (yield_per) sorted by story id
+#   and merges them as it goes, like a merge join
+# - import inserts a batch of stories at a time with executemany + RETURNING for the new ids, then fixes the
+#   node_id references inside options (and the story's shortest_winning_path) to point at the new node ids
+# - node text is written out as plain text, the import puts it (back) into the content store
+#
+# playthrough progress and story payloads aren't exported, payloads get rebuilt on the first request
+#
+# importing the same file twice is fine: a job_id that's already in the database gets skipped, and so does the
+# story it belongs to (a story without any job can't be matched up and comes in again). jobs that were still pending
+# or processing at export time come in as failed, whatever was working on them is gone and nothing would pick them
+# back up with the story they were for
+
+import contextlib
+import gzip
+import json
+import sys
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Iterable, Iterator, TextIO
+
+from sqlalchemy import DateTime, Table, bindparam, insert, select, update
+from sqlalchemy.orm import Session
+
+from core.content_store import load_contents, store_contents
+from core.search import index_story
+from core.story_graph import save_edges
+from models.job import StoryJob
+from models.story import Story, StoryNode
+
+FORMAT_VERSION = 1
+EXPORT_CONTENT_BATCH = 100 # stories whose node texts get loaded together
+EXISTING_JOBS_CHUNK = 500 # job_ids per IN (...) when looking for ones that are already imported
+UNFINISHED_STATUSES = ("pending", "processing")
+
+stories_table: Table = Story.__table__
+nodes_table: Table = StoryNode.__table__
+jobs_table: Table = StoryJob.__table__
+
+
+@contextlib.contextmanager
+def open_ndjson(path: str, mode: str) -> Iterator[TextIO]:
+    # mode is "r" or "w"
+    if path == "-":
+        yield sys.stdin if mode == "r" else sys.stdout
+    elif path.endswith(".gz"):
+        with gzip.open(path, mode + "t", encoding="utf-8") as f:
+            yield f
+    else:
+        with open(path, mode, encoding="utf-8") as f:
+            yield f
+
+
+class _MergeCursor:
+    # rows sorted by key, take(value) returns the rows with that key and skips any before it
+
+    def __init__(self, rows: Iterable, key: str):
+        self._rows = iter(rows)
+        self._key = key
+        self._next = next(self._rows, None)
+
+    def take(self, value) -> list:
+        taken = []
+        while self._next is not None and self._next[self._key] <= value:
+            if self._next[self._key] == value:
+                taken.append(self._next)
+            self._next = next(self._rows, None)
+        return taken
+
+
+def _record(row, exclude: tuple[str, ...] = ()) -> dict:
+    return {
+        key: value.isoformat() if isinstance(value, datetime) else value
+        for key, value in row.items()
+        if key not in exclude
+    }
+
+
+def _stream(db: Session, statement, batch_size: int):
+    return db.execute(statement.execution_options(yield_per=batch_size)).mappings()
+
+
+def export_stories(db: Session, out: TextIO, batch_size: int = 1000) -> dict:
+    counts = {"stories": 0, "nodes": 0, "jobs": 0}
+    out.write(json.dumps({"type": "header", "format": FORMAT_VERSION, "exported_at": datetime.now().isoformat()}) + "\n")
+
+    stories = _stream(db, select(stories_table).order_by(stories_table.c.id), batch_size)
+    nodes = _MergeCursor(_stream(
+        db,
+        select(nodes_table).where(nodes_table.c.story_id.is_not(None)).order_by(nodes_table.c.story_id, nodes_table.c.id),
+        batch_size,
+    ), "story_id")
+    jobs = _MergeCursor(_stream(
+        db,
+        select(jobs_table).where(jobs_table.c.story_id.is_not(None)).order_by(jobs_table.c.story_id, jobs_table.c.id),
+        batch_size,
+    ), "story_id")
+
+    # node text is in the content store, it gets loaded for a few stories at a time (one query) before they're written
+    pending: list[dict] = []
+    for story in stories:
+        story_nodes = nodes.take(story["id"])
+        story_jobs = jobs.take(story["id"])
+
+        record = {"type": "story", **_record(story)}
+        record["nodes"] = [_record(node, exclude=("story_id",)) for node in story_nodes]
+        record["jobs"] = [_record(job, exclude=("id", "story_id")) for job in story_jobs]
+        pending.append(record)
+
+        counts["stories"] += 1
+        counts["nodes"] += len(story_nodes)
+        counts["jobs"] += len(story_jobs)
+
+        if len(pending) >= EXPORT_CONTENT_BATCH:
+            _write_stories(db, out, pending)
+            pending = []
+
+    _write_stories(db, out, pending)
+
+    for job in _stream(db, select(jobs_table).where(jobs_table.c.story_id.is_(None)).order_by(jobs_table.c.id), batch_size):
+        out.write(json.dumps({"type": "job", **_record(job, exclude=("id",))}) + "\n")
+        counts["jobs"] += 1
+
+    return counts
+
+
+def _write_stories(db: Session, out: TextIO, records: list[dict]):
+    # the file always has the plain text, so it can go into a database with or without the content store
+    texts = load_contents(db, [
+        node["content_hash"]
+        for record in records
+        for node in record["nodes"]
+        if node["content"] is None and node["content_hash"]
+    ])
+    for record in records:
+        for node in record["nodes"]:
+            content_hash = node.pop("content_hash", None)
+            if node["content"] is None and content_hash:
+                node["content"] = texts[content_hash]
+        out.write(json.dumps(record) + "\n")
+
+
+def _row(table: Table, record: dict, **overrides) -> dict:
+    # every column but the id, so all rows of an executemany have the same keys
+    row = {}
+    for column in table.columns:
+        if column.primary_key:
+            continue
+        value = overrides[column.name] if column.name in overrides else record.get(column.name)
+        if isinstance(column.type, DateTime) and isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        row[column.name] = value
+    return row
+
+
+def _job_row(record: dict, story_id: int | None) -> dict:
+    if record.get("status") not in UNFINISHED_STATUSES:
+        return _row(jobs_table, record, story_id=story_id)
+    return _row(
+        jobs_table,
+        record,
+        story_id=story_id,
+        status="failed",
+        error=record.get("error") or "unfinished when it was exported",
+        lease_owner=None,
+        lease_expires_at=None,
+    )
+
+
+def _existing_job_ids(db: Session, job_ids: list[str]) -> set[str]:
+    existing = set()
+    for start in range(0, len(job_ids), EXISTING_JOBS_CHUNK):
+        chunk = job_ids[start:start + EXISTING_JOBS_CHUNK]
+        existing.update(db.execute(select(jobs_table.c.job_id).where(jobs_table.c.job_id.in_(chunk))).scalars())
+    return existing
+
+
+def import_stories(db: Session, lines: Iterable[str], batch_size: int = 200, index: bool = True) -> dict:
+    counts = {"stories": 0, "nodes": 0, "jobs": 0, "skipped_stories": 0, "skipped_jobs": 0}
+    stories: list[dict] = []
+    jobs: list[dict] = []
+    header_seen = False
+
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+
+        if not header_seen:
+            if record.get("type") != "header" or record.get("format") != FORMAT_VERSION:
+                raise ValueError(f"not a story export (format {FORMAT_VERSION})")
+            header_seen = True
+            continue
+
+        if record["type"] == "story":
+            stories.append(record)
+            if len(stories) >= batch_size:
+                _import_story_batch(db, stories, counts, index)
+                stories = []
+        elif record["type"] == "job":
+            jobs.append(record)
+            if len(jobs) >= batch_size:
+                _import_jobs(db, jobs, counts)
+                jobs = []
+
+    if stories:
+        _import_story_batch(db, stories, counts, index)
+    if jobs:
+        _import_jobs(db, jobs, counts)
+
+    return counts
+
+
+def _import_story_batch(db: Session, records: list[dict], counts: dict, index: bool):
+    # a story whose job is already there came in with an earlier import
+    existing = _existing_job_ids(db, [job["job_id"] for record in records for job in record["jobs"]])
+    if existing:
+        kept = [record for record in records if not any(job["job_id"] in existing for job in record["jobs"])]
+        counts["skipped_stories"] += len(records) - len(kept)
+        counts["skipped_jobs"] += sum(len(record["jobs"]) for record in records) - sum(len(record["jobs"]) for record in kept)
+        records = kept
+        if not records:
+            return
+
+    story_ids = db.execute(
+        insert(stories_table).returning(stories_table.c.id, sort_by_parameter_order=True),
+        # exports from before completed_at existed only have finished stories in them, the winning path comes below
+        [
+            _row(stories_table, record, completed_at=record.get("completed_at") or record["created_at"], shortest_winning_path=None)
+            for record in records
+        ],
+    ).scalars().all()
+
+    content_hashes = store_contents(db, [node["content"] for record in records for node in record["nodes"]])
+
+    node_rows = []
+    for record, story_id in zip(records, story_ids):
+        node_rows += [
+            _row(nodes_table, node, story_id=story_id, options=[], content=None, content_hash=content_hashes[node["content"]])
+            for node in record["nodes"]
+        ]
+
+    node_ids: dict[int, int] = {} # old id -> new id, node ids are unique across the whole export
+    if node_rows:
+        new_ids = db.execute(
+            insert(nodes_table).returning(nodes_table.c.id, sort_by_parameter_order=True), node_rows
+        ).scalars().all()
+        old_ids = [node["id"] for record in records for node in record["nodes"]]
+        node_ids = dict(zip(old_ids, new_ids))
+
+    # options point at other nodes by id, now that the new ids are known they can be filled in
+    remapped = {
+        node_ids[node["id"]]: [{**option, "node_id": node_ids.get(option.get("node_id"))} for option in node["options"]]
+        for record in records
+        for node in record["nodes"]
+        if node.get("options")
+    }
+    if remapped:
+        db.execute(
+            update(nodes_table)
+            .where(nodes_table.c.id == bindparam("b_id"))
+            .values(options=bindparam("b_options", type_=nodes_table.c.options.type)),
+            [{"b_id": node_id, "b_options": options} for node_id, options in remapped.items()],
+        )
+
+    # so does the story's shortest winning path (node ids from the root)
+    paths = [
+        {"b_id": story_id, "b_path": [node_ids[node_id] for node_id in record["shortest_winning_path"]]}
+        for record, story_id in zip(records, story_ids)
+        if record.get("shortest_winning_path") and all(node_id in node_ids for node_id in record["shortest_winning_path"])
+    ]
+    if paths:
+        db.execute(
+            update(stories_table)
+            .where(stories_table.c.id == bindparam("b_id"))
+            .values(shortest_winning_path=bindparam("b_path", type_=stories_table.c.shortest_winning_path.type)),
+            paths,
+        )
+
+    for record, story_id in zip(records, story_ids):
+        save_edges(db, story_id, [
+            SimpleNamespace(id=node_ids[node["id"]], options=remapped.get(node_ids[node["id"]]))
+            for node in record["nodes"]
+        ])
+
+    job_rows = [
+        _job_row(job, story_id)
+        for record, story_id in zip(records, story_ids)
+        for job in record["jobs"]
+    ]
+    if job_rows:
+        db.execute(insert(jobs_table), job_rows)
+
+    if index:
+        for record, story_id in zip(records, story_ids):
+            index_story(
+                db,
+                SimpleNamespace(id=story_id, title=record["title"]),
+                [SimpleNamespace(id=node_ids[node["id"]], content=node["content"]) for node in record["nodes"]],
+            )
+
+    db.commit()
+
+    counts["stories"] += len(records)
+    counts["nodes"] += len(node_rows)
+    counts["jobs"] += len(job_rows)
+
+
+def _import_jobs(db: Session, records: list[dict], counts: dict):
+    existing = _existing_job_ids(db, [record["job_id"] for record in records])
+    rows = [_job_row(record, None) for record in records if record["job_id"] not in existing]
+    if rows:
+        db.execute(insert(jobs_table), rows)
+        db.commit()
+    counts["jobs"] += len(rows)
+    counts["skipped_jobs"] += len(records) - len(rows)
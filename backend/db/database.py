@@ -1,12 +1,18 @@
-from sqlalchemy import create_engine
+import itertools
+
+from fastapi import HTTPException, Request, Response
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.orm import sessionmaker 
 from sqlalchemy.ext.declarative import declarative_base # base class for all the datamodels
 
 from core.config import settings
+from core.sql_stats import instrument_engine
+from db.sharding import HashRing, shard_of_id, shard_of_key
 
 engine = create_engine(
     settings.DATABASE_URL
 )
+instrument_engine(engine) # statement counts, slow query log (core/sql_stats.py)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -19,6 +25,120 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+# optional shards (DATABASE_SHARD_URLS, see db/sharding.py), shard 0 is engine / SessionLocal
+shard_engines = [engine, *(create_engine(url) for url in settings.DATABASE_SHARD_URLS)]
+for shard_engine in shard_engines[1:]:
+    instrument_engine(shard_engine)
+_shard_sessions = [SessionLocal, *(
+    sessionmaker(autocommit=False, autoflush=False, bind=shard_engine) for shard_engine in shard_engines[1:]
+)]
+_ring = HashRing(len(shard_engines))
+
+
+def shard_for_session(session_id: str) -> int:
+    # where a session's new jobs and stories go
+    return _ring.shard_for(session_id)
+
+
+def shard_session(shard: int):
+    if not 0 <= shard < len(_shard_sessions):
+        raise HTTPException(status_code=404, detail="Not found") # an id from a shard that doesn't exist
+    db = _shard_sessions[shard]()
+    db.info["shard"] = shard
+    return db
+
+
+def shard_of(db) -> int:
+    return db.info.get("shard", 0)
+
+
+def each_shard_session():
+    # for things that have to look at every shard (lists, search, background jobs), closes each one after its turn
+    for shard in range(len(_shard_sessions)):
+        db = shard_session(shard)
+        try:
+            yield db
+        finally:
+            db.close()
+
+
+def _close_after(db):
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+# the shard comes from the id in the path
+def get_story_db(story_id: int):
+    yield from _close_after(shard_session(shard_of_id(story_id)))
+
+
+def get_group_db(group_id: str):
+    yield from _close_after(shard_session(shard_of_key(group_id)))
+
+
+# optional read replicas (DATABASE_READ_URL), requests take turns between them.
+# writes always go to the primary (engine / SessionLocal, or the shard's own)
+read_engines = [create_engine(url) for url in settings.DATABASE_READ_URL]
+for read_engine in read_engines:
+    instrument_engine(read_engine)
+_read_sessions = [sessionmaker(autocommit=False, autoflush=False, bind=read_engine) for read_engine in read_engines]
+_next_replica = itertools.count()
+
+READ_PRIMARY_COOKIE = "read_primary"
+
+
+# like get_db, but for endpoints that only read. without replicas, or while the client is pinned
+# to the primary (pin_reads_to_primary), it's the same session get_db gives you
+def get_read_db(request: Request):
+    yield from _close_after(_read_session(request, 0))
+
+
+def get_story_read_db(story_id: int, request: Request):
+    yield from _close_after(_read_session(request, shard_of_id(story_id)))
+
+
+def get_job_read_db(job_id: str, request: Request):
+    yield from _close_after(_read_session(request, shard_of_key(job_id)))
+
+
+def _read_session(request: Request, shard: int):
+    # the replicas are replicas of DATABASE_URL, the other shards are read from their primary
+    if shard != 0 or not _read_sessions or request.cookies.get(READ_PRIMARY_COOKIE):
+        return shard_session(shard)
+    
+    db = _read_sessions[next(_next_replica) % len(_read_sessions)]()
+    db.info["replica"] = True
+    return db
+
+
+def is_replica(db) -> bool:
+    return db.info.get("replica", False)
+
+
+# replicas lag a bit behind, so a client that just created something reads from the primary for a little while
+def pin_reads_to_primary(response: Response):
+    if read_engines:
+        response.set_cookie(
+            key=READ_PRIMARY_COOKIE, value="1", max_age=settings.READ_YOUR_WRITES_SECONDS, httponly=True
+        )
+
         
 def create_tables():
-    Base.metadata.create_all(bind=engine)
\ No newline at end of file
+    # imported here, both of these need Base from this module
+    from db.migrations import upgrade_schema, upgrade_data, seed_shard_ids
+    from sqlalchemy.orm import Session
+    from core.search import ensure_search_index, rebuild_search_index
+    
+    for shard, shard_engine in enumerate(shard_engines):
+        existing_tables = set(inspect(shard_engine).get_table_names())
+        Base.metadata.create_all(bind=shard_engine)
+        new_columns = upgrade_schema(shard_engine)
+        seed_shard_ids(shard_engine, shard)
+        upgrade_data(shard_engine, {table.name for table in Base.metadata.sorted_tables} - existing_tables, new_columns)
+        if ensure_search_index(shard_engine): # not a model, the text index is database specific
+            with Session(shard_engine) as db:
+                rebuild_search_index(db)
\ No newline at end of file
@@ -0,0 +1,88 @@
+# there's no alembic in this project, create_all() only creates tables that don't exist yet,
+# so new columns and indexes on tables that already exist get added here
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateIndex
+
+from db.database import Base
+from db.sharding import SHARDED_ID_TABLES, id_base
+
+
+def upgrade_schema(engine: Engine) -> set[str]:
+    # returns the columns it added, as "table.column"
+    added = set()
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    preparer = engine.dialect.identifier_preparer
+    
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            
+            # added columns are always nullable, existing rows have nothing to put in them
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(
+                    f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} {column_type}"
+                ))
+                added.add(f"{table.name}.{column.name}")
+            
+            existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    conn.execute(CreateIndex(index))
+    
+    return added
+
+
+def upgrade_data(engine: Engine, new_tables: set[str], new_columns: set[str] = frozenset()):
+    # rows for tables that create_all() just made and that are derived from data already there.
+    # if this gets interrupted the cli has the same backfills (python cli.py backfill-edges)
+    from sqlalchemy.orm import Session
+    from core.story_graph import backfill_edges
+    
+    if "stories.completed_at" in new_columns:
+        # there's no telling which old stories' jobs finished (purged jobs left no trace), so they're all kept
+        with engine.begin() as conn:
+            conn.execute(text("UPDATE stories SET completed_at = created_at WHERE completed_at IS NULL"))
+    
+    if "story_edges" in new_tables:
+        with Session(engine) as db:
+            backfill_edges(db)
+
+
+def seed_shard_ids(engine: Engine, shard: int):
+    # story and node ids on shard k start at k << SHARD_ID_BITS, so an id alone says which database it's in
+    base = id_base(shard)
+    if not base:
+        return
+    
+    with engine.begin() as conn:
+        for table_name in SHARDED_ID_TABLES:
+            if engine.dialect.name == "postgresql":
+                conn.execute(text(
+                    f"SELECT setval(pg_get_serial_sequence('{table_name}', 'id'), "
+                    f"GREATEST((SELECT COALESCE(MAX(id), 0) FROM {table_name}), :base))"
+                ), {"base": base})
+                continue
+            
+            table_sql = conn.execute(
+                text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": table_name}
+            ).scalar()
+            if "AUTOINCREMENT" not in table_sql.upper():
+                raise RuntimeError(f"{table_name} on shard {shard} was created without AUTOINCREMENT, its ids can't be moved")
+            
+            conn.execute(text(
+                "INSERT INTO sqlite_sequence (name, seq) SELECT :name, 0 "
+                "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = :name)"
+            ), {"name": table_name})
+            conn.execute(
+                text("UPDATE sqlite_sequence SET seq = :base WHERE name = :name AND seq < :base"),
+                {"name": table_name, "base": base},
+            )
@@ -0,0 +1,61 @@
+# horizontal sharding of stories and jobs (DATABASE_SHARD_URLS)
+#
+# DATABASE_URL is shard 0, DATABASE_SHARD_URLS adds shards 1, 2, ... every shard has the whole schema.
+# a session's new jobs and stories go to the shard its session_id hashes to on a consistent hash ring, so adding a
+# shard only moves about 1/n of the sessions and their old stories stay where they are (lists and search ask every
+# shard). everything hanging off a story (nodes, edges, contents, payloads, search rows, playthroughs) lives with it.
+#
+# ids carry their shard, so a lookup goes straight to the right database:
+# - story and node ids on shard k start at k << SHARD_ID_BITS (the id sequences get moved there, db/migrations.py)
+# - job ids and group ids of shard k are "s<k>_<uuid>", a plain uuid is shard 0
+# ids from before sharding decode to shard 0, which is where they are
+
+import bisect
+import hashlib
+import uuid
+
+SHARD_ID_BITS = 40 # 2^40 ids per shard and still under 2^53, so javascript clients read them fine
+VIRTUAL_NODES = 100 # points per shard on the ring, evens out how many sessions each shard gets
+
+# integer ids that encode their shard (the tables whose ids get looked up by id alone)
+SHARDED_ID_TABLES = ("stories", "storynodes")
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+
+    def __init__(self, shard_count: int):
+        points = sorted(
+            (_hash(f"shard-{shard}-{point}"), shard)
+            for shard in range(shard_count)
+            for point in range(VIRTUAL_NODES)
+        )
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard_for(self, key: str) -> int:
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._shards[index]
+
+
+def id_base(shard: int) -> int:
+    return shard << SHARD_ID_BITS
+
+
+def shard_of_id(id: int) -> int:
+    return id >> SHARD_ID_BITS
+
+
+def make_key(shard: int) -> str:
+    # a new job / group id on this shard
+    return f"s{shard}_{uuid.uuid4()}" if shard else str(uuid.uuid4())
+
+
+def shard_of_key(key: str) -> int:
+    prefix, separator, _ = key.partition("_")
+    if separator and prefix[:1] == "s" and prefix[1:].isdigit():
+        return int(prefix[1:])
+    return 0
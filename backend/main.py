@@ -1,11 +1,56 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from core.config import settings # backend.core.config?
-from routers import story, job
+from core.maintenance import maintenance_loop
+from core.scheduler import scheduler
+from core.expansion import expansion_scheduler, run_expansions
+from core.leader import leader
+from core.leases import reaper_loop, stop_heartbeats
+from core.playthrough import playthrough_buffer
+from core.compression import CompressionMiddleware
+from core.sql_stats import SqlStatsMiddleware
+from routers import story, job, playthrough
 from db.database import create_tables
 
-create_tables()
+# no create_tables() here, every worker imports this module. python cli.py (serve or any other command) runs the
+# migrations once before starting anything, run it before uvicorn main:app too
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # workers that run the queued story generations, plus whatever a previous process left pending
+    scheduler.start(story.run_generation_batch)
+    # only one worker requeues, and another one again if it takes over (see core/leader.py)
+    leader.on_elected(story.requeue_pending_jobs)
+    await asyncio.to_thread(leader.is_leader)
+    expansion_scheduler.start(run_expansions, settings.ENDLESS_EXPANSION_WORKERS) # endless mode
+    playthrough_buffer.start()
+    
+    # background tasks that live as long as the app does
+    tasks = [asyncio.create_task(reaper_loop(settings.JOB_REAPER_INTERVAL_SECONDS))]
+    if settings.MAINTENANCE_INTERVAL_MINUTES > 0:
+        tasks.append(asyncio.create_task(maintenance_loop(settings.MAINTENANCE_INTERVAL_MINUTES)))
+    
+    yield
+    
+    for task in tasks:
+        task.cancel()
+    
+    # graceful drain: running generations get GRACEFUL_TIMEOUT_SECONDS to finish. the ones that don't are still
+    # calling the LLM, so they aren't put back to pending (that would generate them twice), their leases just
+    # stop being renewed and the reaper requeues them once they expire (JOB_LEASE_SECONDS)
+    unfinished = await asyncio.to_thread(scheduler.stop, settings.GRACEFUL_TIMEOUT_SECONDS)
+    if unfinished:
+        stop_heartbeats()
+    # expansions still running are picked up again by the next request for them (see core/expansion.py)
+    await asyncio.to_thread(expansion_scheduler.stop, settings.GRACEFUL_TIMEOUT_SECONDS)
+    await asyncio.to_thread(playthrough_buffer.stop) # last flush of the choices still in memory
+    leader.resign()
+
 
 app = FastAPI(
     title = "Choose your own adventure game API",
@@ -13,6 +58,7 @@ app = FastAPI(
     version = "0.1.0",
     docs_url = "/docs",
     redoc_url = "/redoc",
+    lifespan = lifespan,
 )
 
 app.add_middleware(
@@ -23,11 +69,19 @@ app.add_middleware(
     allow_headers = ["*"],
 )
 
+# gzip/brotli for everything over the threshold, precompressed story payloads pass through untouched
+app.add_middleware(CompressionMiddleware, minimum_size=settings.COMPRESSION_MINIMUM_SIZE)
+
+# statement count and db time per request, Server-Timing header when DEBUG is on
+app.add_middleware(SqlStatsMiddleware)
+
 app.include_router(story.router, prefix=settings.API_PREFIX)
 app.include_router(job.router, prefix=settings.API_PREFIX)
+app.include_router(playthrough.router, prefix=settings.API_PREFIX)
 
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app="main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    create_tables()
+    uvicorn.run(app="main:app", host="0.0.0.0", port=8000, reload=True)
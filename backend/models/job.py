@@ -9,7 +9,7 @@
 # if job is done, backend can send story
 # 
 
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Column, Integer, String, DateTime, Index, Boolean, Float
 from sqlalchemy.sql import func
 
 from db.database import Base 
@@ -26,5 +26,68 @@ class StoryJob(Base):
     error = Column(String, nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     completed_at = Column(DateTime(timezone=True), nullable=True)
+    group_id = Column(String, index=True, nullable=True) # jobs created together by /stories/create-batch
+    endless = Column(Boolean, nullable=True) # generate a shallow story that grows as it's played (see core/expansion.py)
     
-    
\ No newline at end of file
+    # lease of whoever is running the job (see core/leases.py), attempts counts how many times it was claimed
+    lease_owner = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime(timezone=True), nullable=True)
+    attempts = Column(Integer, nullable=True)
+    idempotency_key = Column(String, nullable=True) # Idempotency-Key header of /stories/create, unique per session
+    idempotency_hash = Column(String, nullable=True) # hash of the request body the key was first used with
+    
+    # maintenance scans are always "jobs with this status older than X", so this keeps them off a full table scan,
+    # the completed_at one is for the recent throughput used by admission control (core/rate_limit.py)
+    __table_args__ = (
+        Index("ix_story_jobs_status_created_at", "status", "created_at"),
+        Index("ix_story_jobs_status_completed_at", "status", "completed_at"),
+        Index("ix_story_jobs_status_lease_expires_at", "status", "lease_expires_at"), # the lease reaper
+        # NULLs never collide, so jobs created without a key aren't affected
+        Index("ix_story_jobs_session_idempotency_key", "session_id", "idempotency_key", unique=True),
+    )
+
+
+# old finished jobs get moved here by the maintenance task when archiving is turned on (see core/maintenance.py)
+class StoryJobArchive(Base):
+    __tablename__ = "story_jobs_archive"
+    
+    id = Column(Integer, primary_key=True)
+    job_id = Column(String, index=True)
+    session_id = Column(String, index=True)
+    theme = Column(String)
+    status = Column(String)
+    story_id = Column(Integer, nullable=True)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=True))
+    completed_at = Column(DateTime(timezone=True), nullable=True)
+    group_id = Column(String, nullable=True)
+    endless = Column(Boolean, nullable=True)
+    lease_owner = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime(timezone=True), nullable=True)
+    attempts = Column(Integer, nullable=True)
+    idempotency_key = Column(String, nullable=True)
+    idempotency_hash = Column(String, nullable=True)
+    archived_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+# what a generation run cost, one row per run of a job (a retried job has a row per attempt, see core/job_accounting.py).
+# kept apart from story_jobs so it can outlive purged jobs (JOB_USAGE_RETENTION_DAYS)
+class JobUsage(Base):
+    __tablename__ = "job_usage"
+    
+    id = Column(Integer, primary_key=True)
+    job_id = Column(String, index=True)
+    theme = Column(String)
+    model = Column(String, nullable=True)
+    status = Column(String) # completed, failed, or lost (the lease ran out and the result was dropped)
+    attempt = Column(Integer, nullable=True) # story_jobs.attempts when it ran, 1 is the first try
+    stories_in_call = Column(Integer) # > 1 for batched generations, their tokens and times are split evenly
+    prompt_tokens = Column(Integer, nullable=True)
+    output_tokens = Column(Integer, nullable=True)
+    llm_seconds = Column(Float)
+    parse_seconds = Column(Float)
+    db_seconds = Column(Float)
+    db_statements = Column(Integer)
+    node_count = Column(Integer, nullable=True)
+    peak_memory_bytes = Column(Integer, nullable=True) # only with JOB_ACCOUNTING_TRACE_MEMORY
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
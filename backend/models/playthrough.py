@@ -0,0 +1,22 @@
+# where a player is in a story, so they can pick it up again from the last node they reached.
+# written in batches by core/playthrough.py, never one row per click
+
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Index
+from sqlalchemy.sql import func
+
+from db.database import Base
+
+class PlaythroughProgress(Base):
+    __tablename__ = "playthrough_progress"
+    
+    id                  = Column(Integer, primary_key=True, index=True)
+    session_id          = Column(String, nullable=False)
+    story_id            = Column(Integer, ForeignKey("stories.id"), nullable=False, index=True)
+    current_node_id     = Column(Integer, nullable=False)
+    choices_made        = Column(Integer, default=0)
+    updated_at          = Column(DateTime(timezone=True), server_default=func.now())
+    
+    # one row per player and story, the flush upserts on it
+    __table_args__      = (
+        Index("ix_playthrough_progress_session_story", "session_id", "story_id", unique=True),
+    )
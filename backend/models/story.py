@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, JSON
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, JSON, Index, Float, LargeBinary
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 
@@ -11,16 +11,36 @@ class Story(Base):
     title               = Column(String, index=True)
     session_id          = Column(String, index=True)
     created_at          = Column(DateTime(timezone=True), server_default=func.now())
+    endless             = Column(Boolean, nullable=True) # leaves get expanded while it's played (see core/expansion.py)
+    # set when the job that generated it finished, stays after the job is purged. a story without it is from a
+    # generation that never finished (see collect_orphans in core/maintenance.py)
+    completed_at        = Column(DateTime(timezone=True), nullable=True)
+    
+    # graph stats, filled in by the generator (see core/story_stats.py)
+    max_depth               = Column(Integer, nullable=True)
+    node_count              = Column(Integer, nullable=True)
+    ending_count            = Column(Integer, nullable=True)
+    winning_ending_count    = Column(Integer, nullable=True)
+    shortest_winning_path   = Column(JSON, nullable=True)
+    branching_factor        = Column(Float, nullable=True)
     
     
     nodes               = relationship("StoryNode", back_populates="story")
     
+    # GET /stories pages through a session's stories newest first with a keyset on this index.
+    # ids on a shard start at its id base (db/sharding.py), sqlite only keeps a raised start with AUTOINCREMENT
+    __table_args__      = (
+        Index("ix_stories_session_created_id", "session_id", "created_at", "id"),
+        {"sqlite_autoincrement": True},
+    )
+    
 class StoryNode(Base):
     __tablename__ = "storynodes"
     
     id                  = Column(Integer, primary_key=True, index=True)
     story_id            = Column(Integer, ForeignKey("stories.id"), index=True)
-    content             = Column(String)
+    content             = Column(String, nullable=True) # only on nodes from before the content store
+    content_hash        = Column(String, ForeignKey("node_contents.hash"), nullable=True, index=True) # see core/content_store.py
     is_root             = Column(Boolean, default=False)
     is_ending           = Column(Boolean, default=False)
     is_winning_ending   = Column(Boolean, default=False)
@@ -29,4 +49,66 @@ class StoryNode(Base):
     
     story               = relationship("Story", back_populates="nodes")
     
-    
\ No newline at end of file
+    __table_args__      = {"sqlite_autoincrement": True} # same as stories, node ids carry their shard too
+
+
+# the /stories/{id}/complete response, serialized and compressed once per encoding (see core/story_payloads.py)
+class StoryPayload(Base):
+    __tablename__ = "story_payloads"
+    
+    story_id            = Column(Integer, ForeignKey("stories.id"), primary_key=True)
+    encoding            = Column(String, primary_key=True) # br, gzip or identity
+    body                = Column(LargeBinary, nullable=False)
+    etag                = Column(String, nullable=False)
+    created_at          = Column(DateTime(timezone=True), server_default=func.now())
+
+
+# node text, compressed and stored once per distinct text (see core/content_store.py)
+class NodeContent(Base):
+    __tablename__ = "node_contents"
+    
+    hash                = Column(String, primary_key=True) # sha256 of the text
+    codec               = Column(String, nullable=False) # raw, deflate or zstd, ":<dictionary id>" when one was used
+    body                = Column(LargeBinary, nullable=False)
+    size                = Column(Integer, nullable=False) # uncompressed bytes
+    created_at          = Column(DateTime(timezone=True), server_default=func.now())
+    last_used_at        = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+
+
+# compression dictionaries trained on our own node texts, rows are never changed so old content stays readable
+class ContentDictionary(Base):
+    __tablename__ = "content_dictionaries"
+    
+    id                  = Column(Integer, primary_key=True)
+    codec               = Column(String, nullable=False)
+    data                = Column(LargeBinary, nullable=False)
+    created_at          = Column(DateTime(timezone=True), server_default=func.now())
+
+
+# endless mode: one row per leaf that got (or is getting) expanded, so each leaf is only expanded once
+class NodeExpansion(Base):
+    __tablename__ = "node_expansions"
+    
+    node_id             = Column(Integer, ForeignKey("storynodes.id"), primary_key=True)
+    story_id            = Column(Integer, ForeignKey("stories.id"), index=True)
+    status              = Column(String, nullable=False) # queued, running, done or failed
+    priority            = Column(Integer, nullable=False) # scheduler priority class it's queued with
+    error               = Column(String, nullable=True)
+    updated_at          = Column(DateTime(timezone=True), server_default=func.now())
+
+
+# the choices out of options as rows, so the graph can be indexed and walked in sql (see core/story_graph.py).
+# options stays the source of truth for clients, the generator writes both
+class StoryEdge(Base):
+    __tablename__ = "story_edges"
+    
+    id                  = Column(Integer, primary_key=True)
+    story_id            = Column(Integer, ForeignKey("stories.id"), nullable=False, index=True)
+    from_node_id        = Column(Integer, ForeignKey("storynodes.id"), nullable=False)
+    to_node_id          = Column(Integer, ForeignKey("storynodes.id"), nullable=False, index=True) # "what leads here"
+    ordinal             = Column(Integer, nullable=False) # position in options
+    text                = Column(String)
+    
+    __table_args__      = (
+        Index("ix_story_edges_from_node_ordinal", "from_node_id", "ordinal", unique=True),
+    )
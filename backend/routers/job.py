@@ -1,11 +1,20 @@
+import hmac
 import uuid
 from typing import Optional
-from fastapi import APIRouter, Depends, HTTPException, Cookie
+from fastapi import APIRouter, Depends, HTTPException, Cookie, Header, Query
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 
-from db.database import get_db
+from db.database import each_shard_session, get_group_db, get_job_read_db, is_replica, shard_session
+from db.sharding import shard_of_key
 from models.job import StoryJob
-from schemas.job import StoryJobResponse
+from schemas.job import StoryJobResponse, StoryJobGroupResponse, JobUsageStatsResponse
+from core.scheduler import scheduler
+from core.job_cache import job_status_cache, FINISHED_STATUSES
+from core.throughput import generation_throughput
+from core.llm_guard import llm_guard
+from core.job_accounting import usage_stats
+from core.config import settings
 
 
 router = APIRouter(
@@ -13,11 +22,89 @@ router = APIRouter(
     tags=["jobs"]
 )
 
+
+def require_admin(x_admin_token: str | None = Header(None)):
+    # for the endpoints that show more than a player should see (ADMIN_TOKEN)
+    if not settings.ADMIN_TOKEN or not x_admin_token or not hmac.compare_digest(x_admin_token, settings.ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Not allowed")
+
+
+# queue depth and wait time per session, to check that the scheduler is actually being fair under load,
+# plus stories per minute / per 1k tokens to see what batching buys us, and the LLM call queue / breaker state.
+# it shows other sessions' queues, so it's for operators only
+@router.get("/scheduler/stats", dependencies=[Depends(require_admin)])
+def get_scheduler_stats():
+    return {
+        **scheduler.stats(),
+        "throughput": generation_throughput.snapshot(),
+        "llm": llm_guard.stats(),
+    }
+
+
+# what generations cost per theme and model (tokens, LLM / parse / db time, nodes, memory), for capacity planning.
+# themes are free text from players, so it's for operators only
+@router.get("/usage/stats", response_model=JobUsageStatsResponse, dependencies=[Depends(require_admin)])
+def get_job_usage_stats(
+    since_hours: int = Query(24 * 7, ge=1),
+    max_groups: int = Query(50, ge=1, le=500)
+):
+    return usage_stats(each_shard_session(), since_hours, max_groups) # every shard's jobs
+
+
+@router.get("/groups/{group_id}", response_model=StoryJobGroupResponse)
+def get_job_group_status(group_id: str, db: Session = Depends(get_group_db)):
+    # counted in the database (group_id index) instead of loading every job of the group
+    counts = dict(
+        db.query(StoryJob.status, func.count())
+        .filter(StoryJob.group_id == group_id)
+        .group_by(StoryJob.status)
+        .all()
+    )
+    
+    if not counts:
+        raise HTTPException(status_code=404, detail="Job group not found.")
+    
+    story_ids = [
+        story_id for (story_id,) in
+        db.query(StoryJob.story_id)
+        .filter(StoryJob.group_id == group_id, StoryJob.story_id.isnot(None))
+        .order_by(StoryJob.id)
+        .all()
+    ]
+    
+    total = sum(counts.values())
+    return StoryJobGroupResponse(
+        group_id=group_id,
+        total=total,
+        pending=counts.get("pending", 0),
+        processing=counts.get("processing", 0),
+        completed=counts.get("completed", 0),
+        failed=counts.get("failed", 0),
+        finished=counts.get("completed", 0) + counts.get("failed", 0) == total,
+        story_ids=story_ids
+    )
+
+
 @router.get("/{job_id}", response_model=StoryJobResponse)
-def get_job_status(job_id: str, db: Session = Depends(get_db)):
+def get_job_status(job_id: str, db: Session = Depends(get_job_read_db)):
+    # every status change is written through to the cache, so polls normally end here
+    cached = job_status_cache.get(job_id)
+    if cached:
+        return cached
+    
     job = db.query(StoryJob).filter(StoryJob.job_id == job_id).first()
+    
+    if not job and is_replica(db):
+        # the replica might just not have it yet
+        with shard_session(shard_of_key(job_id)) as primary:
+            job = primary.query(StoryJob).filter(StoryJob.job_id == job_id).first()
 
     if not job:
         raise HTTPException(status_code=404, detail="Job not found.")
     
+    # evicted or expired from the cache. only finished jobs go back in on a read, a replica could be behind
+    # on an unfinished one and overwrite the newer status the generation task wrote
+    if job.status in FINISHED_STATUSES:
+        job_status_cache.put(job)
+    
     return job
\ No newline at end of file
@@ -0,0 +1,72 @@
+from fastapi import APIRouter, Depends, HTTPException, Cookie, Response
+from sqlalchemy.orm import Session
+
+from db.database import get_story_db
+from models.story import StoryNode
+from models.playthrough import PlaythroughProgress
+from schemas.playthrough import RecordChoiceRequest, PlaythroughResponse
+from core.playthrough import playthrough_buffer
+from routers.story import get_session_id
+
+
+router = APIRouter(
+    prefix="/playthroughs",
+    tags=["playthroughs"]
+)
+
+
+@router.post("/{story_id}/choices", response_model=PlaythroughResponse, status_code=202)
+def record_choice(
+    story_id: int,
+    request: RecordChoiceRequest,
+    response: Response,
+    session_id: str = Depends(get_session_id),
+    db: Session = Depends(get_story_db)
+):
+    response.set_cookie(key="session_id", value=session_id, httponly=True)
+    
+    # a primary key read to check the choice is real, the write itself goes through the buffer
+    from_node = (
+        db.query(StoryNode.options)
+        .filter(StoryNode.id == request.from_node_id, StoryNode.story_id == story_id)
+        .first()
+    )
+    if not from_node:
+        raise HTTPException(status_code=404, detail="Story node not found")
+    
+    if not any(option.get("node_id") == request.to_node_id for option in from_node.options or []):
+        raise HTTPException(status_code=400, detail="That choice isn't an option of this node")
+    
+    pending = playthrough_buffer.record(session_id, story_id, request.to_node_id)
+    
+    # choices_made only counts what's still in the buffer here, the stored count is added on GET
+    return PlaythroughResponse(
+        story_id=story_id,
+        current_node_id=pending.current_node_id,
+        choices_made=pending.choices_made,
+        updated_at=pending.updated_at
+    )
+
+
+@router.get("/{story_id}", response_model=PlaythroughResponse)
+def get_playthrough(story_id: int, session_id: str | None = Cookie(None), db: Session = Depends(get_story_db)):
+    if not session_id:
+        raise HTTPException(status_code=404, detail="Playthrough not found")
+    
+    stored = (
+        db.query(PlaythroughProgress)
+        .filter(PlaythroughProgress.session_id == session_id, PlaythroughProgress.story_id == story_id)
+        .first()
+    )
+    # choices that haven't been flushed yet are newer than what's stored
+    pending = playthrough_buffer.get(session_id, story_id)
+    
+    if not stored and not pending:
+        raise HTTPException(status_code=404, detail="Playthrough not found")
+    
+    return PlaythroughResponse(
+        story_id=story_id,
+        current_node_id=pending.current_node_id if pending else stored.current_node_id,
+        choices_made=(stored.choices_made if stored else 0) + (pending.choices_made if pending else 0),
+        updated_at=pending.updated_at if pending else stored.updated_at
+    )
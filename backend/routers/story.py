@@ -1,17 +1,45 @@
 import uuid
+import base64
+import hashlib
+import math
+import threading
+from contextlib import nullcontext
 from typing import Optional
-from datetime import datetime
-from fastapi import APIRouter, Depends, HTTPException, Cookie, Response, BackgroundTasks
+from datetime import datetime, timedelta, timezone
+from fastapi import APIRouter, Depends, HTTPException, Cookie, Header, Response, Query, Request
+from sqlalchemy import String, literal, select, tuple_, type_coerce
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
-from db.database import get_db, SessionLocal
+from db.database import (
+    each_shard_session, get_story_db, get_story_read_db, is_replica, pin_reads_to_primary,
+    shard_for_session, shard_of, shard_session
+)
+from db.sharding import make_key, shard_of_id, shard_of_key
 from models.story import Story, StoryNode
 from models.job import StoryJob
 from schemas.story import (
-    CompleteStoryResponse, CompleteStoryNodeResponse, CreateStoryRequest
+    CompleteStoryResponse, CompleteStoryNodeResponse, CreateStoryRequest, CreateStoryBatchRequest,
+    StoryListResponse, StorySummaryResponse, StoryStatsResponse, StorySearchResponse, StorySearchHit,
+    NodeExpansionResponse, StoryPathResponse, StoryPathStep, StorySubtreeResponse, StoryReachabilityResponse
 )
-from schemas.job import StoryJobResponse
+from schemas.job import StoryJobResponse, StoryJobBatchResponse
+from core.config import settings
 from core.story_generator import StoryGenerator
+from core.rate_limit import admission
+from core.scheduler import scheduler, GenerationRequest
+from core.story_stats import compute_story_stats, apply_story_stats
+from core.search import search_stories
+from core.compression import negotiate_encoding
+from core.story_payloads import get_story_payload, IDENTITY
+from core.leases import claim_jobs, finish_job, cache_jobs, release_jobs, Heartbeat
+from core.llm_guard import llm_guard, LLMUnavailable
+from core.sql_stats import track
+from core.job_accounting import account, save_job_usage
+from core.job_cache import job_status_cache
+from core.content_store import load_node_contents
+from core.expansion import expansion_in_progress, is_expandable, request_expansion, prefetch_children
+from core.story_graph import path_to_root, subtree_node_ids, is_reachable
 
 
 router = APIRouter(
@@ -26,90 +54,571 @@ def get_session_id(session_id: str | None = Cookie(None)) -> str:
     return session_id
 
 
+def client_rate_key(request: Request, session_id: str | None = Cookie(None)) -> str:
+    # who the rate limit counts against. a client that drops the cookie would get a new session (and a full
+    # bucket) on every request, so without one it's counted by address
+    if session_id:
+        return f"session:{session_id}"
+    return f"client:{request.client.host if request.client else 'unknown'}"
+
+
+def get_session_db(session_id: str = Depends(get_session_id)):
+    # the shard the session's new jobs and stories go to (db/sharding.py)
+    db = shard_session(shard_for_session(session_id))
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+# the caller's stories, newest first.
+# keyset pagination: the cursor is the last story of the previous page and the next page starts right after it
+# on the (session_id, created_at, id) index, so every page costs the same no matter how deep you go.
+# a session's stories can be on more than one shard (after a shard was added), each one gives its next page
+# and they get merged
+@router.get("", response_model=StoryListResponse)
+def list_stories(
+    cursor: str | None = None,
+    limit: int = Query(20, ge=1, le=100),
+    session_id: str | None = Cookie(None)
+):
+    if not session_id:
+        return StoryListResponse(items=[])
+    
+    after = None
+    if cursor:
+        after_id = decode_story_cursor(cursor)
+        # created_at is read back from the row itself (as stored, without conversion), so it compares in
+        # whatever format the databases stored it
+        with shard_session(shard_of_id(after_id)) as db:
+            after_created_at = db.scalar(select(type_coerce(Story.created_at, String)).where(Story.id == after_id))
+        if after_created_at is None:
+            return StoryListResponse(items=[])
+        after = tuple_(literal(after_created_at), after_id)
+    
+    rows = []
+    for db in each_shard_session():
+        query = (
+            db.query(Story.id, Story.title, Story.created_at)
+            .filter(Story.session_id == session_id)
+        )
+        if after is not None:
+            query = query.filter(tuple_(Story.created_at, Story.id) < after)
+        rows += query.order_by(Story.created_at.desc(), Story.id.desc()).limit(limit + 1).all()
+    
+    rows.sort(key=lambda row: (row.created_at, row.id), reverse=True)
+    
+    items = [StorySummaryResponse.model_validate(row) for row in rows[:limit]]
+    next_cursor = encode_story_cursor(items[-1].id) if len(rows) > limit else None
+    
+    return StoryListResponse(items=items, next_cursor=next_cursor)
+
+
+# indexed full-text lookup (FTS5 on sqlite, tsvector + GIN on postgres) instead of LIKE over storynodes.content.
+# every shard gets searched, ranks come from each shard's own index so they're close but not exact across shards
+@router.get("/search", response_model=StorySearchResponse)
+def search(
+    q: str = Query(min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=50)
+):
+    hits = [hit for db in each_shard_session() for hit in search_stories(db, q, limit)]
+    hits.sort(key=lambda hit: hit["rank"], reverse=True)
+    return StorySearchResponse(items=[StorySearchHit(**hit) for hit in hits[:limit]])
+
+
+def encode_story_cursor(story_id: int) -> str:
+    return base64.urlsafe_b64encode(str(story_id).encode()).decode().rstrip("=")
+
+
+def decode_story_cursor(cursor: str) -> int:
+    try:
+        return int(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
 @router.post("/create", response_model=StoryJobResponse)
 def create_story(
     request: CreateStoryRequest,
-    background_tasks: BackgroundTasks,
     response: Response,
     session_id: str = Depends(get_session_id), # Depends() runs the function anytime the endpoint is hit
-    db: Session = Depends(get_db)
+    rate_key: str = Depends(client_rate_key),
+    idempotency_key: str | None = Header(None, alias="Idempotency-Key"),
+    db: Session = Depends(get_session_db)
 ):
     response.set_cookie(key="session_id", value=session_id, httponly=True) # stores what our session id actually is, so that we can use it later
+    pin_reads_to_primary(response) # the status polls that follow have to find the job
+    
+    # clients retry on flaky networks, a retry with the same key gets the job the first request created
+    # (before admission, a retry shouldn't use up the session's rate limit either)
+    if idempotency_key is not None:
+        if not idempotency_key or len(idempotency_key) > settings.IDEMPOTENCY_KEY_MAX_LENGTH:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Idempotency-Key must be 1 to {settings.IDEMPOTENCY_KEY_MAX_LENGTH} characters."
+            )
+    
+    # the key stands for this exact request, reusing it for a different one is a client bug
+    request_hash = hashlib.sha256(request.model_dump_json().encode()).hexdigest()
+    expired = None
+    if idempotency_key:
+        existing = find_idempotent_job(db, session_id, idempotency_key)
+        if existing:
+            previous, fresh = existing
+            if fresh:
+                return replay_idempotent_job(response, previous, request_hash)
+            expired = previous
+    
+    check_llm_available()
+    
+    # every job is a full LLM generation, so check the rate limits and the backlog before queuing another one
+    decision = admission.admit(rate_key)
+    if not decision.allowed:
+        raise HTTPException(
+            status_code=429,
+            detail=decision.reason,
+            headers={"Retry-After": str(decision.retry_after)}
+        )
     
-    job_id = str(uuid.uuid4())
+    job_id = make_key(shard_of(db)) # the id says which shard the job is on
     
     job = StoryJob(
         job_id=job_id,
         session_id=session_id,
         theme=request.theme, # ?
-        status="pending" # hardcoded
+        status="pending", # hardcoded
+        idempotency_key=idempotency_key,
+        idempotency_hash=request_hash if idempotency_key else None,
+        endless=request.endless or None
     )
     
+    if expired is not None:
+        # past the ttl the key counts as new, it's freed in the same commit so the unique index lets the new job in
+        expired.idempotency_key = None
+        expired.idempotency_hash = None
+        db.flush()
     db.add(job) # staging the change
-    db.commit() # commititng the change
     
-    background_tasks.add_task(
-        generate_story_task,
+    try:
+        db.commit() # commititng the change
+    except IntegrityError:
+        # two requests with the same key raced past the lookup, the unique index let only one of them in
+        db.rollback()
+        existing = find_idempotent_job(db, session_id, idempotency_key) if idempotency_key else None
+        if existing is None or not existing[1]:
+            raise
+        return replay_idempotent_job(response, existing[0], request_hash)
+    
+    job_status_cache.put(job) # so the first polls don't miss
+    
+    # the scheduler takes turns between sessions, so one session queuing lots of stories doesn't starve the rest
+    scheduler.submit(GenerationRequest(
         job_id = job_id,
         theme = request.theme,
-        session_id = session_id
-    )
+        session_id = session_id,
+        endless = request.endless
+    ))
     
     
     return job
 
 
+def check_llm_available():
+    # while the LLM circuit breaker is open a new job would only sit in the queue, the client can come back later
+    retry_after = llm_guard.retry_after()
+    if retry_after:
+        raise HTTPException(
+            status_code=503,
+            detail="Story generation is unavailable right now, try again later.",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+
+
+def find_idempotent_job(db: Session, session_id: str, idempotency_key: str) -> tuple[StoryJob, bool] | None:
+    # one lookup on the (session_id, idempotency_key) unique index, (job, fresh) or None.
+    # past the ttl (not fresh) the key counts as new, create_story frees it when it stores the new job
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=settings.IDEMPOTENCY_KEY_TTL_HOURS)
+    row = db.execute(
+        select(StoryJob, (StoryJob.created_at >= cutoff).label("fresh"))
+        .where(StoryJob.session_id == session_id, StoryJob.idempotency_key == idempotency_key)
+    ).first()
+    return (row[0], bool(row[1])) if row else None
+
+
+def replay_idempotent_job(response: Response, job: StoryJob, request_hash: str) -> StoryJob:
+    # jobs from before the hash existed don't have one, they replay like they used to
+    if job.idempotency_hash is not None and job.idempotency_hash != request_hash:
+        raise HTTPException(status_code=422, detail="This Idempotency-Key was already used with a different request.")
+    response.headers["Idempotent-Replayed"] = "true"
+    return job
+
+
+# many stories at once (events, classroom packs, seeding): all the jobs go in with a single commit
+# under a shared group id, progress for the whole group is at GET /jobs/groups/{group_id}
+@router.post("/create-batch", response_model=StoryJobBatchResponse)
+def create_story_batch(
+    request: CreateStoryBatchRequest,
+    response: Response,
+    session_id: str = Depends(get_session_id),
+    rate_key: str = Depends(client_rate_key),
+    db: Session = Depends(get_session_db)
+):
+    response.set_cookie(key="session_id", value=session_id, httponly=True)
+    pin_reads_to_primary(response)
+    
+    if len(request.themes) > settings.MAX_STORY_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"A batch can have at most {settings.MAX_STORY_BATCH_SIZE} themes.")
+    
+    check_llm_available()
+    
+    # one token per story, same limits as creating them one by one
+    decision = admission.admit(rate_key, cost=len(request.themes))
+    if not decision.allowed:
+        raise HTTPException(
+            status_code=429,
+            detail=decision.reason,
+            headers={"Retry-After": str(decision.retry_after)}
+        )
+    
+    # the group and all its jobs are on the session's shard
+    group_id = make_key(shard_of(db))
+    
+    jobs = [
+        StoryJob(
+            job_id=make_key(shard_of(db)),
+            session_id=session_id,
+            theme=theme,
+            status="pending",
+            group_id=group_id
+        )
+        for theme in request.themes
+    ]
+    
+    db.add_all(jobs)
+    db.commit() # one transaction for the whole batch
+    
+    # the commit expired every job, reload them in one query instead of one refresh per job
+    jobs = db.query(StoryJob).filter(StoryJob.group_id == group_id).order_by(StoryJob.id).all()
+    job_status_cache.put_many(jobs)
+    
+    for job in jobs:
+        scheduler.submit(GenerationRequest(
+            job_id = job.job_id,
+            theme = job.theme,
+            session_id = session_id
+        ))
+    
+    return StoryJobBatchResponse(group_id=group_id, jobs=jobs)
+
+
 # you will never want to be accessing the exact same object across threads (in the async context/world)
 
 
-def generate_story_task(job_id: str, theme: str, session_id: str):
+# what the scheduler's worker threads run (started in main.py)
+def run_generation_batch(requests: list[GenerationRequest]):
+    # the LLM is down (breaker open), no point claiming the jobs just to fail them
+    retry_after = llm_guard.retry_after()
+    if retry_after:
+        defer_requests(requests, retry_after)
+        return
+    
+    # endless stories have their own prompt, they never share a call.
+    # each call is a unit for the sql stats (core/sql_stats.py), like a request is
+    for request in [r for r in requests if r.endless]:
+        with track(f"job {request.job_id}"):
+            generate_story_task(request.job_id, request.theme, request.session_id, endless=True)
+    
+    # a shared call saves its stories in one transaction, so only jobs of the same shard go together
+    by_shard: dict[int, list[GenerationRequest]] = {}
+    for request in requests:
+        if not request.endless:
+            by_shard.setdefault(shard_of_key(request.job_id), []).append(request)
+    
+    for requests in by_shard.values():
+        if len(requests) == 1:
+            with track(f"job {requests[0].job_id}"):
+                generate_story_task(requests[0].job_id, requests[0].theme, requests[0].session_id)
+        else:
+            with track(f"job batch of {len(requests)} ({requests[0].job_id}, ...)"):
+                generate_story_batch_task(requests)
+
+
+def generate_story_task(job_id: str, theme: str, session_id: str, endless: bool = False):
 
     # problems will arise if you use the same db session on all api-endpoints,
-    # there's gonna be some hanging operations left in the background 
-    db = SessionLocal()
+    # there's gonna be some hanging operations left in the background.
+    # the story goes on the job's shard
+    db = shard_session(shard_of_key(job_id))
     
     try:
-        job = db.query(StoryJob).filter(StoryJob.job_id == job_id).first()
-        
-        if not job:
+        # pending -> processing only if nobody else got it first (another worker, or a requeue after a restart)
+        if not claim_jobs(db, [job_id]):
             return
         
-        try:
-            job.status = "processing"
-            db.commit()
+        # the heartbeat keeps the lease alive while the LLM works, if this process dies the reaper takes the job back
+        # lost: the lease ran out before the job could be finished, whoever has it now records their own run
+        unavailable, story_id, status = None, None, "lost"
+        with Heartbeat([job_id]), account() as usage:
+            try:
+                # completes the job in the same commit, unless the lease was lost (then there's no story)
+                story = StoryGenerator.generate_story(db, session_id, theme, endless=endless, job_id=job_id)
+                if story:
+                    story_id, status = story.id, "completed"
+                    cache_jobs(db, [job_id])
             
-            story = StoryGenerator.generate_story(db, session_id, theme)
+            except LLMUnavailable as e:
+                db.rollback()
+                unavailable = e
             
-            job.story_id = story.id
-            job.status = "completed"
-            job.completed_at = datetime.now()
-            db.commit()
+            except Exception as e:
+                db.rollback()
+                if finish_job(db, job_id, error=str(e)):
+                    status = "failed"
         
-        except Exception as e:
-            job.status = "failed"
-            job.completed_at = datetime.now()
-            job.error = str(e)
-            db.commit()
+        # what the run cost, deferred runs never reached the LLM so there's nothing to count
+        if not unavailable:
+            save_job_usage(db, usage, [(job_id, theme, story_id, status)])
+        
+        if unavailable:
+            release_jobs([job_id])
+            defer_requests(
+                [GenerationRequest(job_id=job_id, theme=theme, session_id=session_id, endless=endless)],
+                unavailable.retry_after
+            )
     
     finally:
         db.close()
+
+
+def defer_requests(requests: list[GenerationRequest], delay: float):
+    # the jobs stay (or went back to) pending and get queued again once the LLM might be back.
+    # if the process stops first, requeue_pending_jobs picks them up on the next start
+    timer = threading.Timer(delay, lambda: [scheduler.submit(request) for request in requests])
+    timer.daemon = True
+    timer.start()
+
+
+def requeue_pending_jobs() -> int:
+    # jobs still pending when the process starts were queued by a process that's gone (or drained),
+    # the claim in generate_story_task makes it harmless if another worker queues them too
+    pending = []
+    for db in each_shard_session():
+        pending += (
+            db.query(StoryJob.job_id, StoryJob.theme, StoryJob.session_id, StoryJob.endless)
+            .filter(StoryJob.status == "pending")
+            .order_by(StoryJob.created_at)
+            .all()
+        )
+    
+    for job_id, theme, session_id, endless in pending:
+        scheduler.submit(GenerationRequest(job_id=job_id, theme=theme, session_id=session_id, endless=bool(endless)))
+    
+    return len(pending)
+
+
+# same as generate_story_task, but all the themes go to the LLM in one call (the jobs are all on one shard)
+def generate_story_batch_task(requests: list[GenerationRequest]):
+    db = shard_session(shard_of_key(requests[0].job_id))
+    
+    try:
+        claimed = claim_jobs(db, [r.job_id for r in requests])
+        requests = [r for r in requests if r.job_id in claimed]
+        
+        if not requests:
+            return
+        
+        deferred: list[GenerationRequest] = []
+        with Heartbeat([r.job_id for r in requests]), account() as usage:
+            try:
+                results = StoryGenerator.generate_stories(
+                    db, [(r.session_id, r.theme) for r in requests], job_ids=[r.job_id for r in requests]
+                )
+            except Exception as e:
+                db.rollback() # don't keep half saved stories around
+                results = [e] * len(requests)
             
+            finished = [] # (job id, theme, story id, status) for the accounting
+            for request, result in zip(requests, results):
+                if isinstance(result, LLMUnavailable):
+                    deferred.append(request) # the LLM never saw it, not the job's fault
+                elif isinstance(result, Exception):
+                    failed = finish_job(db, request.job_id, error=str(result))
+                    finished.append((request.job_id, request.theme, None, "failed" if failed else "lost"))
+                elif result is None: # the lease was lost, the job belongs to someone else now
+                    finished.append((request.job_id, request.theme, None, "lost"))
+                else:
+                    finished.append((request.job_id, request.theme, result.id, "completed"))
+            cache_jobs(db, [job_id for job_id, _, _, status in finished if status == "completed"])
+        
+        save_job_usage(db, usage, finished)
+        
+        if deferred:
+            release_jobs([r.job_id for r in deferred])
+            defer_requests(deferred, max(e.retry_after for e in results if isinstance(e, LLMUnavailable)))
+    
+    finally:
+        db.close()
+
 
 @router.get("/{story_id}/complete", response_model=CompleteStoryResponse)
-def get_complete_story(story_id: int, db: Session = Depends(get_db)):
-    story = db.query(Story).filter(Story.id == story_id).first()
-    if not story:
+def get_complete_story(story_id: int, request: Request, db: Session = Depends(get_story_read_db)):
+    encoding = negotiate_encoding(request.headers.get("accept-encoding"))
+    
+    # on a replica, the first request still has to store the payloads on the primary. the session only
+    # connects once it's used, so requests served from story_payloads never touch the primary
+    with shard_session(shard_of_id(story_id)) if is_replica(db) else nullcontext(db) as write_db:
+        
+        # only runs the first time, after that the (compressed) bytes come from story_payloads or memory
+        def build() -> bytes:
+            source = db
+            story = db.query(Story).filter(Story.id == story_id).first()
+            if not story and write_db is not db:
+                # generated a moment ago, not on the replica yet
+                source = write_db
+                story = write_db.query(Story).filter(Story.id == story_id).first()
+            if not story:
+                raise HTTPException(status_code=404, detail="Story not found")
+            
+            complete_story = build_complete_story_tree(source, story)
+            
+            return complete_story.model_dump_json().encode()
+        
+        payload = get_story_payload(db, story_id, encoding, build, write_db=write_db)
+    
+    headers = {"ETag": payload.etag, "Vary": "Accept-Encoding"}
+    if request.headers.get("if-none-match") == payload.etag:
+        return Response(status_code=304, headers=headers)
+    
+    if payload.encoding != IDENTITY:
+        headers["Content-Encoding"] = payload.encoding
+    
+    return Response(content=payload.body, media_type="application/json", headers=headers)
+
+
+
+# precomputed when the story was generated, so this is a single row read and the nodes never get loaded
+@router.get("/{story_id}/stats", response_model=StoryStatsResponse)
+def get_story_stats(story_id: int, db: Session = Depends(get_story_db)):
+    row = (
+        db.query(
+            Story.id, Story.max_depth, Story.node_count, Story.ending_count,
+            Story.winning_ending_count, Story.shortest_winning_path, Story.branching_factor
+        )
+        .filter(Story.id == story_id)
+        .first()
+    )
+    if not row:
         raise HTTPException(status_code=404, detail="Story not found")
     
+    if row.node_count is None:
+        # stories from before the stats existed get them computed (and stored) the first time someone asks
+        story = db.get(Story, story_id)
+        nodes = db.query(StoryNode).filter(StoryNode.story_id == story_id).all()
+        try:
+            apply_story_stats(story, compute_story_stats(nodes))
+        except ValueError:
+            raise HTTPException(status_code=500, detail="Story root node not found")
+        db.commit()
+        row = story
+    
+    return StoryStatsResponse(
+        story_id=row.id,
+        max_depth=row.max_depth,
+        node_count=row.node_count,
+        ending_count=row.ending_count,
+        winning_ending_count=row.winning_ending_count,
+        shortest_winning_path=row.shortest_winning_path,
+        branching_factor=row.branching_factor
+    )
+
+
+# endless mode: the client calls this for the node the player is on. a leaf gets expanded (202 until it's done,
+# poll again), and the nodes the player can go to next get prefetched so the next call is usually an instant 200
+@router.post("/{story_id}/nodes/{node_id}/expand", response_model=NodeExpansionResponse)
+def expand_story_node(
+    story_id: int,
+    node_id: int,
+    response: Response,
+    session_id: str = Depends(get_session_id),
+    rate_key: str = Depends(client_rate_key),
+    db: Session = Depends(get_story_db)
+):
+    story = db.query(Story).filter(Story.id == story_id).first()
+    node = db.query(StoryNode).filter(StoryNode.id == node_id, StoryNode.story_id == story_id).first()
+    if not story or not node:
+        raise HTTPException(status_code=404, detail="Story node not found")
+    
+    if not is_expandable(node):
+        if story.endless:
+            prefetch_children(db, node, session_id)
+        load_node_contents(db, [node])
+        return NodeExpansionResponse(node_id=node.id, status="ready", node=CompleteStoryNodeResponse.model_validate(node))
+    
+    if not story.endless:
+        raise HTTPException(status_code=409, detail="Only endless stories can be expanded.")
+    if (story.node_count or 0) >= settings.ENDLESS_MAX_NODES:
+        raise HTTPException(status_code=409, detail="This story can't grow any further.")
+    
+    # polling a leaf that's already being expanded is free, starting a new expansion (an LLM call) takes a token
+    # from the client and one from the story
+    if not expansion_in_progress(db, node.id):
+        decision = admission.admit_expansion(rate_key, story.id)
+        if not decision.allowed:
+            raise HTTPException(
+                status_code=429,
+                detail=decision.reason,
+                headers={"Retry-After": str(decision.retry_after)}
+            )
     
-    complete_story = build_complete_story_tree(db, story)
+    expansion = request_expansion(db, node, session_id)
     
-    return complete_story
+    response.status_code = 202
+    return NodeExpansionResponse(
+        node_id=node.id,
+        status="failed" if expansion.status == "failed" else "pending",
+        error=expansion.error
+    )
+
+
+def _story_node_or_404(db: Session, story_id: int, node_id: int):
+    if not db.query(StoryNode.id).filter(StoryNode.id == node_id, StoryNode.story_id == story_id).first():
+        raise HTTPException(status_code=404, detail="Story node not found")
+
 
+# how the player got to a node (or how to get there), root first
+@router.get("/{story_id}/nodes/{node_id}/path", response_model=StoryPathResponse)
+def get_node_path(story_id: int, node_id: int, db: Session = Depends(get_story_read_db)):
+    _story_node_or_404(db, story_id, node_id)
+    return StoryPathResponse(
+        story_id=story_id,
+        steps=[StoryPathStep(node_id=path_id, choice=choice) for path_id, choice in path_to_root(db, node_id)]
+    )
+
+
+# every node that can still be reached from a node, e.g. to know which endings are left
+@router.get("/{story_id}/nodes/{node_id}/subtree", response_model=StorySubtreeResponse)
+def get_node_subtree(
+    story_id: int,
+    node_id: int,
+    max_depth: Optional[int] = Query(None, ge=1),
+    db: Session = Depends(get_story_read_db)
+):
+    _story_node_or_404(db, story_id, node_id)
+    return StorySubtreeResponse(story_id=story_id, node_ids=subtree_node_ids(db, node_id, max_depth))
+
+
+@router.get("/{story_id}/nodes/{node_id}/reachable/{target_id}", response_model=StoryReachabilityResponse)
+def get_node_reachable(story_id: int, node_id: int, target_id: int, db: Session = Depends(get_story_read_db)):
+    _story_node_or_404(db, story_id, node_id)
+    _story_node_or_404(db, story_id, target_id)
+    return StoryReachabilityResponse(
+        from_node_id=node_id, to_node_id=target_id, reachable=is_reachable(db, node_id, target_id)
+    )
 
 
 def build_complete_story_tree(db: Session, story: Story) -> CompleteStoryResponse:
     nodes = db.query(StoryNode).filter(StoryNode.story_id == story.id).all()
+    load_node_contents(db, nodes) # node text lives in the content store, one query for all of them
     
     node_dict = {}
     for node in nodes:
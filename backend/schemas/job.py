@@ -11,10 +11,48 @@ class StoryJobResponse(BaseModel):
     story_id:       int         |   None = None
     completed_at:   datetime    |   None = None
     error:          str         |   None = None
+    group_id:       str         |   None = None
     
     class Config:
         from_attributes = True
         
+class StoryJobBatchResponse(BaseModel):
+    group_id:       str
+    jobs:           list[StoryJobResponse]
+    
+# aggregate progress of the jobs created by one /stories/create-batch call
+class StoryJobGroupResponse(BaseModel):
+    group_id:       str
+    total:          int
+    pending:        int = 0
+    processing:     int = 0
+    completed:      int = 0
+    failed:         int = 0
+    finished:       bool
+    story_ids:      list[int] = []
+        
+# GET /jobs/usage/stats, percentiles of what a generation costs per (theme, model)
+class JobUsageMetric(BaseModel):
+    p50:            float
+    p90:            float
+    p99:            float
+    mean:           float
+    max:            float
+
+class JobUsageGroup(BaseModel):
+    theme:          str
+    model:          str         |   None = None
+    runs:           int
+    failed:         int
+    lost:           int # the lease ran out, another worker redid the job
+    metrics:        dict[str, JobUsageMetric]
+
+class JobUsageStatsResponse(BaseModel):
+    since:          datetime
+    runs:           int
+    truncated:      bool # hit JOB_USAGE_STATS_MAX_ROWS, only the newest runs are in
+    groups:         list[JobUsageGroup]
+        
 # It's just a renaming tactic; it'll makes more sense when using this class
 class StoryJobCreate(StoryJobBase):
     pass
\ No newline at end of file
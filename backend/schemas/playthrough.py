@@ -0,0 +1,13 @@
+from datetime import datetime
+from pydantic import BaseModel
+
+class RecordChoiceRequest(BaseModel):
+    from_node_id:       int
+    to_node_id:         int
+    
+# where to pick the story up again, the client already has the nodes from /stories/{id}/complete
+class PlaythroughResponse(BaseModel):
+    story_id:           int
+    current_node_id:    int
+    choices_made:       int
+    updated_at:         datetime | None = None
@@ -2,7 +2,7 @@
 # the structure and shape of the data we want to handle
 
 from datetime import datetime
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 class StoryOptionsSchema(BaseModel):
     text: str
@@ -29,6 +29,10 @@ class StoryBase(BaseModel):
 
 class CreateStoryRequest(BaseModel):
     theme: str
+    endless: bool = False # starts shallow, leaves get generated as the story is played
+    
+class CreateStoryBatchRequest(BaseModel):
+    themes: list[str] = Field(min_length=1)
     
 class CompleteStoryResponse(StoryBase):
     id: int
@@ -38,3 +42,61 @@ class CompleteStoryResponse(StoryBase):
     
     class Config:
         from_attributes = True
+
+# only what a list needs, the nodes stay out of it
+class StorySummaryResponse(BaseModel):
+    id: int
+    title: str
+    created_at: datetime
+    
+    class Config:
+        from_attributes = True
+        
+class StoryListResponse(BaseModel):
+    items: list[StorySummaryResponse]
+    next_cursor: str | None = None
+
+class StoryStatsResponse(BaseModel):
+    story_id: int
+    max_depth: int
+    node_count: int
+    ending_count: int
+    winning_ending_count: int
+    shortest_winning_path: list[int] | None = None
+    branching_factor: float
+
+class StorySearchHit(BaseModel):
+    story_id: int
+    title: str
+    snippet: str | None = None
+    rank: float
+    
+class StorySearchResponse(BaseModel):
+    items: list[StorySearchHit]
+
+
+# POST /stories/{id}/nodes/{node_id}/expand, node is there once the status is ready
+class NodeExpansionResponse(BaseModel):
+    node_id: int
+    status: str # ready, pending or failed
+    node: CompleteStoryNodeResponse | None = None
+    error: str | None = None
+
+
+# walks of the story graph (story_edges), node ids only, the text is in /complete
+class StoryPathStep(BaseModel):
+    node_id: int
+    choice: str | None = None # the option taken from this node, None for the last step
+
+class StoryPathResponse(BaseModel):
+    story_id: int
+    steps: list[StoryPathStep]
+
+class StorySubtreeResponse(BaseModel):
+    story_id: int
+    node_ids: list[int] # closest first, the node itself is the first one
+
+class StoryReachabilityResponse(BaseModel):
+    from_node_id: int
+    to_node_id: int
+    reachable: bool
@@ -0,0 +1,47 @@
+# the app reads its settings and opens its engines at import, so the databases have to be picked before anything
+# imports core.config: three throwaway sqlite files, DATABASE_URL is shard 0 and the other two are shards 1 and 2
+#
+#   uv run --with pytest pytest
+
+import os
+import tempfile
+
+_databases = tempfile.mkdtemp(prefix="story-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{_databases}/shard0.db"
+os.environ["DATABASE_SHARD_URLS"] = f"sqlite:///{_databases}/shard1.db,sqlite:///{_databases}/shard2.db"
+os.environ["DATABASE_READ_URL"] = ""
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+
+import pytest
+
+from db.database import create_tables, shard_engines
+
+SHARDS = 3
+
+
+@pytest.fixture(scope="session", autouse=True)
+def databases():
+    assert len(shard_engines) == SHARDS
+    create_tables()
+    yield
+    for shard_engine in shard_engines:
+        shard_engine.dispose()
+
+
+@pytest.fixture
+def db(tmp_path):
+    # a database of its own, for tests that delete or count whole tables (maintenance, transfer, leases).
+    # not a shard, nothing routes to it
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    from core.search import ensure_search_index
+    from db.database import Base
+
+    engine = create_engine(f"sqlite:///{tmp_path}/own.db")
+    Base.metadata.create_all(bind=engine)
+    ensure_search_index(engine)
+    session = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
@@ -0,0 +1,143 @@
+import gzip
+import json
+
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
+from fastapi.testclient import TestClient
+
+from core import compression
+from core.compression import CompressionMiddleware, negotiate_encoding
+from core.story_payloads import IDENTITY, get_story_payload, invalidate_story_payload, payload_cache
+from models.story import Story, StoryPayload
+
+BIG = {"content": "the dragon sleeps " * 200}
+
+
+def _client() -> TestClient:
+    app = FastAPI()
+    app.add_middleware(CompressionMiddleware, minimum_size=1024)
+
+    @app.get("/big")
+    def big():
+        return BIG
+
+    @app.get("/small")
+    def small():
+        return {"ok": True}
+
+    @app.get("/text")
+    def text():
+        return PlainTextResponse("words " * 500)
+
+    @app.get("/image")
+    def image():
+        return Response(b"\x89PNG" * 1000, media_type="image/png")
+
+    @app.get("/encoded")
+    def encoded():
+        body = gzip.compress(json.dumps(BIG).encode())
+        return Response(body, media_type="application/json", headers={"Content-Encoding": "gzip"})
+
+    return TestClient(app)
+
+
+@pytest.fixture
+def gzip_only(monkeypatch):
+    monkeypatch.setattr(compression, "brotli", None)
+
+
+def test_negotiation_follows_quality(gzip_only):
+    assert negotiate_encoding(None) is None
+    assert negotiate_encoding("gzip") == "gzip"
+    assert negotiate_encoding("GZIP;q=0.5, identity") == "gzip"
+    assert negotiate_encoding("gzip;q=0") is None
+    assert negotiate_encoding("br") is None
+    assert negotiate_encoding("*") == "gzip"
+    assert negotiate_encoding("gzip;q=abc") is None
+
+
+def test_big_json_gets_compressed(gzip_only):
+    response = _client().get("/big", headers={"Accept-Encoding": "gzip"})
+
+    assert response.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["vary"]
+    assert int(response.headers["content-length"]) < len(json.dumps(BIG))
+    assert response.json() == BIG # the client undoes it
+
+
+def test_small_responses_and_clients_without_gzip_get_it_plain(gzip_only):
+    small = _client().get("/small", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in small.headers
+    assert small.headers["content-length"] == str(len(small.content))
+
+    plain = _client().get("/big", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+    assert plain.json() == BIG
+
+
+def test_only_text_types_are_compressed(gzip_only):
+    client = _client()
+    assert client.get("/text", headers={"Accept-Encoding": "gzip"}).headers["content-encoding"] == "gzip"
+    assert "content-encoding" not in client.get("/image", headers={"Accept-Encoding": "gzip"}).headers
+
+
+def test_encoded_responses_pass_through(gzip_only):
+    response = _client().get("/encoded", headers={"Accept-Encoding": "gzip"})
+
+    # compressed once, not twice
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.json() == BIG
+
+
+def _story(db, node_count=3, endless=True) -> int:
+    story = Story(title="t", session_id="s", endless=endless, node_count=node_count)
+    db.add(story)
+    db.commit()
+    return story.id
+
+
+def test_payloads_are_stored_once_and_served_from_there(db, gzip_only):
+    story_id = _story(db)
+    builds = []
+
+    def build():
+        builds.append(1)
+        return json.dumps(BIG).encode()
+
+    first = get_story_payload(db, story_id, "gzip", build)
+    second = get_story_payload(db, story_id, "gzip", build)
+
+    assert first.encoding == "gzip" and second.body == first.body
+    assert len(builds) == 1
+    assert {row.encoding for row in db.query(StoryPayload).filter_by(story_id=story_id)} == {"gzip"}
+
+
+def test_payload_of_a_story_that_grew_meanwhile_is_not_stored(db, gzip_only):
+    story_id = _story(db, node_count=3)
+
+    def build():
+        # an expansion commits (and invalidates) while this request builds the old tree
+        db.query(Story).filter_by(id=story_id).update({"node_count": 5})
+        db.commit()
+        invalidate_story_payload(db, story_id)
+        db.commit()
+        return b'{"old": true}'
+
+    payload = get_story_payload(db, story_id, None, build)
+
+    assert payload.body == b'{"old": true}' # this request still gets what it built
+    assert db.query(StoryPayload).filter_by(story_id=story_id).count() == 0
+
+    fresh = get_story_payload(db, story_id, None, lambda: b'{"new": true}')
+    assert fresh.body == b'{"new": true}'
+    assert [row.encoding for row in db.query(StoryPayload).filter_by(story_id=story_id)] == [IDENTITY] # too small
+
+
+def test_finished_stories_are_kept_in_the_lru(db, gzip_only):
+    story_id = _story(db, endless=False)
+    get_story_payload(db, story_id, "gzip", lambda: json.dumps(BIG).encode())
+
+    assert payload_cache.get(story_id, "gzip") is not None
+    invalidate_story_payload(db, story_id)
+    assert payload_cache.get(story_id, "gzip") is None
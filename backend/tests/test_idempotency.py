@@ -0,0 +1,86 @@
+import uuid
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+from core.config import settings
+from db.database import shard_session
+from db.sharding import shard_of_key
+from main import app
+from models.job import StoryJob
+from routers import story as story_router
+
+CREATE = settings.API_PREFIX + "/stories/create"
+
+
+@pytest.fixture
+def client(monkeypatch):
+    submitted = []
+    monkeypatch.setattr(story_router.scheduler, "submit", submitted.append)
+    monkeypatch.setattr(story_router.llm_guard, "retry_after", lambda: 0)
+    monkeypatch.setattr(story_router.admission, "admit", lambda rate_key, cost=1: SimpleNamespace(allowed=True))
+
+    client = TestClient(app) # no lifespan, nothing gets started
+    client.cookies.set("session_id", f"session-{uuid.uuid4()}")
+    client.submitted = submitted
+    return client
+
+
+def _create(client, key, theme="dragons"):
+    return client.post(CREATE, json={"theme": theme}, headers={"Idempotency-Key": key})
+
+
+def test_a_retry_gets_the_same_job(client):
+    first = _create(client, "k1")
+    retry = _create(client, "k1")
+
+    assert first.status_code == retry.status_code == 200
+    assert retry.json()["job_id"] == first.json()["job_id"]
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert "Idempotent-Replayed" not in first.headers
+    assert len(client.submitted) == 1 # generated once
+
+    assert _create(client, "k2").json()["job_id"] != first.json()["job_id"]
+    assert len(client.submitted) == 2
+
+
+def test_the_same_key_for_a_different_request_is_rejected(client):
+    _create(client, "k1", theme="dragons")
+
+    assert _create(client, "k1", theme="pirates").status_code == 422
+    assert len(client.submitted) == 1
+
+
+def test_keys_are_per_session(client):
+    job_id = _create(client, "k1").json()["job_id"]
+    client.cookies.clear() # the response set the cookie again
+    client.cookies.set("session_id", f"session-{uuid.uuid4()}")
+
+    assert _create(client, "k1").json()["job_id"] != job_id
+
+
+def test_an_expired_key_starts_a_new_job(client):
+    old_job_id = _create(client, "k1").json()["job_id"]
+    db = shard_session(shard_of_key(old_job_id))
+    try:
+        long_ago = datetime.now(timezone.utc) - timedelta(hours=settings.IDEMPOTENCY_KEY_TTL_HOURS + 1)
+        db.query(StoryJob).filter_by(job_id=old_job_id).update({"created_at": long_ago})
+        db.commit()
+
+        new_job_id = _create(client, "k1", theme="pirates").json()["job_id"]
+
+        assert new_job_id != old_job_id
+        db.expire_all()
+        old = db.query(StoryJob).filter_by(job_id=old_job_id).one()
+        assert (old.idempotency_key, old.idempotency_hash) == (None, None) # freed for the new job
+        assert _create(client, "k1", theme="pirates").json()["job_id"] == new_job_id
+    finally:
+        db.close()
+
+
+@pytest.mark.parametrize("key", ["", "x" * (settings.IDEMPOTENCY_KEY_MAX_LENGTH + 1)])
+def test_bad_keys_are_rejected(client, key):
+    assert _create(client, key).status_code == 400
+    assert client.submitted == []
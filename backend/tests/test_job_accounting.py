@@ -0,0 +1,18 @@
+import pytest
+
+from core.job_accounting import _percentile
+
+
+@pytest.mark.parametrize("percent, expected", [(50, 5), (90, 9), (99, 10), (100, 10), (1, 1)])
+def test_nearest_rank(percent, expected):
+    assert _percentile(list(range(1, 11)), percent) == expected
+
+
+def test_single_value():
+    assert [_percentile([7], percent) for percent in (50, 90, 99)] == [7, 7, 7]
+
+
+def test_small_samples_round_up():
+    assert _percentile([1, 2, 3], 50) == 2
+    assert _percentile([1, 2, 3, 4], 50) == 2
+    assert _percentile([1, 2, 3, 4], 51) == 3
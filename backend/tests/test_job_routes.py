@@ -0,0 +1,25 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from core.config import settings
+from main import app
+
+client = TestClient(app) # no lifespan, nothing gets started
+
+
+@pytest.fixture
+def admin_token(monkeypatch):
+    monkeypatch.setattr(settings, "ADMIN_TOKEN", "operator")
+    return "operator"
+
+
+@pytest.mark.parametrize("path", ["/jobs/scheduler/stats", "/jobs/usage/stats"])
+def test_operator_endpoints_need_the_admin_token(path, admin_token):
+    assert client.get(settings.API_PREFIX + path).status_code == 403
+    assert client.get(settings.API_PREFIX + path, headers={"X-Admin-Token": "guess"}).status_code == 403
+    assert client.get(settings.API_PREFIX + path, headers={"X-Admin-Token": admin_token}).status_code == 200
+
+
+def test_operator_endpoints_are_off_without_a_token(monkeypatch):
+    monkeypatch.setattr(settings, "ADMIN_TOKEN", "")
+    assert client.get(settings.API_PREFIX + "/jobs/scheduler/stats", headers={"X-Admin-Token": ""}).status_code == 403
@@ -0,0 +1,40 @@
+from core.leader import LOCK_FILE_ENV, Leader
+
+
+def test_one_process_per_lock_file_leads(tmp_path, monkeypatch):
+    monkeypatch.setenv(LOCK_FILE_ENV, str(tmp_path / "leader.lock"))
+    first, second = Leader(), Leader()
+    elected = []
+    def second_elected():
+        elected.append("second")
+
+    first.on_elected(lambda: elected.append("first"))
+    second.on_elected(second_elected)
+    second.on_elected(second_elected) # registered twice, runs once
+
+    assert first.is_leader()
+    assert not second.is_leader()
+    assert first.is_leader() # still, the callbacks only run when it takes over
+    assert elected == ["first"]
+
+    first.resign() # or the worker died
+    assert second.is_leader()
+    assert not first.is_leader()
+    assert elected == ["first", "second"]
+    second.resign()
+
+
+def test_without_a_lock_file_everyone_leads(monkeypatch):
+    monkeypatch.delenv(LOCK_FILE_ENV, raising=False)
+    first, second = Leader(), Leader()
+
+    assert first.is_leader() and second.is_leader()
+
+
+def test_failing_startup_work_doesnt_stop_the_leader(tmp_path, monkeypatch):
+    monkeypatch.setenv(LOCK_FILE_ENV, str(tmp_path / "leader.lock"))
+    leader = Leader()
+    leader.on_elected(lambda: 1 / 0)
+
+    assert leader.is_leader()
+    leader.resign()
@@ -0,0 +1,135 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from core import leases
+from core.config import settings
+from core.job_cache import job_status_cache
+from core.leases import (
+    Heartbeat, claim_jobs, complete_job, finish_job, reap_expired_leases, release_jobs, stop_heartbeats, worker_id,
+)
+from db.database import shard_session
+from db.sharding import make_key
+from models.job import StoryJob
+from models.story import Story
+
+
+@pytest.fixture
+def submitted(monkeypatch):
+    requests = []
+    monkeypatch.setattr(leases.scheduler, "submit", requests.append)
+    return requests
+
+
+def _job(db, status="pending", **values) -> str:
+    job_id = make_key(db.info.get("shard", 0))
+    db.add(StoryJob(job_id=job_id, session_id="s", theme="t", status=status, **values))
+    db.commit()
+    return job_id
+
+
+def _get(db, job_id) -> StoryJob:
+    db.expire_all()
+    return db.query(StoryJob).filter_by(job_id=job_id).one()
+
+
+def test_a_job_is_claimed_once(db):
+    job_id = _job(db)
+
+    assert claim_jobs(db, [job_id]) == {job_id}
+    assert claim_jobs(db, [job_id]) == set()
+
+    job = _get(db, job_id)
+    assert (job.status, job.lease_owner, job.attempts) == ("processing", worker_id(), 1)
+    assert job_status_cache.get(job_id).status == "processing"
+
+
+def test_finishing_needs_the_lease(db):
+    kept, lost = _job(db), _job(db)
+    claim_jobs(db, [kept, lost])
+    db.query(StoryJob).filter_by(job_id=lost).update({"lease_owner": "someone-else"})
+    db.commit()
+
+    assert finish_job(db, kept, error="boom")
+    assert not finish_job(db, lost, error="boom")
+    assert _get(db, kept).status == "failed"
+    assert _get(db, lost).status == "processing"
+
+
+def test_a_lost_lease_saves_no_story(db):
+    kept, lost = _job(db), _job(db)
+    claim_jobs(db, [kept, lost])
+    db.query(StoryJob).filter_by(job_id=lost).update({"lease_owner": "someone-else"})
+    db.commit()
+
+    def save():
+        story = Story(title="t", session_id="s")
+        db.add(story)
+        db.flush()
+        return story
+
+    story = complete_job(db, kept, save)
+    assert complete_job(db, lost, save) is None
+    db.commit()
+
+    assert db.query(Story).count() == 1
+    job = _get(db, kept)
+    assert (job.status, job.story_id, job.lease_owner) == ("completed", story.id, None)
+
+
+def test_the_reaper_requeues_expired_leases_and_gives_up_after_max_attempts(db, submitted):
+    expired = datetime.now(timezone.utc) - timedelta(minutes=1)
+    requeued = _job(db, "processing", lease_owner="dead", lease_expires_at=expired, attempts=1)
+    given_up = _job(db, "processing", lease_owner="dead", lease_expires_at=expired, attempts=settings.JOB_MAX_ATTEMPTS)
+    from_before_leases = _job(db, "processing")
+    alive = _job(db, "processing", lease_owner="alive", lease_expires_at=datetime.now(timezone.utc) + timedelta(minutes=1))
+
+    assert reap_expired_leases(db) == (2, 1)
+
+    assert _get(db, requeued).status == "pending"
+    assert _get(db, from_before_leases).status == "pending"
+    assert _get(db, given_up).status == "failed"
+    assert _get(db, alive).status == "processing"
+    assert {request.job_id for request in submitted} == {requeued, from_before_leases}
+    assert reap_expired_leases(db) == (0, 0)
+
+
+def test_released_jobs_go_back_without_using_an_attempt():
+    db = shard_session(1)
+    try:
+        job_id = _job(db)
+        claim_jobs(db, [job_id])
+        release_jobs([job_id])
+
+        job = _get(db, job_id)
+        assert (job.status, job.lease_owner, job.attempts) == ("pending", None, 0)
+    finally:
+        db.close()
+
+
+def test_heartbeat_keeps_the_lease_alive(monkeypatch):
+    monkeypatch.setattr(settings, "JOB_HEARTBEAT_SECONDS", 0.05)
+    db = shard_session(2)
+    try:
+        job_id = _job(db)
+        claim_jobs(db, [job_id])
+        soon = datetime.now(timezone.utc) + timedelta(seconds=1)
+        db.query(StoryJob).filter_by(job_id=job_id).update({"lease_expires_at": soon})
+        db.commit()
+
+        with Heartbeat([job_id]):
+            time.sleep(0.3)
+        renewed = _get(db, job_id).lease_expires_at
+        # sqlite hands back naive datetimes
+        assert renewed > (soon + timedelta(seconds=settings.JOB_LEASE_SECONDS / 2)).replace(tzinfo=None)
+
+        # after a timed out drain the beats stop, the lease runs out on its own
+        db.query(StoryJob).filter_by(job_id=job_id).update({"lease_expires_at": soon})
+        db.commit()
+        with Heartbeat([job_id]):
+            stop_heartbeats()
+            time.sleep(0.2)
+        assert _get(db, job_id).lease_expires_at == soon.replace(tzinfo=None)
+    finally:
+        db.close()
@@ -0,0 +1,96 @@
+import pytest
+
+from core import llm_guard
+from core.llm_guard import CircuitBreaker, LLMUnavailable
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(llm_guard.time, "monotonic", clock)
+    return clock
+
+
+def _breaker() -> CircuitBreaker:
+    return CircuitBreaker(window_seconds=60, min_calls=4, failure_rate=0.5, cooldown_seconds=30)
+
+
+def _call(breaker: CircuitBreaker, failed: bool):
+    probe = breaker.before_call()
+    breaker.record(failed, probe)
+
+
+def test_stays_closed_below_min_calls(clock):
+    breaker = _breaker()
+    for _ in range(3):
+        _call(breaker, failed=True)
+
+    assert breaker.stats()["state"] == "closed"
+    assert breaker.before_call() is False
+
+
+def test_opens_at_the_failure_rate(clock):
+    breaker = _breaker()
+    for failed in (False, True, False, True):
+        _call(breaker, failed)
+
+    with pytest.raises(LLMUnavailable) as raised:
+        breaker.before_call()
+    assert raised.value.retry_after == pytest.approx(30)
+
+
+def test_old_outcomes_leave_the_window(clock):
+    breaker = _breaker()
+    for _ in range(3):
+        _call(breaker, failed=True)
+    clock.now += 61
+    _call(breaker, failed=True)
+
+    assert breaker.stats() == {"state": "closed", "retry_after_seconds": 0, "window_calls": 1, "window_failures": 1}
+
+
+def test_half_open_lets_one_probe_through(clock):
+    breaker = _breaker()
+    for _ in range(4):
+        _call(breaker, failed=True)
+    clock.now += 31
+
+    assert breaker.before_call() is True # the probe
+    with pytest.raises(LLMUnavailable) as raised:
+        breaker.before_call() # everyone else waits for it
+    assert raised.value.retry_after == llm_guard.HALF_OPEN_RETRY_SECONDS
+
+    breaker.record(failed=False, probe=True)
+    assert breaker.stats()["state"] == "closed"
+    assert breaker.before_call() is False
+
+
+def test_failed_probe_opens_it_again(clock):
+    breaker = _breaker()
+    for _ in range(4):
+        _call(breaker, failed=True)
+    clock.now += 31
+
+    breaker.record(failed=True, probe=breaker.before_call())
+
+    with pytest.raises(LLMUnavailable):
+        breaker.before_call()
+    assert breaker.retry_after() == pytest.approx(30)
+
+
+def test_calls_started_before_it_opened_dont_count(clock):
+    breaker = _breaker()
+    for _ in range(4):
+        _call(breaker, failed=True)
+
+    breaker.record(failed=False, probe=False) # was already out when it opened
+    assert breaker.stats()["state"] == "open"
@@ -0,0 +1,111 @@
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func, select
+
+from core.maintenance import collect_orphans, purge_jobs
+from models.job import StoryJob, StoryJobArchive
+from models.playthrough import PlaythroughProgress
+from models.story import Story, StoryNode
+
+LONG_AGO = datetime.now(timezone.utc) - timedelta(days=60)
+
+
+def _job(db, status: str, created_at: datetime = LONG_AGO, story_id: int | None = None) -> StoryJob:
+    job = StoryJob(job_id=f"job-{db.query(StoryJob).count()}-{status}", session_id="s", theme="t", status=status,
+                   created_at=created_at, story_id=story_id)
+    db.add(job)
+    db.commit()
+    return job
+
+
+def _story(db, created_at: datetime = LONG_AGO, completed: bool = False) -> int:
+    story = Story(title="t", session_id="s", created_at=created_at, completed_at=created_at if completed else None)
+    db.add(story)
+    db.flush()
+    db.add_all([StoryNode(story_id=story.id, is_root=True, options=[]), StoryNode(story_id=story.id, options=[])])
+    db.commit()
+    return story.id
+
+
+def _story_ids(db) -> set[int]:
+    return set(db.scalars(select(Story.id)))
+
+
+def test_purge_keeps_recent_and_unfinished_jobs(db):
+    _job(db, "completed")
+    _job(db, "failed")
+    kept = {
+        _job(db, "completed", created_at=datetime.now(timezone.utc)).job_id,
+        _job(db, "pending").job_id,
+        _job(db, "processing").job_id,
+    }
+
+    purged = purge_jobs(db, retention_days=30, failed_retention_days=30, archive=False, batch_size=1)
+
+    assert purged == 2
+    assert set(db.scalars(select(StoryJob.job_id))) == kept
+    assert not db.query(StoryJobArchive).count()
+
+
+def test_failed_jobs_have_their_own_retention(db):
+    _job(db, "failed", created_at=datetime.now(timezone.utc) - timedelta(days=10))
+    _job(db, "completed", created_at=datetime.now(timezone.utc) - timedelta(days=10))
+
+    assert purge_jobs(db, retention_days=30, failed_retention_days=7, archive=False) == 1
+    assert db.scalars(select(StoryJob.status)).all() == ["completed"]
+
+
+def test_purge_can_archive(db):
+    job_id = _job(db, "completed", story_id=42).job_id
+    db.execute(StoryJob.__table__.update().values(idempotency_key="key", idempotency_hash="hash"))
+    db.commit()
+
+    purge_jobs(db, retention_days=30, failed_retention_days=30, archive=True)
+
+    assert db.scalar(select(func.count()).select_from(StoryJob)) == 0
+    archived = db.query(StoryJobArchive).one()
+    assert (archived.job_id, archived.story_id, archived.status, archived.idempotency_hash) == (job_id, 42, "completed", "hash")
+
+
+def test_orphans_are_unfinished_unread_stories(db):
+    failed = _story(db)
+    _job(db, "failed", story_id=failed)
+    no_job = _story(db)
+
+    kept = {
+        "completed": _story(db, completed=True), # its job got purged, it's still a delivered story
+        "pending job": _story(db),
+        "archived job": _story(db),
+        "played": _story(db),
+        "recent": _story(db, created_at=datetime.now(timezone.utc)),
+    }
+    _job(db, "processing", story_id=kept["pending job"])
+    db.add(StoryJobArchive(job_id="archived", status="completed", story_id=kept["archived job"]))
+    db.add(PlaythroughProgress(session_id="s", story_id=kept["played"], current_node_id=1))
+    db.commit()
+
+    deleted_stories, deleted_nodes = collect_orphans(db, grace_minutes=60, batch_size=1)
+
+    assert deleted_stories == 2
+    assert deleted_nodes == 0 # went with their stories
+    assert _story_ids(db) == set(kept.values())
+    assert not db.query(StoryNode).filter(StoryNode.story_id.in_([failed, no_job])).count()
+
+
+def test_purging_a_job_never_orphans_its_finished_story(db):
+    story_id = _story(db, completed=True)
+    _job(db, "completed", story_id=story_id)
+
+    purge_jobs(db, retention_days=30, failed_retention_days=30, archive=False)
+    collect_orphans(db, grace_minutes=60)
+
+    assert _story_ids(db) == {story_id}
+
+
+def test_nodes_of_deleted_stories_are_collected(db):
+    story_id = _story(db, completed=True)
+    db.add(StoryNode(story_id=story_id + 1000, options=[])) # its story is gone
+    db.commit()
+
+    assert collect_orphans(db, grace_minutes=60) == (0, 1)
+    assert db.query(StoryNode).count() == 2
@@ -0,0 +1,106 @@
+import uuid
+
+import pytest
+
+from core import playthrough
+from core.playthrough import PlaythroughBuffer
+from db.database import shard_session
+from db.sharding import id_base, shard_of_id
+from models.playthrough import PlaythroughProgress
+
+
+@pytest.fixture
+def session_id():
+    return f"player-{uuid.uuid4()}"
+
+
+def _stored(session_id: str, story_id: int) -> tuple[int, int] | None:
+    db = shard_session(shard_of_id(story_id))
+    try:
+        row = db.query(PlaythroughProgress).filter_by(session_id=session_id, story_id=story_id).first()
+        return (row.current_node_id, row.choices_made) if row else None
+    finally:
+        db.close()
+
+
+def test_clicks_collapse_until_the_flush(session_id):
+    buffer = PlaythroughBuffer()
+    story_id = id_base(1) + 5
+    for node_id in (11, 12, 13):
+        buffer.record(session_id, story_id, node_id)
+
+    pending = buffer.get(session_id, story_id)
+    assert (pending.current_node_id, pending.choices_made) == (13, 3)
+    assert _stored(session_id, story_id) is None
+
+    assert buffer.flush() == 1
+    assert _stored(session_id, story_id) == (13, 3)
+    assert buffer.get(session_id, story_id) is None
+
+
+def test_flushes_add_up(session_id):
+    buffer = PlaythroughBuffer()
+    story_id = id_base(0) + 5
+    buffer.record(session_id, story_id, 1)
+    buffer.flush()
+    buffer.record(session_id, story_id, 2)
+    buffer.record(session_id, story_id, 3)
+    buffer.flush()
+
+    assert _stored(session_id, story_id) == (3, 3)
+
+
+def test_each_shard_gets_its_own_rows(session_id):
+    buffer = PlaythroughBuffer()
+    story_ids = [id_base(shard) + 7 for shard in range(3)]
+    for story_id in story_ids:
+        buffer.record(session_id, story_id, 1)
+
+    assert buffer.flush() == 3
+    assert [_stored(session_id, story_id) for story_id in story_ids] == [(1, 1)] * 3
+
+
+def test_a_batch_being_written_is_still_visible(session_id, monkeypatch):
+    buffer = PlaythroughBuffer()
+    story_id = id_base(2) + 5
+    buffer.record(session_id, story_id, 4)
+    seen = []
+
+    upsert = playthrough._upsert_statement
+    def watching(db):
+        seen.append(buffer.get(session_id, story_id)) # between taking the batch and its commit
+        return upsert(db)
+    monkeypatch.setattr(playthrough, "_upsert_statement", watching)
+
+    buffer.flush()
+    assert (seen[0].current_node_id, seen[0].choices_made) == (4, 1)
+
+
+def test_a_row_that_can_never_be_written_is_dropped(session_id):
+    buffer = PlaythroughBuffer()
+    good, broken = id_base(1) + 8, id_base(1) + 9
+    buffer.record(session_id, good, 2)
+    buffer.record(session_id, broken, None) # current_node_id is NOT NULL, this row never goes in
+
+    assert buffer.flush() == 1
+    assert _stored(session_id, good) == (2, 1)
+    assert buffer.get(session_id, broken) is None
+    assert buffer.flush() == 0 # it doesn't come back
+
+
+def test_failed_flush_keeps_the_choices_for_the_next_one(session_id, monkeypatch):
+    buffer = PlaythroughBuffer()
+    story_id = id_base(0) + 9
+    buffer.record(session_id, story_id, 1)
+
+    upsert = playthrough._upsert_statement
+    def down(db):
+        raise ConnectionError("database went away")
+    monkeypatch.setattr(playthrough, "_upsert_statement", down)
+    with pytest.raises(ConnectionError):
+        buffer.flush()
+
+    buffer.record(session_id, story_id, 2) # came in while it was down
+    monkeypatch.setattr(playthrough, "_upsert_statement", upsert)
+    assert buffer.flush() == 1
+    assert _stored(session_id, story_id) == (2, 2)
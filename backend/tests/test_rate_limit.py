@@ -0,0 +1,95 @@
+import pytest
+
+from core import rate_limit
+from core.rate_limit import MemoryRateLimitBackend
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(rate_limit.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_takes_tokens_until_the_burst_is_gone(clock):
+    backend = MemoryRateLimitBackend()
+    assert [backend.acquire("a", rate=1, capacity=3)[0] for _ in range(4)] == [True, True, True, False]
+
+
+def test_retry_after_is_the_time_to_refill_the_cost(clock):
+    backend = MemoryRateLimitBackend()
+    backend.acquire("a", rate=0.5, capacity=2, cost=2)
+
+    assert backend.acquire("a", rate=0.5, capacity=2, cost=1) == (False, pytest.approx(2))
+
+
+def test_refills_with_time_up_to_capacity(clock):
+    backend = MemoryRateLimitBackend()
+    backend.acquire("a", rate=1, capacity=3, cost=3)
+
+    clock[0] += 2
+    assert backend.acquire("a", rate=1, capacity=3, cost=2)[0]
+    assert not backend.acquire("a", rate=1, capacity=3, cost=1)[0]
+
+    clock[0] += 100
+    assert backend.acquire("a", rate=1, capacity=3, cost=3)[0]
+    assert not backend.acquire("a", rate=1, capacity=3, cost=1)[0]
+
+
+def test_keys_have_their_own_buckets(clock):
+    backend = MemoryRateLimitBackend()
+    backend.acquire("a", rate=1, capacity=1)
+
+    assert not backend.acquire("a", rate=1, capacity=1)[0]
+    assert backend.acquire("b", rate=1, capacity=1)[0]
+
+
+def test_denied_request_costs_nothing(clock):
+    backend = MemoryRateLimitBackend()
+    backend.acquire("a", rate=1, capacity=3, cost=2)
+
+    assert not backend.acquire("a", rate=1, capacity=3, cost=2)[0]
+    assert backend.acquire("a", rate=1, capacity=3, cost=1)[0]
+
+
+def test_refund_gives_tokens_back_up_to_capacity(clock):
+    backend = MemoryRateLimitBackend()
+    backend.acquire("a", rate=1, capacity=2, cost=2)
+
+    backend.refund("a", capacity=2, cost=5)
+    assert [backend.acquire("a", rate=1, capacity=2)[0] for _ in range(3)] == [True, True, False]
+
+
+def test_idle_buckets_get_pruned(clock):
+    backend = MemoryRateLimitBackend(max_keys=2)
+    backend.acquire("a", rate=1, capacity=1)
+    backend.acquire("b", rate=1, capacity=1)
+
+    clock[0] += 24 * 3600
+    backend.acquire("c", rate=1, capacity=1)
+
+    assert set(backend._buckets) == {"c"}
+
+
+def test_expansions_of_one_story_share_a_budget(clock, monkeypatch):
+    from core.config import settings
+    from core.rate_limit import AdmissionController
+
+    monkeypatch.setattr(settings, "ENDLESS_STORY_EXPANSION_BURST", 2)
+    monkeypatch.setattr(settings, "SESSION_RATE_LIMIT_BURST", 3)
+    backend = MemoryRateLimitBackend()
+    controller = AdmissionController(backend)
+    monkeypatch.setattr(controller, "_backlog_stats", lambda: (0, 1.0))
+
+    # every new session gets a full bucket, the story doesn't
+    assert controller.admit_expansion("session:a", 1).allowed
+    assert controller.admit_expansion("session:b", 1).allowed
+    denied = controller.admit_expansion("session:c", 1)
+    assert not denied.allowed and "story" in denied.reason
+    assert denied.retry_after > 0
+
+    # the denied request didn't cost session c anything, and other stories have their own budget
+    assert controller.admit_expansion("session:c", 2).allowed
+    assert controller.admit_expansion("session:c", 3).allowed
+    assert controller.admit_expansion("session:c", 4).allowed
+    assert not controller.admit_expansion("session:c", 5).allowed
@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+
+from sqlalchemy import text
+
+from core.search import index_nodes, index_story, rebuild_search_index, remove_stories, search_stories
+from models.story import Story, StoryNode
+
+
+def _story(db, title: str, contents: list[str]) -> Story:
+    story = Story(title=title, session_id="s")
+    db.add(story)
+    db.flush()
+    nodes = [StoryNode(story_id=story.id, content=content, options=[]) for content in contents]
+    db.add_all(nodes)
+    db.flush()
+    index_story(db, story, nodes)
+    db.commit()
+    return story
+
+
+def _found(db, query: str) -> list[int]:
+    return [hit["story_id"] for hit in search_stories(db, query)]
+
+
+def test_finds_titles_and_node_text_once_per_story(db):
+    dragon = _story(db, "The dragon", ["a dragon sleeps", "the dragon wakes", "run"])
+    _story(db, "The sea", ["waves"])
+
+    assert _found(db, "dragon") == [dragon.id]
+    assert _found(db, "waves wakes") == []
+    assert _found(db, "sleeps wakes") == [dragon.id] # words from different nodes of the same story
+
+
+def test_expanded_nodes_get_added_to_the_story(db):
+    story = _story(db, "Endless", ["a door"])
+
+    index_nodes(db, story.id, [SimpleNamespace(id=99, content="a hidden staircase")])
+    db.commit()
+
+    assert _found(db, "staircase") == [story.id]
+    assert _found(db, "door") == [story.id]
+
+
+def test_removed_stories_are_gone_from_the_index(db):
+    kept, removed = _story(db, "kept tale", ["owl"]), _story(db, "removed tale", ["owl"])
+
+    remove_stories(db, [removed.id])
+    db.commit()
+
+    assert _found(db, "owl") == [kept.id]
+
+
+def test_rebuild_drops_rows_of_deleted_stories(db):
+    story_ids = [_story(db, f"tale {i}", ["lantern"]).id for i in range(5)]
+    for story_id in (story_ids[1], story_ids[4]): # one in the middle, one past the last story left
+        db.query(StoryNode).filter_by(story_id=story_id).delete()
+        db.query(Story).filter_by(id=story_id).delete()
+    db.commit()
+
+    assert rebuild_search_index(db, batch_size=2) == 3
+    assert sorted(_found(db, "lantern")) == [story_ids[0], story_ids[2], story_ids[3]]
+    assert db.execute(text("SELECT count(*) FROM story_search")).scalar() == 3
@@ -0,0 +1,161 @@
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from core.scheduler import GenerationRequest
+from core.search import index_story
+from db.database import get_job_read_db, get_story_db, shard_engines, shard_of, shard_session
+from db.migrations import seed_shard_ids
+from db.sharding import HashRing, id_base, make_key, shard_of_id, shard_of_key
+from models.story import Story, StoryNode
+from routers import story as story_router
+
+from conftest import SHARDS
+
+
+def _add_story(shard: int, session_id: str, title: str, created_at: datetime | None = None, contents=()) -> int:
+    db = shard_session(shard)
+    try:
+        story = Story(title=title, session_id=session_id, created_at=created_at or datetime.now(timezone.utc))
+        db.add(story)
+        db.flush()
+        nodes = [StoryNode(story_id=story.id, content=content, is_root=not i, options=[]) for i, content in enumerate(contents)]
+        db.add_all(nodes)
+        db.flush()
+        index_story(db, story, nodes)
+        db.commit()
+        return story.id
+    finally:
+        db.close()
+
+
+def test_ring_spreads_sessions_over_every_shard():
+    ring = HashRing(SHARDS)
+    placed = Counter(ring.shard_for(f"session-{i}") for i in range(3000))
+
+    assert set(placed) == set(range(SHARDS))
+    assert min(placed.values()) > 3000 / SHARDS / 2 # roughly even, not exact
+    assert ring.shard_for("session-1") == HashRing(SHARDS).shard_for("session-1") # the same on every process
+
+
+def test_adding_a_shard_only_moves_sessions_to_it():
+    before, after = HashRing(SHARDS), HashRing(SHARDS + 1)
+    keys = [f"session-{i}" for i in range(3000)]
+    moved = [key for key in keys if before.shard_for(key) != after.shard_for(key)]
+
+    assert all(after.shard_for(key) == SHARDS for key in moved)
+    assert 0 < len(moved) < len(keys) / 2
+
+
+def test_ids_start_at_the_shard_base():
+    for shard in range(SHARDS):
+        story_id = _add_story(shard, "seeded", "seeded")
+        assert story_id > id_base(shard)
+        assert shard_of_id(story_id) == shard
+
+
+def test_seeding_again_keeps_the_sequence_where_it_is():
+    story_id = _add_story(2, "reseeded", "first")
+    seed_shard_ids(shard_engines[2], 2)
+
+    assert _add_story(2, "reseeded", "second") == story_id + 1
+
+
+def test_job_keys_carry_their_shard():
+    assert [shard_of_key(make_key(shard)) for shard in range(SHARDS)] == list(range(SHARDS))
+    assert shard_of_key(str(uuid.uuid4())) == 0 # from before sharding
+    assert shard_of_key("sx_abc") == 0
+
+
+def test_story_db_follows_the_story_id():
+    for shard in range(SHARDS):
+        dependency = get_story_db(id_base(shard) + 1)
+        assert shard_of(next(dependency)) == shard
+        dependency.close()
+
+
+def test_job_read_db_follows_the_job_id():
+    request = SimpleNamespace(cookies={})
+    for shard in range(SHARDS):
+        dependency = get_job_read_db(make_key(shard), request)
+        assert shard_of(next(dependency)) == shard
+        dependency.close()
+
+
+def test_id_of_a_missing_shard_is_not_found():
+    with pytest.raises(HTTPException) as raised:
+        next(get_story_db(id_base(SHARDS) + 1))
+    assert raised.value.status_code == 404
+
+
+def test_list_merges_shards_newest_first():
+    session_id = f"session-{uuid.uuid4()}"
+    now = datetime.now(timezone.utc)
+    expected = [
+        _add_story(shard, session_id, f"story {i}", now - timedelta(minutes=i))
+        for i, shard in enumerate([1, 0, 2, 2, 1, 0])
+    ]
+
+    page = story_router.list_stories(cursor=None, limit=10, session_id=session_id)
+
+    assert [item.id for item in page.items] == expected
+    assert page.next_cursor is None
+
+
+def test_list_pages_through_equal_timestamps_without_gaps():
+    # the same created_at on every shard, the id breaks the tie (and ids of a later shard are always bigger)
+    session_id = f"session-{uuid.uuid4()}"
+    created_at = datetime(2024, 5, 1, 12, 0, tzinfo=timezone.utc)
+    story_ids = [_add_story(shard, session_id, "same time", created_at) for shard in range(SHARDS) for _ in range(3)]
+
+    seen, cursor = [], None
+    while True:
+        page = story_router.list_stories(cursor=cursor, limit=2, session_id=session_id)
+        seen += [item.id for item in page.items]
+        cursor = page.next_cursor
+        if cursor is None:
+            break
+
+    assert seen == sorted(story_ids, reverse=True)
+
+
+def test_search_merges_every_shard_by_rank():
+    word = f"quux{uuid.uuid4().hex[:8]}"
+    story_ids = {
+        _add_story(shard, "searcher", f"tale {shard}", contents=[f"the {word} sleeps", "something else"])
+        for shard in range(SHARDS)
+    }
+
+    hits = story_router.search(q=word, limit=10).items
+    assert {hit.story_id for hit in hits} == story_ids
+    assert [hit.rank for hit in hits] == sorted((hit.rank for hit in hits), reverse=True)
+
+    assert len(story_router.search(q=word, limit=2).items) == 2
+
+
+def test_generation_batches_stay_on_one_shard(monkeypatch):
+    singles, batches = [], []
+    monkeypatch.setattr(story_router.llm_guard, "retry_after", lambda: 0)
+    monkeypatch.setattr(
+        story_router, "generate_story_task",
+        lambda job_id, theme, session_id, endless=False: singles.append((job_id, endless)),
+    )
+    monkeypatch.setattr(story_router, "generate_story_batch_task", lambda requests: batches.append(requests))
+
+    requests = [
+        GenerationRequest(job_id=make_key(shard), theme="t", session_id="s")
+        for shard in (0, 1, 0, 2, 1, 0)
+    ]
+    endless = GenerationRequest(job_id=make_key(1), theme="t", session_id="s", endless=True)
+    story_router.run_generation_batch(requests + [endless])
+
+    assert sorted(len(batch) for batch in batches) == [2, 3]
+    for batch in batches:
+        assert len({shard_of_key(request.job_id) for request in batch}) == 1
+    assert (endless.job_id, True) in singles
+    # shard 2 only had one job, it goes on its own
+    assert [job_id for job_id, is_endless in singles if not is_endless] == [requests[3].job_id]
@@ -0,0 +1,28 @@
+import pytest
+
+from core.sql_stats import statement_shape
+
+
+@pytest.mark.parametrize("statement", [
+    "SELECT * FROM stories WHERE id = ?",
+    "SELECT * FROM stories WHERE id = :id_1",
+    "SELECT * FROM stories WHERE id = %(id_1)s",
+    "SELECT * FROM stories WHERE id = $1",
+])
+def test_placeholder_styles_look_the_same(statement):
+    assert statement_shape(statement) == "SELECT * FROM stories WHERE id = ?"
+
+
+def test_in_lists_of_any_length_are_one_shape():
+    short = statement_shape("SELECT id FROM storynodes WHERE id IN (?, ?)")
+    long = statement_shape("SELECT id FROM storynodes WHERE id IN (%(id_1)s, %(id_2)s, %(id_3)s,%(id_4)s)")
+
+    assert short == long == "SELECT id FROM storynodes WHERE id IN (?)"
+
+
+def test_whitespace_is_collapsed():
+    assert statement_shape("SELECT id\n    FROM stories\n\tWHERE id = ?") == "SELECT id FROM stories WHERE id = ?"
+
+
+def test_different_statements_stay_different():
+    assert statement_shape("SELECT id FROM stories WHERE id = ?") != statement_shape("SELECT id FROM storynodes WHERE id = ?")
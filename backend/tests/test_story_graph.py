@@ -0,0 +1,68 @@
+from types import SimpleNamespace
+
+from core.story_graph import edge_rows, path_to_root, save_edges
+from db.database import shard_session
+from models.story import Story, StoryNode
+
+
+def test_edge_rows_follow_the_options():
+    nodes = [
+        SimpleNamespace(id=1, options=[{"text": "left", "node_id": 2}, {"text": "right", "node_id": 3}]),
+        SimpleNamespace(id=2, options=[]),
+        SimpleNamespace(id=3, options=None),
+    ]
+
+    assert edge_rows(7, nodes) == [
+        {"story_id": 7, "from_node_id": 1, "to_node_id": 2, "ordinal": 0, "text": "left"},
+        {"story_id": 7, "from_node_id": 1, "to_node_id": 3, "ordinal": 1, "text": "right"},
+    ]
+
+
+def test_edge_rows_skip_options_without_a_node():
+    # the ordinal stays the option's position
+    node = SimpleNamespace(id=1, options=[{"text": "nowhere"}, {"text": "on", "node_id": 2}])
+
+    assert [(row["to_node_id"], row["ordinal"]) for row in edge_rows(7, [node])] == [(2, 1)]
+
+
+def _chain(db, length: int) -> list[StoryNode]:
+    # root -> step 1 -> ... plus a dead end off the root
+    story = Story(title="path", session_id="graph")
+    db.add(story)
+    db.flush()
+    nodes = [StoryNode(story_id=story.id, is_root=not i, options=[]) for i in range(length + 1)]
+    db.add_all(nodes)
+    db.flush()
+    for i, node in enumerate(nodes[:length - 1]):
+        node.options = [{"text": f"go {i + 1}", "node_id": nodes[i + 1].id}]
+    nodes[0].options = nodes[0].options + [{"text": "stop", "node_id": nodes[length].id}]
+    save_edges(db, story.id, nodes)
+    db.commit()
+    return nodes
+
+
+def test_path_to_root_goes_from_the_root_down():
+    db = shard_session(0)
+    try:
+        nodes = _chain(db, 4)
+
+        assert path_to_root(db, nodes[3].id) == [
+            (nodes[0].id, "go 1"),
+            (nodes[1].id, "go 2"),
+            (nodes[2].id, "go 3"),
+            (nodes[3].id, None),
+        ]
+        assert path_to_root(db, nodes[4].id) == [(nodes[0].id, "stop"), (nodes[4].id, None)]
+        assert path_to_root(db, nodes[0].id) == [(nodes[0].id, None)]
+    finally:
+        db.close()
+
+
+def test_path_to_root_keeps_the_last_steps():
+    db = shard_session(0)
+    try:
+        nodes = _chain(db, 5)
+
+        assert path_to_root(db, nodes[4].id, max_steps=2) == [(nodes[3].id, "go 4"), (nodes[4].id, None)]
+    finally:
+        db.close()
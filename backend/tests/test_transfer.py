@@ -0,0 +1,98 @@
+import io
+from datetime import datetime, timezone
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from core.content_store import load_contents, store_contents
+from core.story_stats import apply_story_stats, compute_story_stats
+from core.transfer import export_stories, import_stories
+from db.database import Base
+from models.job import StoryJob
+from models.story import Story, StoryEdge, StoryNode
+
+
+@pytest.fixture
+def target(tmp_path):
+    # a second database to import into
+    engine = create_engine(f"sqlite:///{tmp_path}/target.db")
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+def _add_story(db, title: str, job_status: str = "completed") -> int:
+    # root -> (a winning ending, b -> a losing ending)
+    texts = [f"{title} root", f"{title} win", f"{title} middle", f"{title} lose"]
+    hashes = store_contents(db, texts)
+    story = Story(title=title, session_id="s", completed_at=datetime.now(timezone.utc))
+    db.add(story)
+    db.flush()
+    root, win, middle, lose = nodes = [
+        StoryNode(story_id=story.id, content_hash=hashes[text], is_root=i == 0, options=[]) for i, text in enumerate(texts)
+    ]
+    win.is_ending = win.is_winning_ending = lose.is_ending = True
+    db.add_all(nodes)
+    db.flush()
+    root.options = [{"text": "win", "node_id": win.id}, {"text": "go on", "node_id": middle.id}]
+    middle.options = [{"text": "lose", "node_id": lose.id}]
+    apply_story_stats(story, compute_story_stats(nodes))
+    db.add(StoryJob(job_id=f"job-{title}", session_id="s", theme=title, status=job_status, story_id=story.id))
+    db.commit()
+    return story.id
+
+
+def _export(db) -> list[str]:
+    out = io.StringIO()
+    export_stories(db, out)
+    return out.getvalue().splitlines()
+
+
+def test_round_trip_points_at_the_new_nodes(db, target):
+    _add_story(db, "first")
+    _add_story(db, "second")
+    _add_story(target, "already there") # so the new ids can't line up with the old ones by chance
+    lines = _export(db)
+
+    counts = import_stories(target, lines, batch_size=1, index=False)
+    assert (counts["stories"], counts["nodes"], counts["jobs"]) == (2, 8, 2)
+
+    for title in ("first", "second"):
+        story = target.query(Story).filter_by(title=title).one()
+        nodes = {node.id: node for node in target.query(StoryNode).filter_by(story_id=story.id)}
+        texts = load_contents(target, [node.content_hash for node in nodes.values()])
+
+        root_id, win_id = story.shortest_winning_path
+        assert nodes[root_id].is_root and nodes[win_id].is_winning_ending
+        assert texts[nodes[win_id].content_hash] == f"{title} win"
+        assert all(option["node_id"] in nodes for node in nodes.values() for option in node.options)
+        assert story.shortest_winning_path == compute_story_stats(nodes.values()).shortest_winning_path
+        assert target.query(StoryEdge).filter_by(story_id=story.id).count() == 3
+        assert target.query(StoryJob).filter_by(story_id=story.id).one().job_id == f"job-{title}"
+
+
+def test_importing_twice_skips_what_is_there(db, target):
+    _add_story(db, "once")
+    lines = _export(db)
+
+    import_stories(target, lines, index=False)
+    counts = import_stories(target, lines, index=False)
+
+    assert (counts["stories"], counts["skipped_stories"], counts["skipped_jobs"]) == (0, 1, 1)
+    assert target.query(Story).count() == 1
+
+
+def test_unfinished_jobs_come_in_failed(db, target):
+    _add_story(db, "running", job_status="processing")
+    db.add(StoryJob(job_id="job-queued", session_id="s", theme="t", status="pending", lease_owner="gone"))
+    db.commit()
+
+    import_stories(target, _export(db), index=False)
+
+    jobs = {job.job_id: job for job in target.query(StoryJob)}
+    assert {job.status for job in jobs.values()} == {"failed"}
+    assert jobs["job-queued"].lease_owner is None and jobs["job-queued"].story_id is None
+    assert jobs["job-running"].story_id == target.query(Story).one().id